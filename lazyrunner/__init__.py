@@ -9,5 +9,9 @@ from manager import initialize, manager, reset, clean
 
 from configuration import configTree
 
+from streams import ResultStream
+
+from exceptions import ModuleCancelled, ModuleTimeout
+
 import creation
 
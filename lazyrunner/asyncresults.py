@@ -0,0 +1,350 @@
+"""
+Getting results without blocking the caller.  Requests are queued
+and run on background threads, each module requested getting a
+ResultFuture to wait on.  Requests for a module under a parameter
+tree already queued or running share the one computation.  A free
+thread takes everything queued and runs it in one pass over a graph
+built for all of it, whatever the parameter trees, so the nodes the
+requests have in common are computed once.  A pass is cancelled once
+nothing is waiting on it.  Passes running at the same time, with more
+than one thread, don't share work in progress; they share nodes only
+through the cache, as each loads what another has saved.
+
+There is no asyncio in python 2; code running an event loop (a
+trollius or tornado loop, say) can get woken up through
+`ResultFuture.addDoneCallback`, which is called on a worker thread.
+"""
+
+import sys, time, threading, logging
+from collections import deque
+from exceptions import CancelledError, ResultTimeout
+
+class _Job(object):
+    # The computation of module `name` under the parameter tree `ptree`
+
+    def __init__(self, name, ptree, key):
+        self.name = name
+        self.ptree = ptree
+        self.key = key
+        self.state = "pending"
+        self.value = None
+        self.exc_info = None
+        self.futures = []
+
+        # Once running, the jobs run in the same pass and the event
+        # cancelling it
+        self.batch = None
+        self.cancel_event = None
+
+class ResultFuture(object):
+    """
+    The results of one module requested through
+    `AsyncRunner.submit`.  Each request gets its own future, even
+    when it shares the computation with another, so cancelling one
+    leaves the others be.
+    """
+
+    def __init__(self, runner, job):
+        self.name = job.name
+        self._runner = runner
+        self._job = job
+        self._cancelled = False
+        self._callbacks = []
+
+    def done(self):
+        """
+        Returns True if the results are in, the computation failed,
+        or the future was cancelled.
+        """
+
+        with self._runner.condition:
+            return self._cancelled or self._job.state == "finished"
+
+    def running(self):
+        """
+        Returns True if the module is being computed.
+        """
+
+        with self._runner.condition:
+            return not self._cancelled and self._job.state == "running"
+
+    def cancelled(self):
+        """
+        Returns True if the future was cancelled.
+        """
+
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancels the request unless it's done already, returning True
+        if it is cancelled.  The computation itself is dropped once no
+        request is waiting on it; if running, it's stopped once no
+        request waits on anything in the same pass (see
+        `PModule.checkCancelled`).
+        """
+
+        with self._runner.condition:
+            if self._cancelled:
+                return True
+
+            if self._job.state == "finished":
+                return False
+
+            self._cancelled = True
+            self._runner._dropFuture(self)
+            self._runner.condition.notify_all()
+
+            callbacks, self._callbacks = self._callbacks, []
+
+        self._runner._callBack(callbacks, self)
+
+        return True
+
+    def result(self, timeout = None):
+        """
+        Waits for and returns the results of the module, raising the
+        exception it raised if it failed.  Raises CancelledError if
+        the future was cancelled, or ResultTimeout if `timeout`
+        seconds pass first.
+        """
+
+        self._wait(timeout)
+
+        if self._job.exc_info is not None:
+            t, v, tb = self._job.exc_info
+            raise t, v, tb
+
+        return self._job.value
+
+    def exception(self, timeout = None):
+        """
+        Waits for the module to finish as `result` does, returning the
+        exception it raised, or None if it succeeded.
+        """
+
+        self._wait(timeout)
+
+        return self._job.exc_info[1] if self._job.exc_info is not None else None
+
+    def addDoneCallback(self, f):
+        """
+        Calls `f(future)` once the future is done; right away if it
+        already is, otherwise on the thread finishing it.
+        """
+
+        with self._runner.condition:
+            if not (self._cancelled or self._job.state == "finished"):
+                self._callbacks.append(f)
+                return
+
+        self._runner._callBack([f], self)
+
+    def _wait(self, timeout):
+
+        with self._runner.condition:
+            if timeout is not None:
+                end_time = time.time() + timeout
+
+            while not (self._cancelled or self._job.state == "finished"):
+                if timeout is None:
+                    self._runner.condition.wait()
+                else:
+                    remaining = end_time - time.time()
+
+                    if remaining <= 0:
+                        raise ResultTimeout("Results of '%s' not ready after %g seconds."
+                                            % (self.name, timeout))
+
+                    self._runner.condition.wait(remaining)
+
+            if self._cancelled:
+                raise CancelledError("Request for the results of '%s' was cancelled." % self.name)
+
+class AsyncRunner(object):
+    """
+    Runs the submitted requests on `n_workers` background threads.
+    `run(requests, cancel_event)` computes, for each (parameter tree,
+    module names) pair in `requests`, the list of the results of
+    those modules under that tree, returning the lists in order, and
+    should stop once the threading.Event `cancel_event` is set.
+    """
+
+    def __init__(self, run, n_workers):
+        self.run = run
+        self.n_workers = max(1, n_workers)
+        self.log = logging.getLogger("Manager")
+
+        self.condition = threading.Condition()
+
+        # Jobs waiting to start, in order, and (name, tree hash) -> job
+        # for everything pending or running
+        self.pending = deque()
+        self.jobs = {}
+
+        self.threads = []
+        self.closed = False
+
+    def submit(self, ptree, names):
+        """
+        Queues the computation of the modules `names` under the
+        parameter tree `ptree`, returning a dict mapping each name to
+        its ResultFuture.
+        """
+
+        h = ptree.hash()
+        futures = {}
+
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Requests can't be submitted after the runner is closed.")
+
+            for name in names:
+                if name in futures:
+                    continue
+
+                key = (name, h)
+                job = self.jobs.get(key)
+
+                if job is None:
+                    job = self.jobs[key] = _Job(name, ptree, key)
+                    self.pending.append(job)
+
+                f = ResultFuture(self, job)
+                job.futures.append(f)
+                futures[name] = f
+
+            if len(self.threads) < min(self.n_workers, len(self.jobs)):
+                t = threading.Thread(target = self._work, name = "lazyrunner-async")
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+            self.condition.notify_all()
+
+        return futures
+
+    def close(self):
+        """
+        Cancels the requests that haven't started, waits for the
+        running ones and stops the background threads.
+        """
+
+        with self.condition:
+            self.closed = True
+
+            dropped = [f for job in self.pending for f in job.futures]
+            self.condition.notify_all()
+
+        for f in dropped:
+            f.cancel()
+
+        for t in self.threads:
+            t.join()
+
+    def _dropFuture(self, f):
+        # Called with the condition held
+
+        job = f._job
+        job.futures.remove(f)
+
+        if job.futures:
+            return
+
+        if job.state == "pending":
+            self.pending.remove(job)
+            del self.jobs[job.key]
+
+        elif job.state == "running" and not any(j.futures for j in job.batch):
+            job.cancel_event.set()
+
+    def _callBack(self, callbacks, f):
+        for c in callbacks:
+            try:
+                c(f)
+            except Exception:
+                self.log.exception("Exception raised in callback of future for '%s'." % f.name)
+
+    def _work(self):
+
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+
+                if not self.pending:
+                    return
+
+                # Everything queued goes in one pass
+                batch = list(self.pending)
+                self.pending.clear()
+
+                cancel_event = threading.Event()
+
+                for job in batch:
+                    job.state = "running"
+                    job.batch = batch
+                    job.cancel_event = cancel_event
+
+            # The jobs by parameter tree, in the order queued
+            groups = []
+            group_lookup = {}
+
+            for job in batch:
+                h = job.key[1]
+
+                if h not in group_lookup:
+                    group_lookup[h] = []
+                    groups.append(group_lookup[h])
+
+                group_lookup[h].append(job)
+
+            results = self._runGroups(groups, cancel_event)
+
+            callbacks = []
+
+            with self.condition:
+                for group, (values, exc_info) in zip(groups, results):
+                    for job, v in zip(group, values):
+                        job.value = v
+                        job.exc_info = exc_info
+                        job.state = "finished"
+                        job.batch = None
+                        del self.jobs[job.key]
+
+                        for f in job.futures:
+                            callbacks.append( (f, f._callbacks) )
+                            f._callbacks = []
+
+                self.condition.notify_all()
+
+            # Don't keep the tracebacks' frames around on this thread
+            results = None
+
+            for f, cl in callbacks:
+                self._callBack(cl, f)
+
+    def _runGroups(self, groups, cancel_event):
+        # Returns (values, exc_info) for each group of jobs.  If a
+        # pass over several parameter trees fails, each is run on its
+        # own, so a failure under one tree doesn't fail the others;
+        # what the first pass finished is loaded from the cache.
+
+        requests = [(group[0].ptree, [job.name for job in group]) for group in groups]
+
+        try:
+            return [(values, None) for values in self.run(requests, cancel_event)]
+        except Exception:
+            if len(groups) == 1 or cancel_event.is_set():
+                exc_info = sys.exc_info()
+                return [([None] * len(group), exc_info) for group in groups]
+
+        ret = []
+
+        for group, request in zip(groups, requests):
+            try:
+                ret.append( (self.run([request], cancel_event)[0], None) )
+            except Exception:
+                ret.append( ([None] * len(group), sys.exc_info()) )
+
+        return ret
@@ -0,0 +1,213 @@
+"""
+Cache bundles: the cache entries a run needs, packed into one tar
+archive for copying to other machines.  The first member of the
+archive is a manifest giving the size and SHA-1 hash of each entry;
+importing checks every entry against it before moving it into the
+cache directory.
+
+The archive is compressed if its name ends in .gz/.tgz or .bz2/.tbz2;
+the cache files themselves are stored as they are.
+"""
+
+import os, tarfile, hashlib, json, time, logging
+from os.path import join, exists, split, isdir, getsize
+from cStringIO import StringIO
+from diskio import temporaryFilename
+from exceptions import BundleError
+
+_manifest_name = "lazyrunner-manifest.json"
+_format = 1
+
+def _compression(filename):
+    if filename.endswith((".gz", ".tgz")):
+        return "gz"
+    elif filename.endswith((".bz2", ".tbz2", ".tbz")):
+        return "bz2"
+    else:
+        return ""
+
+def _keyPath(directory, key):
+    # Keys are relative, '/' separated paths that stay inside the
+    # cache directory.
+    parts = key.split("/")
+
+    if not key or key.startswith("/") or "\\" in key or any(p in ("", ".", "..") for p in parts):
+        raise BundleError("Invalid entry name '%s' in bundle." % key)
+
+    return join(directory, *parts)
+
+def _hashFile(filename):
+    h = hashlib.sha1()
+    f = open(filename, 'rb')
+
+    try:
+        while True:
+            block = f.read(2**20)
+
+            if not block:
+                break
+
+            h.update(block)
+    finally:
+        f.close()
+
+    return h.hexdigest()
+
+def writeBundle(directory, filename, keys):
+    """
+    Writes the cache entries `keys`, relative paths in the cache
+    directory `directory`, to the bundle `filename`.  Returns the
+    number of bytes of cache entries written.
+    """
+
+    keys = sorted(set(keys))
+
+    entries = []
+
+    for key in keys:
+        path = _keyPath(directory, key)
+        entries.append({"key" : key, "size" : getsize(path), "sha1" : _hashFile(path)})
+
+    manifest = json.dumps({"format" : _format, "created" : time.time(), "entries" : entries},
+                          indent = 1, sort_keys = True)
+
+    temp_filename = temporaryFilename(filename)
+    tf = tarfile.open(temp_filename, "w:" + _compression(filename))
+
+    try:
+        info = tarfile.TarInfo(_manifest_name)
+        info.size = len(manifest)
+        info.mtime = time.time()
+        tf.addfile(info, StringIO(manifest))
+
+        # Each entry is written as a regular file; tarfile.add would
+        # write hard linked ones, e.g. deduplicated results, as links
+        # to the first, which readBundle doesn't accept.
+        for e in entries:
+            f = open(_keyPath(directory, e["key"]), 'rb')
+
+            try:
+                info = tarfile.TarInfo(e["key"])
+                info.size = e["size"]
+                info.mtime = os.fstat(f.fileno()).st_mtime
+                info.mode = 0644
+                tf.addfile(info, f)
+            finally:
+                f.close()
+
+    except:
+        tf.close()
+        os.remove(temp_filename)
+        raise
+
+    tf.close()
+    os.rename(temp_filename, filename)
+
+    return sum(e["size"] for e in entries)
+
+def readBundle(directory, filename, overwrite = False):
+    """
+    Unpacks the bundle `filename` into the cache directory
+    `directory`.  Each entry is checked against the size and hash in
+    the manifest before being moved into place; entries already in
+    the cache are skipped unless `overwrite` is True.  Returns the
+    lists of the keys imported and skipped.  Raises BundleError if
+    the bundle is malformed or an entry fails the checks; the entries
+    moved into place before that are left.
+    """
+
+    log = logging.getLogger("Manager")
+
+    try:
+        tf = tarfile.open(filename, "r:*")
+    except tarfile.TarError, e:
+        raise BundleError("%s is not a cache bundle: %s" % (filename, str(e)))
+
+    imported = []
+    skipped = []
+
+    try:
+        info = tf.next()
+
+        if info is None or info.name != _manifest_name:
+            raise BundleError("%s is not a cache bundle: manifest missing." % filename)
+
+        try:
+            manifest = json.loads(tf.extractfile(info).read())
+        except ValueError, e:
+            raise BundleError("Manifest of %s is corrupt: %s" % (filename, str(e)))
+
+        if manifest.get("format") != _format:
+            raise BundleError("%s is in an unsupported bundle format." % filename)
+
+        entries = dict( (e["key"], e) for e in manifest["entries"])
+        seen = set()
+
+        while True:
+            info = tf.next()
+
+            if info is None:
+                break
+
+            key = info.name
+
+            if key not in entries or key in seen or not info.isfile():
+                raise BundleError("Unexpected entry '%s' in %s." % (key, filename))
+
+            seen.add(key)
+            path = _keyPath(directory, key)
+
+            if exists(path) and not overwrite:
+                skipped.append(key)
+                continue
+
+            d = split(path)[0]
+
+            if not isdir(d):
+                os.makedirs(d)
+
+            temp_filename = temporaryFilename(path)
+            src = tf.extractfile(info)
+            h = hashlib.sha1()
+            size = 0
+
+            try:
+                out = open(temp_filename, 'wb')
+
+                try:
+                    while True:
+                        block = src.read(2**20)
+
+                        if not block:
+                            break
+
+                        h.update(block)
+                        size += len(block)
+                        out.write(block)
+                finally:
+                    out.close()
+
+                if size != entries[key]["size"] or h.hexdigest() != entries[key]["sha1"]:
+                    raise BundleError("Entry '%s' in %s is corrupt." % (key, filename))
+
+                os.rename(temp_filename, path)
+
+            finally:
+                if exists(temp_filename):
+                    os.remove(temp_filename)
+
+            log.debug("Imported %s." % key)
+            imported.append(key)
+
+        missing = set(entries) - seen
+
+        if missing:
+            raise BundleError("%s is truncated; %d entries missing." % (filename, len(missing)))
+
+    except tarfile.TarError, e:
+        raise BundleError("Error reading %s: %s" % (filename, str(e)))
+
+    finally:
+        tf.close()
+
+    return imported, skipped
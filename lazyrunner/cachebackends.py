@@ -0,0 +1,451 @@
+"""
+Storage backends for a shared results cache.  The local cache
+directory is always the working copy; if a backend is configured
+(the `cache_backend` option), results missing locally are looked up
+in it, and results saved locally are also put to it, so several
+machines can share one store.
+
+A backend stores byte strings under keys, the relative '/' separated
+paths of the cache files.  Besides a plain directory (`file://` URLs,
+e.g. on a network drive), a store can be served over HTTP by
+`lazyrunner.cacheserver`; `HTTPBackend` talks to it over a pool of
+kept-alive connections and checks for many keys in one request.
+"""
+
+import os, threading, socket, httplib, urlparse, urllib, json
+from os.path import join, exists, getsize, split, isdir, normpath
+from collections import deque
+
+class CacheBackend(object):
+    """
+    The interface of a cache store.  Subclasses define probe(), get(),
+    put(), delete() and list(); the batch versions call these one key
+    at a time unless overridden.
+    """
+
+    def probe(self, key):
+        """
+        Returns the size in bytes of the object stored under `key`,
+        or None if there isn't one.
+        """
+        raise NotImplementedError
+
+    def get(self, key):
+        """
+        Returns the bytes stored under `key`; raises KeyError if
+        there's nothing there.
+        """
+        raise NotImplementedError
+
+    def put(self, key, data):
+        """
+        Stores the byte string `data` under `key`, replacing what was
+        there.
+        """
+        raise NotImplementedError
+
+    def putFile(self, key, f):
+        """
+        Stores the contents of the open file `f` under `key`, as put()
+        does; backends override this to copy it without reading it all
+        into memory.
+        """
+        self.put(key, f.read())
+
+    def delete(self, key):
+        """
+        Removes the object under `key`; returns False if there wasn't
+        one.
+        """
+        raise NotImplementedError
+
+    def list(self, prefix = ""):
+        """
+        Returns a sorted list of the keys starting with `prefix`.
+        """
+        raise NotImplementedError
+
+    def probeMany(self, keys):
+        """
+        Returns a list with what probe() gives for each key in `keys`.
+        """
+        return [self.probe(k) for k in keys]
+
+    def getMany(self, keys):
+        """
+        Returns a dict mapping each key in `keys` that is stored to
+        its bytes.
+        """
+
+        ret = {}
+
+        for k in keys:
+            try:
+                ret[k] = self.get(k)
+            except KeyError:
+                pass
+
+        return ret
+
+    def putMany(self, items):
+        """
+        Stores each (key, data) pair in `items`.
+        """
+        for k, data in items:
+            self.put(k, data)
+
+    def close(self):
+        pass
+
+# The size of the blocks files are copied in
+_block_size = 2**16
+
+def _checkKey(key):
+    # Keys are relative paths that stay inside the store
+    if (not key or key.startswith("/") or "\\" in key
+        or any(part in ("", ".", "..") for part in key.split("/"))):
+        raise ValueError("Invalid cache key '%s'." % key)
+
+    return key
+
+class LocalBackend(CacheBackend):
+    """
+    A store in the directory `directory`, one file per key.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, key):
+        return join(self.directory, *_checkKey(key).split("/"))
+
+    def probe(self, key):
+        filename = self.path(key)
+
+        return getsize(filename) if exists(filename) else None
+
+    def get(self, key):
+        try:
+            f = open(self.path(key), 'rb')
+        except IOError:
+            raise KeyError(key)
+
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def put(self, key, data):
+        self._write(key, lambda out: out.write(data))
+
+    def putFile(self, key, f, size = None):
+        """
+        Stores the contents of the open file `f`, or its next `size`
+        bytes if given, under `key`.
+        """
+
+        def copy(out):
+            remaining = size
+
+            while remaining is None or remaining > 0:
+                block = f.read(_block_size if remaining is None else min(_block_size, remaining))
+
+                if not block:
+                    if remaining is not None:
+                        raise IOError("File ended %d bytes short." % remaining)
+
+                    return
+
+                out.write(block)
+
+                if remaining is not None:
+                    remaining -= len(block)
+
+        self._write(key, copy)
+
+    def _write(self, key, write):
+        filename = self.path(key)
+        d = split(filename)[0]
+
+        if not exists(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                # Created by someone else in the mean time
+                if not isdir(d):
+                    raise
+
+        # Readers never see a partly written file
+        temp_filename = "%s.%d-%d.tmp" % (filename, os.getpid(), id(threading.currentThread()))
+
+        f = open(temp_filename, 'wb')
+
+        try:
+            write(f)
+        except:
+            f.close()
+            os.remove(temp_filename)
+            raise
+
+        f.close()
+        os.rename(temp_filename, filename)
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+            return True
+        except OSError:
+            return False
+
+    def list(self, prefix = ""):
+        ret = []
+
+        for d, dirs, files in os.walk(self.directory):
+            rel = os.path.relpath(d, self.directory)
+            parts = [] if rel == "." else rel.split(os.sep)
+
+            for f in files:
+                if f.endswith(".tmp"):
+                    continue
+
+                key = "/".join(parts + [f])
+
+                if key.startswith(prefix):
+                    ret.append(key)
+
+        return sorted(ret)
+
+class _ConnectionPool(object):
+    """
+    At most `size` kept-alive connections to one server, shared
+    between threads.
+    """
+
+    def __init__(self, host, port, size, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(size)
+
+    def request(self, method, path, body = None, headers = {}):
+        # Returns (status, headers, body) of the response
+
+        self.available.acquire()
+
+        try:
+            # A kept-alive connection may have been closed by the
+            # server since it was last used; then try a fresh one.
+            for attempt in [0, 1]:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+
+                fresh = conn is None
+
+                if fresh:
+                    conn = httplib.HTTPConnection(self.host, self.port, timeout = self.timeout)
+
+                # A file is sent from the start each time
+                if hasattr(body, "seek"):
+                    body.seek(0)
+
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+
+                    if fresh or attempt == 1:
+                        raise
+
+                    continue
+
+                if response.getheader("connection", "").lower() == "close":
+                    conn.close()
+                else:
+                    with self.lock:
+                        self.idle.append(conn)
+
+                return response.status, dict(response.getheaders()), data
+
+        finally:
+            self.available.release()
+
+    def close(self):
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
+
+def _runInParallel(f, items, n_threads):
+    # Calls f on each item on up to n_threads threads; re-raises the
+    # first exception.
+
+    items = deque(items)
+    errors = []
+
+    def work():
+        while not errors:
+            try:
+                item = items.popleft()
+            except IndexError:
+                return
+
+            try:
+                f(item)
+            except Exception, e:
+                errors.append(e)
+
+    threads = [threading.Thread(target = work) for i in xrange(min(n_threads, len(items)))]
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+class HTTPBackend(CacheBackend):
+    """
+    A store served over HTTP by `lazyrunner.cacheserver` at `url`,
+    using up to `n_connections` connections at once.  Errors talking
+    to the server raise IOError.
+    """
+
+    def __init__(self, url, n_connections = 4, timeout = 60):
+        u = urlparse.urlparse(url)
+
+        if u.scheme != "http" or not u.hostname:
+            raise ValueError("Cache server URL must be of the form http://host:port/path.")
+
+        self.url = url
+        self.n_connections = n_connections
+        self.base_path = u.path.rstrip("/")
+        self.pool = _ConnectionPool(u.hostname, u.port or 80, n_connections, timeout)
+
+    def _request(self, method, path, body = None, headers = {}):
+        try:
+            return self.pool.request(method, self.base_path + path, body, headers)
+        except (httplib.HTTPException, socket.error), e:
+            raise IOError("Error talking to cache server at %s: %s" % (self.url, str(e)))
+
+    def _objectPath(self, key):
+        return "/objects/" + urllib.quote(_checkKey(key))
+
+    def _error(self, status, data):
+        return IOError("Cache server at %s returned %d: %s" % (self.url, status, data.strip()))
+
+    def probe(self, key):
+        status, headers, data = self._request("HEAD", self._objectPath(key))
+
+        if status == 404:
+            return None
+        elif status != 200:
+            raise self._error(status, data)
+
+        return int(headers["content-length"])
+
+    def get(self, key):
+        status, headers, data = self._request("GET", self._objectPath(key))
+
+        if status == 404:
+            raise KeyError(key)
+        elif status != 200:
+            raise self._error(status, data)
+
+        return data
+
+    def put(self, key, data):
+        status, headers, ret = self._request(
+            "PUT", self._objectPath(key), data,
+            {"Content-Type" : "application/octet-stream"})
+
+        if status not in (200, 201, 204):
+            raise self._error(status, ret)
+
+    def putFile(self, key, f):
+        # httplib sends a file body in blocks
+        status, headers, ret = self._request(
+            "PUT", self._objectPath(key), f,
+            {"Content-Type" : "application/octet-stream",
+             "Content-Length" : str(os.fstat(f.fileno()).st_size)})
+
+        if status not in (200, 201, 204):
+            raise self._error(status, ret)
+
+    def delete(self, key):
+        status, headers, data = self._request("DELETE", self._objectPath(key))
+
+        if status == 404:
+            return False
+        elif status not in (200, 204):
+            raise self._error(status, data)
+
+        return True
+
+    def list(self, prefix = ""):
+        status, headers, data = self._request(
+            "GET", "/list?" + urllib.urlencode({"prefix" : prefix}))
+
+        if status != 200:
+            raise self._error(status, data)
+
+        return json.loads(data)
+
+    def probeMany(self, keys):
+        # One request for all of them
+        keys = [_checkKey(k) for k in keys]
+
+        if not keys:
+            return []
+
+        status, headers, data = self._request(
+            "POST", "/probe", json.dumps(keys), {"Content-Type" : "application/json"})
+
+        if status != 200:
+            raise self._error(status, data)
+
+        return json.loads(data)
+
+    def getMany(self, keys):
+        ret = {}
+
+        def get(k):
+            try:
+                ret[k] = self.get(k)
+            except KeyError:
+                pass
+
+        _runInParallel(get, keys, self.n_connections)
+
+        return ret
+
+    def putMany(self, items):
+        _runInParallel(lambda t: self.put(*t), items, self.n_connections)
+
+    def close(self):
+        self.pool.close()
+
+def backendFromOptions(opttree):
+    """
+    Returns the backend given by the `cache_backend` option, or None
+    if there isn't one.
+    """
+
+    url = opttree.cache_backend
+
+    if not url:
+        return None
+
+    if url.startswith("file://"):
+        return LocalBackend(normpath(os.path.expanduser(url[len("file://"):])))
+
+    if url.startswith("http://"):
+        return HTTPBackend(url, opttree.cache_backend_connections)
+
+    raise ValueError("cache_backend must be a file:// or http:// URL.")
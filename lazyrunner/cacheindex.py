@@ -0,0 +1,185 @@
+"""
+Which module versions each cache entry was computed with.  When a
+module's version changes, the keys of its entries and of those of
+every module depending on it change, so the old entries are never
+read again.  Each entry written is recorded here along with the
+versions its key depends on, so entries for superseded versions can
+be found and removed (see `VersionIndex.prune`).
+
+The records are appended to one log file per module directory, a
+JSON list of the key and the versions on each line; appends of a
+line are atomic, so several processes can share the index.  Pruning
+rewrites a log, so appends take a shared lock (flock, on a lock file
+next to the log) and the rewrite an exclusive one.  Entries written
+before the index existed aren't recorded, and are left alone.
+"""
+
+import os, json, logging, shutil
+from os.path import join, exists, split, isdir, getsize
+from contextlib import contextmanager
+from diskio import temporaryFilename
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class VersionIndex(object):
+    """
+    The index kept in `directory`.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log = logging.getLogger("RunCTRL")
+
+    def _logFilename(self, key):
+        return join(self.directory, key.split("/")[0] + ".log")
+
+    def record(self, key, versions):
+        """
+        Records that the cache entry `key` (a '/' separated path in
+        the cache directory) was computed with `versions`, a dict
+        mapping module names to their versions as strings.
+        """
+
+        filename = self._logFilename(key)
+
+        try:
+            if not isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not isdir(self.directory):
+                        raise
+
+            with self._locked(filename):
+                # Written in one call so concurrent appends don't mix
+                f = open(filename, 'a')
+
+                try:
+                    f.write(json.dumps([key, versions], sort_keys = True) + "\n")
+                finally:
+                    f.close()
+
+        except (IOError, OSError), e:
+            self.log.warning("Could not record the versions of %s: %s" % (key, str(e)))
+
+    @contextmanager
+    def _locked(self, filename, exclusive = False):
+        # Holds the lock of the log `filename`.  It's on a file of its
+        # own, as the log itself is replaced when rewritten.
+
+        if fcntl is None:
+            yield
+            return
+
+        f = open(filename + ".lock", 'a')
+
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            # Closing it releases the lock
+            f.close()
+
+    def _read(self, filename):
+        # Returns a dict mapping each key to its latest versions
+
+        records = {}
+
+        f = open(filename, 'r')
+
+        try:
+            for line in f:
+                try:
+                    key, versions = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+
+                records[key] = versions
+        finally:
+            f.close()
+
+        return records
+
+    def prune(self, cache_directory, current, archive_directory = None):
+        """
+        Removes the entries in `cache_directory` computed with a
+        version of a module other than the one in `current`, a dict
+        mapping module names to their current versions as strings.
+        Modules not in `current` are ignored.  If `archive_directory`
+        is given, the entries are moved there, to the same relative
+        paths, instead of deleted.  Returns the number of entries and
+        bytes removed.
+        """
+
+        n_removed = 0
+        n_bytes = 0
+
+        if not isdir(self.directory):
+            return n_removed, n_bytes
+
+        for log_name in sorted(os.listdir(self.directory)):
+            if not log_name.endswith(".log"):
+                continue
+
+            log_filename = join(self.directory, log_name)
+
+            with self._locked(log_filename):
+                records = self._read(log_filename)
+
+            for key, versions in sorted(records.iteritems()):
+                path = join(cache_directory, *key.split("/"))
+
+                if not exists(path):
+                    continue
+
+                stale = [n for n, v in versions.iteritems() if n in current and current[n] != v]
+
+                if not stale:
+                    continue
+
+                size = getsize(path)
+
+                try:
+                    if archive_directory is not None:
+                        dest = join(archive_directory, *key.split("/"))
+
+                        if not isdir(split(dest)[0]):
+                            os.makedirs(split(dest)[0])
+
+                        shutil.move(path, dest)
+                    else:
+                        os.remove(path)
+
+                except (IOError, OSError), e:
+                    self.log.warning("Could not remove %s: %s" % (path, str(e)))
+                    continue
+
+                self.log.debug("Removed %s; computed with an earlier version of %s."
+                               % (key, ", ".join(sorted(stale))))
+
+                n_removed += 1
+                n_bytes += size
+
+            # Rewrite the log with the entries still there.  It's read
+            # again under the lock, so records appended meanwhile are
+            # kept.
+            with self._locked(log_filename, exclusive = True):
+                records = self._read(log_filename)
+                temp_filename = temporaryFilename(log_filename)
+
+                f = open(temp_filename, 'w')
+
+                try:
+                    for key, versions in sorted(records.iteritems()):
+                        if exists(join(cache_directory, *key.split("/"))):
+                            f.write(json.dumps([key, versions], sort_keys = True) + "\n")
+                finally:
+                    f.close()
+
+                os.rename(temp_filename, log_filename)
+
+        return n_removed, n_bytes
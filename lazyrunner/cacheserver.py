@@ -0,0 +1,192 @@
+"""
+A small HTTP server for a shared results cache, holding the store in
+a local directory; see `cachebackends.HTTPBackend` for the client.
+Run it with::
+
+  python -m lazyrunner.cacheserver [--host <host>] <directory> [port]
+
+and set the `cache_backend` option to ``http://<host>:<port>/``.
+
+The server has no authentication: anyone who can connect to it can
+read, replace and delete the entries, and as clients unpickle the
+results they load, anyone who can write an entry can run code on
+every client.  It therefore listens only on the local host unless
+another address is given with --host; serve it further only to
+trusted machines, e.g. on a private network or through an SSH tunnel.
+
+The protocol: GET, HEAD, PUT and DELETE on ``/objects/<key>``; POST
+to ``/probe`` with a JSON list of keys returns a JSON list of their
+sizes (null for missing ones); GET ``/list?prefix=<prefix>`` returns
+a JSON list of the keys.
+"""
+
+import sys, threading, urllib, urlparse, json, logging
+from optparse import OptionParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from cachebackends import LocalBackend
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # For keep-alive connections
+    protocol_version = "HTTP/1.1"
+
+    def _respond(self, status, data = "", content_type = "application/octet-stream",
+                 length = None):
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data) if length is None else length))
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def _key(self):
+        path = urlparse.urlparse(self.path).path
+
+        if not path.startswith("/objects/"):
+            return None
+
+        return urllib.unquote(path[len("/objects/"):])
+
+    def _withKey(self, f):
+        key = self._key()
+
+        if key is None:
+            self._respond(404, "Not found.\n", "text/plain")
+            return
+
+        try:
+            f(key)
+        except ValueError, e:
+            self._respond(400, str(e) + "\n", "text/plain")
+
+    def _readBody(self):
+        return self.rfile.read(int(self.headers.getheader("content-length", 0)))
+
+    def do_HEAD(self):
+        def head(key):
+            size = self.server.store.probe(key)
+
+            if size is None:
+                self._respond(404, "", "text/plain")
+            else:
+                self._respond(200, length = size)
+
+        self._withKey(head)
+
+    def do_GET(self):
+        u = urlparse.urlparse(self.path)
+
+        if u.path == "/list":
+            prefix = urlparse.parse_qs(u.query).get("prefix", [""])[0]
+            self._respond(200, json.dumps(self.server.store.list(prefix)), "application/json")
+            return
+
+        def get(key):
+            try:
+                self._respond(200, self.server.store.get(key))
+            except KeyError:
+                self._respond(404, "Not found.\n", "text/plain")
+
+        self._withKey(get)
+
+    def do_PUT(self):
+        length = int(self.headers.getheader("content-length", 0))
+        keep_alive = not self.close_connection
+
+        # The body is left unread if the key is rejected, and then the
+        # connection can't be used again.
+        self.close_connection = True
+
+        def put(key):
+            self.server.store.putFile(key, self.rfile, length)
+            self.close_connection = not keep_alive
+            self._respond(204)
+
+        self._withKey(put)
+
+    def do_DELETE(self):
+        def delete(key):
+            if self.server.store.delete(key):
+                self._respond(204)
+            else:
+                self._respond(404, "Not found.\n", "text/plain")
+
+        self._withKey(delete)
+
+    def do_POST(self):
+        data = self._readBody()
+
+        if urlparse.urlparse(self.path).path != "/probe":
+            self._respond(404, "Not found.\n", "text/plain")
+            return
+
+        try:
+            sizes = self.server.store.probeMany(json.loads(data))
+        except ValueError, e:
+            self._respond(400, str(e) + "\n", "text/plain")
+            return
+
+        self._respond(200, json.dumps(sizes), "application/json")
+
+    def log_message(self, format, *args):
+        self.server.log.debug("%s - %s" % (self.address_string(), format % args))
+
+class CacheServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the store in `directory` at `address`, a (host, port)
+    pair; port 0 picks a free one.  Call serve_forever(), or start()
+    to serve on a background thread.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, address = ("127.0.0.1", 0)):
+        HTTPServer.__init__(self, address, _Handler)
+
+        self.store = LocalBackend(directory)
+        self.log = logging.getLogger("CacheServer")
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d/" % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target = self.serve_forever, name = "lazyrunner-cacheserver")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+if __name__ == "__main__":
+
+    parser = OptionParser(usage = "python -m lazyrunner.cacheserver [--host <host>] <directory> [port]")
+
+    parser.add_option("", "--host", dest = "host", default = "127.0.0.1",
+                      help = "The address to listen on; by default only the local host can "
+                      "connect.  Anyone who can connect can run code on the clients.")
+
+    options, args = parser.parse_args()
+
+    if len(args) not in [1, 2]:
+        parser.error("Expected the store directory and, optionally, the port.")
+
+    logging.basicConfig(level = logging.INFO)
+
+    server = CacheServer(args[0], (options.host, int(args[1]) if len(args) == 2 else 8010))
+    server.log.info("Serving %s at %s." % (args[0], server.url))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -58,10 +58,28 @@ __default_opttree.project_directory = (str, '.', "The root of the project direct
 __default_opttree.verbose = (is_boolean, False, "Print more detailed diagnostic and progress messages.")
 __default_opttree.no_cache = (is_boolean, False, "Disable the caching system.")
 __default_opttree.force = (is_boolean, False, "Overwrite existing files when creating new modules.")
-__default_opttree.cache_read_only = (is_boolean, False, "Only load things from cache; never save.")
+__default_opttree.cache_read_only = (is_boolean, False, "Only load things from cache; never save.  Results in the shared store given by cache_backend are still copied to the cache directory, but nothing is published to it.")
 __default_opttree.no_compile = (is_boolean, False, "Disable compiling things, even if source files are modified.")
 __default_opttree.config_file = (str, 'conf', "The configuration file to load options from.")
 __default_opttree.cache_directory = ([str, type(None)], None, "The cache directory to use; None disables caching.")
+__default_opttree.cache_graph_plans = (is_boolean, False, "Store what each request resolved to next to the cache, so a repeated request whose results are all cached loads them without rebuilding the graph.")
+__default_opttree.parallel_workers = (int, 1, "Number of modules to run at once; longer running branches, as estimated from earlier runs, are started first.")
+__default_opttree.prefetch_workers = (int, 0, "Number of threads loading cached results in the background ahead of when they are needed; 0 disables this.")
+__default_opttree.prefetch_memory_limit = (int, 512, "Limit on the results loaded in the background but not yet used, in MB of the cache files they were loaded from; as these are compressed, the results themselves can take several times as much memory.")
+__default_opttree.io_workers = (int, 8, "Number of modules setting the class attribute io_bound (ones mostly waiting on disk or other processes) to run at once, on threads of their own besides the parallel_workers ones; 0 runs them as any other module.")
+__default_opttree.parallel_processes = (is_boolean, False, "When running modules in parallel, run each module's run() in a forked worker process, passing large arrays in the results back through shared memory; modules can also set the class attribute run_in_process.")
+__default_opttree.shared_memory_directory = ([str, type(None)], None, "Directory for the arrays passed back from worker processes; None uses /dev/shm if present, else the temporary directory.")
+__default_opttree.shared_memory_threshold = (int, 65536, "Arrays of at least this many bytes in the results of worker processes are passed back through shared memory instead of pickled.")
+__default_opttree.async_workers = (int, 1, "Number of background threads running the requests made through getResultsAsync.  The requests queued when a thread is free are run together, computing the modules they share once; requests running at once on different threads share only what is in the cache.")
+__default_opttree.write_behind_workers = (int, 0, "Number of threads saving results to the cache in the background, so the next module can start right away; 0 saves them before continuing.")
+__default_opttree.write_behind_queue_size = (int, 4, "Maximum number of results waiting to be saved in the background before saving more blocks.")
+__default_opttree.cache_deduplication = (is_boolean, False, "Store identical cache files once, hard linked to a copy named by the hash of their contents.  Needs a file system with hard links; identical results are stored separately if it has none.")
+__default_opttree.cache_auto_prune = (is_boolean, False, "On initialization, remove the cache entries computed with earlier versions of the modules, as --cache-prune-stale does.")
+__default_opttree.cache_prune_archive = ([str, type(None)], None, "If set, cache entries pruned for earlier module versions are moved to this directory instead of deleted.")
+__default_opttree.trace_parameter_access = (is_boolean, False, "Trace the local parameters each module reads, and reuse cached results of earlier runs that read the same values; modules can also set the class attribute trace_parameters.")
+__default_opttree.cache_backend = (str, "", "URL of a cache store shared behind the local cache directory: http://host:port/ for a server run with 'python -m lazyrunner.cacheserver', or file:///path for a shared directory.  Empty for none.")
+__default_opttree.cache_backend_connections = (int, 4, "Maximum number of connections to the shared cache store at once.")
+__default_opttree.checkpoint_interval = ((int, float), 0, "Default minimum number of seconds between the checkpoints a module writes with checkpoint(); 0 writes every one.")
 __default_opttree.import_list = (list, [], "List of modules / directories to import in loading project.")
 __default_opttree.auto_import = (is_boolean, True, "Automatically import all subdirs with __init__.py files.")
 __default_opttree.cython.use_cpp = (is_boolean, False, "Compile cython extensions in C++ mode.")
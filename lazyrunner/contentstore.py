@@ -0,0 +1,145 @@
+"""
+Storing identical cache files once.  Different keys often give
+byte-identical results, e.g. from a module that ignores most of its
+parameters.  Each cache file written is hashed and hard linked to a
+file named by its content hash; if that already exists, the new file
+is replaced by another link to it.  The copies then share one file on
+disk, and one copy in the page cache.
+
+Reading is unaffected, as the cache files are still where they were.
+Every cache file is replaced by renaming a new one over it, never
+rewritten in place, so replacing one doesn't touch the others sharing
+its contents.
+"""
+
+import os, hashlib, errno, logging
+from os.path import join, exists, split, isdir, samefile
+from diskio import temporaryFilename
+
+class ContentStore(object):
+    """
+    The files in `directory`, one per distinct content, named by the
+    SHA-1 hash of their contents.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log = logging.getLogger("RunCTRL")
+
+        # Cleared if the file system doesn't support hard links
+        self.enabled = hasattr(os, "link")
+
+    def path(self, digest):
+        return join(self.directory, digest[:2], digest[2:])
+
+    def _hash(self, filename):
+        h = hashlib.sha1()
+        f = open(filename, 'rb')
+
+        try:
+            while True:
+                block = f.read(2**20)
+
+                if not block:
+                    break
+
+                h.update(block)
+        finally:
+            f.close()
+
+        return h.hexdigest()
+
+    def add(self, filename):
+        """
+        Links the cache file `filename` with the stored copy of its
+        contents, adding that if needed.  Returns True if the contents
+        were already stored.
+        """
+
+        if not self.enabled:
+            return False
+
+        try:
+            return self._add(filename)
+
+        except (OSError, IOError), e:
+            if e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                self.log.warning("Hard links not usable in the cache directory; "
+                                 "identical results will be stored separately.")
+                self.enabled = False
+            else:
+                self.log.debug("Could not deduplicate %s: %s" % (filename, str(e)))
+
+            return False
+
+    def _add(self, filename):
+
+        target = self.path(self._hash(filename))
+
+        for attempt in [0, 1]:
+            if exists(target):
+                if samefile(target, filename):
+                    return True
+
+                temp_filename = temporaryFilename(filename)
+
+                try:
+                    os.link(target, temp_filename)
+                except OSError, e:
+                    # Pruned in the mean time
+                    if e.errno == errno.ENOENT:
+                        continue
+
+                    raise
+
+                os.rename(temp_filename, filename)
+
+                self.log.debug("%s has the same contents as an earlier result; stored once." % filename)
+
+                return True
+
+            d = split(target)[0]
+
+            if not isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    if not isdir(d):
+                        raise
+
+            try:
+                os.link(filename, target)
+                return False
+            except OSError, e:
+                # Added by someone else in the mean time
+                if e.errno != errno.EEXIST:
+                    raise
+
+        return False
+
+    def prune(self):
+        """
+        Removes the stored contents no cache file links to any more.
+        Returns the number of bytes freed.
+        """
+
+        freed = 0
+
+        if not isdir(self.directory):
+            return freed
+
+        for d, dirs, files in os.walk(self.directory):
+            for f in files:
+                filename = join(d, f)
+
+                try:
+                    st = os.stat(filename)
+
+                    if st.st_nlink == 1:
+                        os.remove(filename)
+                        freed += st.st_size
+
+                except OSError:
+                    pass
+
+        return freed
@@ -1,19 +1,55 @@
 from cPickle import loads, dumps, PicklingError
 import h5py
-import os, os.path as osp
+import os, os.path as osp, threading, sys
 import cPickle
 from bz2 import BZ2File
 
 from treedict import TreeDict
 from numpy import ndarray, dtype
+from streams import ResultStream, isStreamFile
 
-def loadResults(opttree, filename):
+def temporaryFilename(filename):
+    """
+    Returns a name, unique to the calling thread, to write a cache
+    file under before renaming it to `filename`.  The rename replaces
+    the directory entry, so readers never see a partly written file
+    and files sharing the old contents are left alone.
+    """
+
+    return "%s.%d-%d.tmp" % (filename, os.getpid(), id(threading.currentThread()))
+
+def loadResults(opttree, filename, buffered = False):
     """
     Loads a given results file and returns the TreeDict instance
     containing them.
+
+    If `buffered` is True, a pickled file is read into memory in one
+    go before unpickling it.  This takes more memory, but holds the
+    interpreter lock far less, which matters when loading on a
+    background thread.
     """
 
     filename = osp.expanduser(filename)
+
+    try:
+        return _loadObject(opttree, filename, buffered)
+    except Exception:
+        exc_info = sys.exc_info()
+
+    # Streamed results are written the same way either way and never
+    # load as anything else, so they are only looked for once the
+    # file fails to load.
+    try:
+        is_stream = isStreamFile(filename)
+    except IOError:
+        is_stream = False
+
+    if is_stream:
+        return ResultStream.fromFile(filename)
+
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+def _loadObject(opttree, filename, buffered):
     
     if opttree.use_hdf5:
         try:
@@ -38,26 +74,27 @@ def loadResults(opttree, filename):
         def with_compression(fatal_on_error):
             try:
                 f = BZ2File(filename, 'r')
-                return cPickle.load(f)
+                return cPickle.loads(f.read()) if buffered else cPickle.load(f)
             except IOError:
                 if fatal_on_error:
                     raise
                 else:
-                    return without_comression(True)
+                    return without_compression(True)
 
         def without_compression(fatal_on_error):
             try:
-                return cPickle.load(open(filename, 'rb'))
+                f = open(filename, 'rb')
+                return cPickle.loads(f.read()) if buffered else cPickle.load(f)
             except IOError:
                 if fatal_on_error:
                     raise
                 else:
-                    return without_comression(True)
+                    return without_compression(True)
         
         if opttree.cache_compression:
             return with_compression(False)
         else:
-            return without_comression(False)
+            return without_compression(False)
         
             
 def saveResults(opttree, filename, obj):
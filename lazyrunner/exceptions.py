@@ -4,3 +4,12 @@ A set of exceptions relevent for specific error messages.
 
 class ConfigError(Exception): pass
 
+class BundleError(Exception): pass
+
+class CancelledError(Exception): pass
+
+class ResultTimeout(Exception): pass
+
+class ModuleCancelled(Exception): pass
+
+class ModuleTimeout(ModuleCancelled): pass
@@ -0,0 +1,185 @@
+"""
+A record of how long each module's run() took and how large its
+results were, per node key.  This is kept next to the cache (under
+__history__/) so later runs can estimate costs before computing
+anything.
+"""
+
+import os, logging, threading
+import cPickle
+from os.path import join, exists
+from collections import namedtuple
+
+RunRecord = namedtuple('RunRecord', ['run_time', 'size'])
+
+class RunHistory(object):
+    """
+    Holds the recorded run times and result sizes.  Records are loaded
+    per module on first use and written back by `save()`.  If
+    `directory` is None, the history is kept in memory only; if
+    `read_only` is True, it is read but never written back.  It may
+    be shared between threads.
+    """
+
+    def __init__(self, directory, read_only = False):
+        self.directory = directory
+        self.read_only = read_only
+        self.log = logging.getLogger("RunCTRL")
+
+        # module name -> {key : RunRecord}
+        self.records = {}
+
+        # module name -> set of keys recorded since the last save
+        self.modified = {}
+
+        # module name -> mean recorded run time, or None
+        self.mean_run_times = {}
+
+        self.lock = threading.RLock()
+
+    def _filename(self, name):
+        return join(self.directory, name + ".hist")
+
+    def _moduleRecords(self, name):
+        try:
+            return self.records[name]
+        except KeyError:
+            pass
+
+        records = self.records[name] = self._loadRecords(name)
+
+        return records
+
+    def _loadRecords(self, name):
+
+        records = {}
+
+        if self.directory is not None and exists(self._filename(name)):
+            try:
+                f = open(self._filename(name), 'rb')
+                try:
+                    records = cPickle.load(f)
+                finally:
+                    f.close()
+
+            except Exception, e:
+                self.log.warning("Error loading run history for '%s' (%s); ignoring."
+                                 % (name, str(e)))
+                records = {}
+
+        return records
+
+    def record(self, name, key, run_time = None, size = None):
+        """
+        Records the run time (in seconds) and/or the size (in bytes) of
+        the results of module `name` under node key `key`.  Values
+        given as None keep what was recorded before.
+        """
+
+        with self.lock:
+            records = self._moduleRecords(name)
+            old = records.get(key, RunRecord(None, None))
+
+            records[key] = RunRecord(
+                run_time = run_time if run_time is not None else old.run_time,
+                size = size if size is not None else old.size)
+
+            self.modified.setdefault(name, set()).add(key)
+            self.mean_run_times.pop(name, None)
+
+    def get(self, name, key):
+        """
+        Returns the RunRecord for module `name` under `key`, or None
+        if nothing has been recorded.
+        """
+
+        with self.lock:
+            return self._moduleRecords(name).get(key, None)
+
+    def meanRunTime(self, name):
+        """
+        Returns the mean of the run times recorded for module `name`
+        over all keys, or None if none have been recorded.
+        """
+
+        with self.lock:
+            try:
+                return self.mean_run_times[name]
+            except KeyError:
+                pass
+
+            times = [r.run_time for r in self._moduleRecords(name).itervalues()
+                     if r.run_time is not None]
+
+            mean = self.mean_run_times[name] = (sum(times) / len(times)) if times else None
+
+            return mean
+
+    def estimateRunTime(self, name, key):
+        """
+        Returns the run time recorded for module `name` under `key`,
+        or, for a key not seen before, the mean run time of the
+        module.  Returns None if nothing is known about the module.
+        """
+
+        record = self.get(name, key)
+
+        if record is not None and record.run_time is not None:
+            return record.run_time
+
+        return self.meanRunTime(name)
+
+    def save(self):
+        """
+        Writes the records of all modified modules back to disk.
+        """
+
+        with self.lock:
+            self._save()
+
+    def _save(self):
+
+        if self.directory is None or self.read_only:
+            self.modified.clear()
+            return
+
+        for name, keys in self.modified.iteritems():
+            filename = self._filename(name)
+            temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+
+            # Other processes may have written to the same history
+            # since it was loaded, so merge with what's there now.
+            records = self._loadRecords(name)
+            records.update( (k, self.records[name][k]) for k in keys)
+            self.records[name] = records
+            self.mean_run_times.pop(name, None)
+
+            try:
+                if not exists(self.directory):
+                    os.makedirs(self.directory)
+
+                f = open(temp_filename, 'wb')
+                try:
+                    cPickle.dump(records, f, protocol=-1)
+                finally:
+                    f.close()
+
+                os.rename(temp_filename, filename)
+
+            except Exception, e:
+                self.log.warning("Error saving run history for '%s' (%s)."
+                                 % (name, str(e)))
+
+        self.modified.clear()
+
+def historyFromOptions(opttree):
+    """
+    Returns the RunHistory kept in the cache directory given by
+    `opttree`, or an in-memory one if caching is disabled.
+    """
+
+    if opttree.cache_directory is None:
+        return RunHistory(None)
+    else:
+        return RunHistory(join(opttree.cache_directory, "__history__"),
+                          read_only = not opttree.disk_write_enabled)
@@ -2,11 +2,19 @@
 A class that manages a batch of sessions.  
 """
 
-import time, logging, sys
+import time, logging, sys, atexit
 from os import makedirs, remove
 from os.path import join, expanduser, exists, split, abspath, normpath
 from treedict import TreeDict
 from pnstructures import PNodeCommon, PNode
+from history import historyFromOptions
+from writebehind import WriteBehindQueue
+from cachebackends import backendFromOptions
+from contentstore import ContentStore
+from cacheindex import VersionIndex
+from bundles import writeBundle, readBundle
+from asyncresults import AsyncRunner
+from progress import ProgressTracker
 
 import parameters as parameter_module
 import pmodule
@@ -78,7 +86,19 @@ def manager():
 
 def reset():
     global __manager
+
+    if __manager is not None:
+        __manager.close()
+
     __manager = None
+
+def _closeAtExit():
+    global __manager
+
+    if __manager is not None:
+        __manager.close()
+
+atexit.register(_closeAtExit)
     
 class _RunManager(object):
     """
@@ -121,14 +141,44 @@ class _RunManager(object):
                 
         parameter_module.finalize()
         pmodule.finalize()
+
+        self.history = historyFromOptions(self.opttree)
+
+        if self.opttree.disk_write_enabled and self.opttree.write_behind_workers > 0:
+            self.writer = WriteBehindQueue(self.opttree, self.opttree.write_behind_workers,
+                                           self.opttree.write_behind_queue_size)
+        else:
+            self.writer = None
+
+        # The store shared behind the cache directory, if any
+        if self.opttree.disk_read_enabled or self.opttree.disk_write_enabled:
+            self.remote = backendFromOptions(self.opttree)
+        else:
+            self.remote = None
+
+        # Created when first needed; see getResultsAsync
+        self.async_runner = None
+
+        # See setProgressCallback
+        self.progress_callback = None
+        self.progress_interval = 0.5
+
+        if self.opttree.disk_write_enabled and self.opttree.cache_auto_prune:
+            self.pruneStaleCache()
         
     ########################################################################################
     # General Control Functions
     
-    def getResults(self, modules = None, presets = [], parameters = None):
+    def getResults(self, modules = None, presets = [], parameters = None, timeout = None):
+        """
+        Returns a dict mapping each of the module names in `modules`
+        (by default, the run queue) to its results under the given
+        presets, or under the parameter tree `parameters` if given.
+        If `timeout` is given, it replaces the time limit, in seconds,
+        of every module run (see `PModule.checkCancelled`); a module
+        running past it raises ModuleTimeout.
+        """
                 
-        common = PNodeCommon(self.opttree)
-        
         ptree = parameter_module.getParameterTree(presets, parameters = parameters)
         
         if modules is None:
@@ -137,9 +187,307 @@ class _RunManager(object):
         if type(modules) is str:        
             modules = [modules]
         
-        results = common.getResults(ptree, modules)
+        results = self._runRequest(ptree, modules, timeout = timeout)
         
         return dict(zip(modules, results)) 
+
+    def iterResults(self, modules = None, presets = [], parameters = None):
+        """
+        Like getResults, but yields (module name, parameters, results)
+        for each module as soon as its results are ready, in the order
+        they finish, while the rest are computed in the background.
+        `parameters` is the module's branch of the parameter tree.
+        The results aren't kept once yielded, so they can be dropped
+        right after they are used.  Closing the generator before the
+        end stops the modules still running (see
+        `PModule.checkCancelled`) and waits for them.
+        """
+
+        ptree = parameter_module.getParameterTree(presets, parameters = parameters)
+        
+        if modules is None:
+            modules = pmodule.getCurrentRunQueue()
+        
+        if type(modules) is str:        
+            modules = [modules]
+
+        common = self._newCommon()
+        results = common.iterResults(ptree, modules)
+
+        try:
+            for r in results:
+                yield r
+        finally:
+            # Stops the run if the caller stopped early
+            results.close()
+            self._finishRun(common)
+
+    def getResultsBatch(self, requests):
+        """
+        Runs several requests at once.  `requests` is a list of
+        (presets, modules) pairs, each as given to getResults; the
+        list of dicts mapping module names to results is returned, one
+        per request in the same order.  The graphs of all requests are
+        built together, so the modules they have in common are run or
+        loaded once, and their results are dropped as soon as the
+        last request using them has them.
+        """
+
+        trees = []
+
+        for presets, modules in requests:
+            if modules is None:
+                modules = pmodule.getCurrentRunQueue()
+
+            if type(modules) is str:
+                modules = [modules]
+
+            trees.append( (parameter_module.getParameterTree(presets), modules) )
+
+        common = self._newCommon()
+
+        try:
+            results = common.getResultsBatch(trees)
+        finally:
+            self._finishRun(common)
+
+        return [dict(zip(modules, r)) for (ptree, modules), r in zip(trees, results)]
+
+    def getResultsAsync(self, modules = None, presets = [], parameters = None):
+        """
+        Like getResults, but returns right away with a dict mapping
+        each module name to an `asyncresults.ResultFuture` holding its
+        results once computed on a background thread (see the
+        `async_workers` option).  A request for a module and parameter
+        tree already queued or running waits on that computation
+        rather than starting another.  Everything queued when a
+        background thread becomes free is run in one pass, computing
+        the nodes the requests share once, whatever their parameter
+        trees; requests running at the same time on different threads
+        share only what is already in the cache.  A future can be
+        cancelled until it's done; the modules running for it are
+        stopped once nothing else waits on them.
+        """
+
+        ptree = parameter_module.getParameterTree(presets, parameters = parameters)
+        
+        if modules is None:
+            modules = pmodule.getCurrentRunQueue()
+        
+        if type(modules) is str:        
+            modules = [modules]
+
+        if self.async_runner is None:
+            self.async_runner = AsyncRunner(self._runRequests, self.opttree.async_workers)
+
+        return self.async_runner.submit(ptree, modules)
+
+    def _runRequests(self, requests, cancel_event):
+        # Runs the (parameter tree, module names) pairs in `requests`
+        # in one graph, returning the list of results of each
+
+        if len(requests) == 1:
+            ptree, modules = requests[0]
+            return [self._runRequest(ptree, modules, cancel_event)]
+
+        common = self._newCommon()
+        common.cancelled = cancel_event
+
+        try:
+            return common.getResultsBatch(requests)
+        finally:
+            self._finishRun(common)
+
+    def _runRequest(self, ptree, modules, cancel_event = None, timeout = None):
+
+        common = self._newCommon()
+        common.timeout = timeout
+
+        if cancel_event is not None:
+            common.cancelled = cancel_event
+
+        try:
+            return common.getResults(ptree, modules, use_graph_plan = True)
+        finally:
+            self._finishRun(common)
+
+    def _newCommon(self):
+        # The environment for one run of the graph
+
+        common = PNodeCommon(self.opttree, self.history, self.writer, self.remote)
+
+        if self.progress_callback is not None:
+            common.progress = ProgressTracker(
+                self.progress_callback, self.history.estimateRunTime,
+                self.opttree.parallel_workers, self.progress_interval)
+
+        return common
+
+    def _finishRun(self, common):
+
+        if common.progress is not None:
+            common.progress.close()
+
+        self.history.save()
+
+    def setProgressCallback(self, callback, interval = 0.5):
+        """
+        Calls `callback(progress)` with a `progress.Progress` snapshot
+        during each later run (getResults, iterResults,
+        getResultsBatch or getResultsAsync), at most every `interval`
+        seconds and once at the end.  It gives the number of modules
+        planned, loaded, running and done, the bytes loaded, and the
+        time left as estimated from the run times recorded earlier.
+        `progress.ProgressBar()` draws a progress bar on the terminal.
+        Passing None turns the reports off again.
+        """
+
+        self.progress_callback = callback
+        self.progress_interval = interval
+
+    def plan(self, modules = None, presets = [], parameters = None):
+        """
+        Returns the plan for a call to getResults with the same
+        arguments, without running anything: a list of PlanEntry
+        instances giving, for each PNode needed, whether its results
+        would come from disk, from the shared cache store or be
+        computed, along with the stored size and the run time recorded
+        previously, if known.  Use `planning.formatPlan` to print it.
+        """
+
+        common = PNodeCommon(self.opttree, self.history, self.writer, self.remote)
+        
+        ptree = parameter_module.getParameterTree(presets, parameters = parameters)
+        
+        if modules is None:
+            modules = pmodule.getCurrentRunQueue()
+        
+        if type(modules) is str:        
+            modules = [modules]
+
+        return common.plan(ptree, modules)
+    
+    def exportCache(self, filename, modules = None, presets = [], parameters = None):
+        """
+        Writes the cache entries that a call to getResults with the
+        same arguments would load to the bundle `filename`, a tar
+        archive (compressed if the name ends in .gz or .bz2), so they
+        can be copied to another machine and imported there with
+        importCache.  Returns the list of entries written.
+        """
+
+        if not self.opttree.disk_read_enabled:
+            raise RuntimeError("Exporting the cache requires the cache to be enabled.")
+
+        common = PNodeCommon(self.opttree, self.history, self.writer, self.remote)
+        
+        ptree = parameter_module.getParameterTree(presets, parameters = parameters)
+        
+        if modules is None:
+            modules = pmodule.getCurrentRunQueue()
+
+        # Anything still being written has to be in place first
+        self.flush()
+
+        keys = common.cacheEntries(ptree, modules)
+        size = writeBundle(self.opttree.cache_directory, filename, keys)
+
+        self.log.info("Exported %d cache entries (%d bytes) to %s." % (len(keys), size, filename))
+
+        return keys
+
+    def importCache(self, filename, overwrite = False):
+        """
+        Unpacks a bundle written by exportCache into the cache
+        directory.  Each entry is checked against the hash recorded
+        in the bundle; a BundleError is raised on a corrupt or
+        malformed bundle.  Entries already in the cache are kept
+        unless `overwrite` is True.  Returns the list of entries
+        imported.
+        """
+
+        if not self.opttree.disk_write_enabled:
+            raise RuntimeError("Importing to the cache requires the cache to be writable.")
+
+        imported, skipped = readBundle(self.opttree.cache_directory, filename, overwrite)
+
+        if self.opttree.cache_deduplication:
+            content = ContentStore(join(self.opttree.cache_directory, "__content__"))
+
+            for key in imported:
+                content.add(join(self.opttree.cache_directory, *key.split("/")))
+
+        self.log.info("Imported %d cache entries from %s; %d already present."
+                      % (len(imported), filename, len(skipped)))
+
+        return imported
+    
+    def pruneStaleCache(self):
+        """
+        Removes the cache entries computed with a version of a module,
+        or of a module it depends on, other than the current one.
+        These are never loaded again, as changing a version changes
+        the keys.  Entries are moved to the `cache_prune_archive`
+        directory instead if that is set.  Only entries written since
+        versions were recorded are considered.  Returns the number of
+        entries and bytes removed.
+        """
+
+        if not self.opttree.disk_write_enabled:
+            raise RuntimeError("Pruning the cache requires the cache to be writable.")
+
+        cache_directory = self.opttree.cache_directory
+
+        current = dict( (name, str(pmodule.getPModuleClass(name)._getVersion()))
+                        for name in pmodule.getPModuleNames())
+
+        archive = self.opttree.cache_prune_archive
+
+        if archive is not None:
+            archive = abspath(expanduser(archive))
+
+        n, size = VersionIndex(join(cache_directory, "__versions__")).prune(
+            cache_directory, current, archive)
+
+        # Stored contents only the removed entries used
+        if archive is None:
+            ContentStore(join(cache_directory, "__content__")).prune()
+
+        if n != 0:
+            self.log.info("%s %d cache entries (%d bytes) from earlier module versions."
+                          % ("Archived" if archive is not None else "Removed", n, size))
+
+        return n, size
+    
+    def flush(self):
+        """
+        Waits until all results being saved to the cache in the
+        background are written.  Returns a list of (filename, error
+        message) pairs for those that could not be written.
+        """
+
+        if self.writer is None:
+            return []
+
+        return self.writer.flush()
+
+    def close(self):
+        """
+        Finishes saving results to the cache and stops the background
+        threads.  Called by `reset()` and on exit.
+        """
+
+        if self.async_runner is not None:
+            self.async_runner.close()
+            self.async_runner = None
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.remote is not None:
+            self.remote.close()
+            self.remote = None
     
     def getPresetHelp(self, width = None):
         return '\n'.join(parameters_module.getPresetHelpList(width = width))
@@ -1,5 +1,5 @@
 from presets import processPModule, preset, presetTree, allPresets, \
-     applyPreset, updatePresetCompletionCache, \
+     applyPreset, updatePresetCompletionCache, completePreset, \
      getPresetHelpList, validatePresets, getParameterTree,           \
      registerPreset, BadPreset, defaults, group, PCall
 
@@ -0,0 +1,210 @@
+"""
+An index of the preset names, for completing and correcting them
+quickly with many thousands of presets.  The names, and the
+``name:argument=`` forms for the keyword arguments of function
+presets, are kept in a sorted list; the completions of a prefix are
+then a contiguous run of it, found by bisection.  Suggestions for a
+misspelled name come from an index of the trigrams in each name: the
+names sharing the most trigrams with it are the candidates, ranked
+by edit distance.  Comparing against every name instead is far too
+slow in python with this many.
+
+The sorted completions are saved one per line, so tab completion can
+read them without loading the project; see `PresetIndex.save`.
+"""
+
+import os, heapq
+from bisect import bisect_left
+from os.path import exists
+
+def editDistance(a, b):
+    """
+    Returns the Levenshtein distance between the strings `a` and `b`.
+    """
+
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = range(len(b) + 1)
+
+    for i, ca in enumerate(a):
+        current = [i + 1]
+
+        for j, cb in enumerate(b):
+            current.append(min(previous[j + 1] + 1,
+                               current[j] + 1,
+                               previous[j] + (ca != cb)))
+
+        previous = current
+
+    return previous[-1]
+
+def _ngrams(word):
+    # The trigrams of the word, padded so the ends count as well
+
+    w = "^" + word + "$"
+    return set(w[i:i+3] for i in xrange(len(w) - 2))
+
+class PresetIndex(object):
+    """
+    The index of the presets added with `add`.
+    """
+
+    def __init__(self):
+        # Sorted names and argument completions
+        self.completions = []
+
+        # The names, and for each trigram the indices of the names
+        # containing it; see closest.  None until needed for an index
+        # loaded from a file.
+        self.name_list = []
+        self.ngram_index = {}
+
+    def add(self, name, arguments = []):
+        """
+        Adds the preset `name`, taking the keyword `arguments`.
+        """
+
+        for c in [name] + ["%s:%s=" % (name, a) for a in arguments]:
+            i = bisect_left(self.completions, c)
+
+            if i < len(self.completions) and self.completions[i] == c:
+                continue
+
+            self.completions.insert(i, c)
+
+            if ":" not in c and self.name_list is not None:
+                self._indexName(c)
+
+    def names(self):
+        """
+        Returns the sorted list of preset names.
+        """
+
+        return [c for c in self.completions if ":" not in c]
+
+    def complete(self, prefix, limit = None):
+        """
+        Returns the sorted names and argument completions starting
+        with `prefix`, at most `limit` of them if given.
+        """
+
+        prefix = prefix.lower()
+
+        ret = []
+        i = bisect_left(self.completions, prefix)
+
+        while i < len(self.completions) and self.completions[i].startswith(prefix):
+            if limit is not None and len(ret) == limit:
+                break
+
+            ret.append(self.completions[i])
+            i += 1
+
+        return ret
+
+    def _indexName(self, name):
+
+        i = len(self.name_list)
+        self.name_list.append(name)
+
+        for g in _ngrams(name):
+            self.ngram_index.setdefault(g, []).append(i)
+
+    def closest(self, name, n = 5):
+        """
+        Returns up to `n` preset names closest to `name` in edit
+        distance, closest first, among those sharing the most
+        trigrams with it.
+        """
+
+        if self.name_list is None:
+            self.name_list = []
+
+            for c in self.names():
+                self._indexName(c)
+
+        name = name.lower()
+
+        postings = sorted( (self.ngram_index[g] for g in _ngrams(name) if g in self.ngram_index),
+                           key = len)
+
+        if not postings:
+            return []
+
+        # Trigrams common to a large part of the names, like those of
+        # a shared module prefix, say little; skip them unless there's
+        # nothing else.
+        limit = max(100, len(self.name_list) // 10)
+        postings = [p for p in postings if len(p) <= limit] or postings[:1]
+
+        counts = {}
+
+        for p in postings:
+            for i in p:
+                counts[i] = counts.get(i, 0) + 1
+
+        candidates = heapq.nlargest(20 * n, counts.iteritems(), key = lambda t: t[1])
+
+        ranked = sorted( (editDistance(name, self.name_list[i]), self.name_list[i])
+                         for i, c in candidates)
+
+        return [w for d, w in ranked[:n]]
+
+    def save(self, filename):
+        """
+        Writes the sorted completions to `filename`, one per line,
+        unless it already holds them.
+        """
+
+        data = "".join(c + "\n" for c in self.completions)
+
+        if exists(filename):
+            f = open(filename, 'r')
+
+            try:
+                if f.read() == data:
+                    return
+            finally:
+                f.close()
+
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+
+        f = open(temp_filename, 'w')
+
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        os.rename(temp_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Returns the index saved to `filename`; it is empty if the file
+        doesn't exist.
+        """
+
+        index = cls()
+
+        if not exists(filename):
+            return index
+
+        f = open(filename, 'r')
+
+        try:
+            completions = [l.strip() for l in f]
+        finally:
+            f.close()
+
+        completions = sorted(set(c for c in completions if c))
+
+        # Files written by earlier versions are space separated
+        if len(completions) == 1 and " " in completions[0]:
+            completions = sorted(set(completions[0].split()))
+
+        index.completions = completions
+        index.name_list = None
+
+        return index
@@ -3,8 +3,8 @@ The central place for handling parameters.
 """
 
 from treedict import TreeDict
-from collections import namedtuple
-import sys, textwrap
+from collections import namedtuple, OrderedDict
+import sys, textwrap, threading
 import re
 import warnings
 import os, struct
@@ -12,6 +12,7 @@ import inspect
 from os.path import commonprefix
 from common import cleanedPreset, checkNameValidity, combineNames
 from parameters import getDefaultTree, modifyPModuleBranchDefault, modifyGlobalDefaultTree
+from presetindex import PresetIndex
 import random
 from copy import copy
 
@@ -22,9 +23,23 @@ __preset_staging = None
 __preset_staging_visited = None
 __preset_lookup = None
 __preset_description_lookup = None
-__preset_tree = None
+__preset_index = None
 __preset_unique_prefix = 'PRESET_' + ('%06x' % random.randrange(256**3)) + "_"
 
+# Memoized parsePreset results for preset strings, and the trees
+# getParameterTree has produced, by (base tree hash, preset keys),
+# least recently used first.  Both are cleared whenever the registered
+# presets change.
+__parsed_preset_cache = {}
+__parameter_tree_cache = OrderedDict()
+
+# Bound on the number of parameter trees held in the cache
+_parameter_tree_cache_size = 256
+
+# Guards the parameter tree cache, as graphs may be built on several
+# threads
+__parameter_tree_cache_lock = threading.Lock()
+
 ################################################################################
 # Stuff for keeping track of the parameter tree
 
@@ -165,13 +180,16 @@ def resetAndInitPresets():
     global __preset_staging_visited
     global __preset_lookup
     global __preset_description_lookup
-    global __preset_tree
+    global __preset_index
 
     __preset_staging = {}
     __preset_staging_visited = set()
     __preset_lookup = {}
     __preset_description_lookup = TreeDict('preset_descriptions')
-    __preset_tree = None
+    __preset_index = PresetIndex()
+
+    __parsed_preset_cache.clear()
+    __parameter_tree_cache.clear()
 
 def registerPreset(name, preset, branch = None, description = None,
                    apply = [], ignore_context = False):
@@ -242,6 +260,19 @@ def registerPreset(name, preset, branch = None, description = None,
             name, branch, preset, description, apply)
 
 
+def _presetArguments(pw):
+    # The names of the arguments a function preset takes after the tree
+
+    if type(pw.action) is TreeDict:
+        return []
+
+    try:
+        args = inspect.getargspec(pw.action)[0]
+    except TypeError:
+        return []
+
+    return [a for a in args[1:] if type(a) is str]
+
 def finalizePresetLookup():
 
     lookup = {}
@@ -272,6 +303,12 @@ def finalizePresetLookup():
     assert __preset_lookup == {}
     __preset_lookup.update(lookup)
 
+    for k, pw in lookup.iteritems():
+        __preset_index.add(__cleanPresetTreeName(k), _presetArguments(pw))
+
+    __parsed_preset_cache.clear()
+    __parameter_tree_cache.clear()
+
 
 def registerPrefixDescription(prefix, description, ignore_context = False):
     """
@@ -957,7 +994,7 @@ class PCall(object):
         return PCall(combineNames(self._preset_name_, attr))
         
     def __treedict_hash__(self):
-        p = getParameterTree([self], TreeDict())
+        p = _cachedParameterTree([self], TreeDict())
         return p.hash()
             
         
@@ -976,31 +1013,37 @@ class PDeltaTree(object):
 
 def updatePresetCompletionCache(filename):
     """
-    Saves a list of the current presets to a temporary file.  This is
-    to speed up tab completion for preset names.
+    Saves the sorted names of the current presets, and the argument
+    forms ``name:argument=`` of those taking keyword arguments, to
+    `filename`, one per line.  This is to speed up tab completion
+    for preset names; see `completePreset`.  The file is only
+    rewritten if the presets changed.
+    """
+
+    __preset_index.save(filename)
 
+def completePreset(prefix, filename = None):
+    """
+    Returns the sorted preset names and argument forms starting with
+    `prefix`, from the current presets or, if `filename` is given,
+    from the list saved there by `updatePresetCompletionCache`.
     """
 
-    f = open(filename, 'w')
-    f.write(" ".join(allPresets()))
-    f.close()
+    if filename is not None:
+        return PresetIndex.load(filename).complete(prefix)
+    else:
+        return __preset_index.complete(prefix)
     
 ################################################################################
 # Now methods for gracefully handling errors
 
 def getPresetCorrectionMessage(preset, n_close = 5, width = 80):
-    global __preset_tree
 
-    if __preset_tree is None:
-        __preset_tree = TreeDict.fromdict(__preset_lookup)
-                                          
     preset = preset.lower()
 
-    startwith_list = [__cleanPresetTreeName(k)
-                      for k in __preset_tree.iterkeys() if k.startswith(preset)]
+    startwith_list = [n for n in __preset_index.complete(preset) if ":" not in n]
 
-    closest = [__cleanPresetTreeName(nc)
-               for nc in __preset_tree.getClosestKey(__presetTreeName(preset), n_close)]
+    closest = __preset_index.closest(preset, n_close)
 
     for k in (set(closest) & set(startwith_list)):
         closest.pop(closest.index(k))
@@ -1040,6 +1083,23 @@ PresetInfo = namedtuple('PresetInfo',
                         ['name', 'preset', 'list_args', 'kw_args'])
 
 def parsePreset(preset):
+
+    if type(preset) is str:
+        # Held with the arguments as tuples, so a caller changing the
+        # ones it's given doesn't change those of later calls
+        try:
+            pi = __parsed_preset_cache[preset]
+        except KeyError:
+            pi = _parsePreset(preset)
+            pi = __parsed_preset_cache[preset] = pi._replace(
+                list_args = tuple(pi.list_args),
+                kw_args = tuple(sorted(pi.kw_args.iteritems())))
+
+        return pi._replace(list_args = list(pi.list_args), kw_args = dict(pi.kw_args))
+
+    return _parsePreset(preset)
+
+def _parsePreset(preset):
     
     if type(preset) is str:
             
@@ -1140,10 +1200,38 @@ def parsePreset(preset):
         list_args = list_args,
         kw_args = kw_args)
 
+def _presetKey(pi):
+    # Identifies what applying the parsed preset `pi` does
+
+    if isinstance(pi.preset, PDeltaTree):
+        return ("__tree__", pi.preset.tree.hash())
+    else:
+        return (pi.name, tuple(pi.list_args), tuple(sorted(pi.kw_args.iteritems())))
+
 def getParameterTree(presets, parameters = None):
     """
-    Returns the parameter tree 
+    Returns the frozen parameter tree given by applying `presets` in
+    order to `parameters`, which is modified, frozen and returned, or
+    to the default tree if None.  The trees produced from the default
+    tree are cached by the presets applied, so a repeated request
+    returns the tree from the earlier one.  Presets are assumed to
+    depend on nothing but the tree and their arguments.
     """
+
+    if parameters is None:
+        return _applyPresets(presets, getDefaultTree(), True)
+    else:
+        assert type(parameters) is TreeDict
+        return _applyPresets(presets, parameters, False)
+
+def _cachedParameterTree(presets, parameters):
+    # As getParameterTree, for callers that only use the tree returned:
+    # it may be one cached by an earlier call, with `parameters` then
+    # left as it was.
+
+    return _applyPresets(presets, parameters, True)
+
+def _applyPresets(presets, parameters, use_cache):
     
     try:
         preset_list = [parsePreset(n) for n in presets]
@@ -1152,11 +1240,23 @@ def getParameterTree(presets, parameters = None):
         raise BadPreset('\n'.join( (("\n Preset '%s' not found; did you mean:\n " % pname)
                                     + ('\n'.join(msg)) )
                         for (pname, msg) in msgs))
-    
-    if parameters is None:
-        parameters = getDefaultTree()
-    else:
-        assert type(parameters) is TreeDict
+
+    key = None
+
+    if use_cache:
+        try:
+            key = (parameters.hash(), tuple(_presetKey(pt) for pt in preset_list))
+            hash(key)
+        except TypeError:
+            # Arguments that can't be hashed
+            key = None
+
+    if key is not None:
+        with __parameter_tree_cache_lock:
+            if key in __parameter_tree_cache:
+                # Moves it to the most recently used end
+                ret = __parameter_tree_cache[key] = __parameter_tree_cache.pop(key)
+                return ret
     
     for pt in preset_list:
         pt.preset(parameters, pt.list_args, pt.kw_args)
@@ -1164,6 +1264,13 @@ def getParameterTree(presets, parameters = None):
     parameters.attach(recursive = True)
     parameters.freeze()
 
+    if key is not None:
+        with __parameter_tree_cache_lock:
+            __parameter_tree_cache[key] = parameters
+
+            if len(__parameter_tree_cache) > _parameter_tree_cache_size:
+                __parameter_tree_cache.popitem(last = False)
+
     return parameters
             
 def parsePresetStrings(ps_list):
@@ -1,4 +1,4 @@
-from presets import getParameterTree
+from presets import _cachedParameterTree
 
 ################################################################################
 
@@ -81,7 +81,7 @@ class Delta(object):
             pt[self.name].update(self.local_delta, protect_structure=False)
 
         if self.apply_preset is not None:
-            pt = getParameterTree(self.apply_preset, pt)
+            pt = _cachedParameterTree(self.apply_preset, pt)
 
         return pt
 
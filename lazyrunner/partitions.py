@@ -0,0 +1,72 @@
+"""
+Partitioned results.  A module declaring `partitions` produces its
+results shard by shard through `runPartition(index)`; each shard is
+cached on its own, under a key built from the shard index and the
+matching shards of its partitioned inputs, so a change touching one
+shard only causes that shard to be recomputed downstream.
+"""
+
+import hashlib, base64
+from treedict import TreeDict
+
+def itemHash(item):
+    # The same hashing as used for the keys given to the cache methods
+    return TreeDict(key = item).hash()
+
+def shardKey(name, version, index, local_item, input_keys):
+    """
+    Returns the cache key of shard `index` of module `name`.
+    `local_item` identifies what the shard depends on in the module's
+    own parameters, and `input_keys` is a sorted list of the keys of
+    whatever the shard depends on upstream.
+    """
+
+    h = hashlib.md5()
+    h.update(name)
+    h.update(str(version))
+    h.update(str(index))
+    h.update(local_item)
+
+    for k in input_keys:
+        h.update(k)
+
+    return base64.b64encode(h.digest(), "az")[:12]
+
+class PartitionedResults(object):
+    """
+    The results of a partitioned module, a sequence of shards.  Shards
+    that were saved to the cache are loaded from it each time they are
+    accessed; the rest are held in memory.  `keys` gives the cache key
+    of each shard.
+    """
+
+    def __init__(self, keys, shards, loader):
+        self.keys = list(keys)
+        self._shards = shards
+        self._loader = loader
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.keys)
+
+        if not 0 <= index < len(self.keys):
+            raise IndexError("Shard index %d out of range." % index)
+
+        try:
+            return self._shards[index]
+        except KeyError:
+            return self._loader(index)
+
+    def __iter__(self):
+        for i in xrange(len(self.keys)):
+            yield self[i]
+
+    def __reduce__(self):
+        # Stored as a plain list of the shards
+        return (list, (list(self),))
+
+    def __repr__(self):
+        return "<PartitionedResults: %d shard(s)>" % len(self.keys)
@@ -0,0 +1,247 @@
+"""
+Graph plans -- a record of what a request resolved to: the cache keys
+of the requested modules and the versions of every module in the
+graph below them.  Plans are persisted next to the cache, keyed by
+the root parameter hash and the requested modules, so a repeated
+request can go straight to the cache without rebuilding the graph.
+"""
+
+import hashlib, base64, logging, os
+import cPickle
+from os.path import join, exists, split
+from collections import namedtuple
+from pmodule import isPModule, getPModuleClass
+
+################################################################################
+# The plan structures
+
+PlanNode = namedtuple('PlanNode',
+                      ['name', 'key', 'local_key', 'dependency_key',
+                       'is_result_disk_writable'])
+
+# One line of a dry run; see PNodeCommon.plan.  `status` is one of
+# "disk", "remote" (the shared cache store) or "compute"; `size`
+# (bytes) and `estimated_time` (seconds) are None when unknown.
+# `repeated` marks a node already listed earlier in the plan.
+PlanEntry = namedtuple('PlanEntry',
+                       ['depth', 'name', 'key', 'status', 'module_needed',
+                        'size', 'estimated_time', 'repeated'])
+
+class GraphPlan(object):
+    """
+    The PNode graph for a set of requested modules.  `roots` is a list
+    of (name, key) pairs in request order, `nodes` maps the keys of
+    the roots to `PlanNode` instances, and `versions` maps each module
+    in the graph to its version when the plan was built.
+    """
+
+    def __init__(self, roots, nodes, versions):
+        self.roots = roots
+        self.nodes = nodes
+        self.versions = versions
+
+    def isCurrent(self):
+        """
+        Returns True if all the modules in the plan are still
+        registered under the versions the plan was built with.
+        """
+
+        for name, version in self.versions.iteritems():
+            if not isPModule(name) or getPModuleClass(name)._getVersion() != version:
+                return False
+
+        return True
+
+def buildGraphPlan(pn_list):
+    """
+    Builds a GraphPlan from a list of initialized and registered root
+    PNodes.  This must be called before any results are pulled, as
+    pulling releases the dependency structure.
+    """
+
+    nodes = {}
+
+    for pn in pn_list:
+        nodes[pn.key] = PlanNode(
+            name = pn.name,
+            key = pn.key,
+            local_key = pn.local_key,
+            dependency_key = pn.dependency_key,
+            is_result_disk_writable = pn.is_result_disk_writable)
+
+    # Only the versions are needed from the rest of the graph
+    versions = {}
+    seen = set()
+    stack = list(pn_list)
+
+    while stack:
+        pn = stack.pop()
+
+        if pn.key in seen:
+            continue
+
+        seen.add(pn.key)
+        versions[pn.name] = pn.p_class._getVersion()
+
+        stack.extend(cpn for (ln, cpn) in pn.result_dependencies.itervalues())
+
+    return GraphPlan([(pn.name, pn.key) for pn in pn_list], nodes, versions)
+
+################################################################################
+# Persisting the plans
+
+def graphPlanKey(parameters, names):
+    """
+    Returns the key under which the plan for requesting `names` with
+    the parameter tree `parameters` is stored.
+    """
+
+    h = hashlib.md5()
+    h.update(parameters.hash())
+
+    for n in names:
+        h.update(n)
+
+    return base64.b64encode(h.digest(), "az")[:16]
+
+def _graphPlanFilename(cache_directory, key):
+    return join(cache_directory, "__plans__", key + ".plan")
+
+def loadGraphPlan(cache_directory, key):
+    """
+    Returns the stored plan under `key`, or None if there isn't one
+    or it can't be read.
+    """
+
+    filename = _graphPlanFilename(cache_directory, key)
+
+    if not exists(filename):
+        return None
+
+    try:
+        f = open(filename, 'rb')
+        try:
+            plan = cPickle.load(f)
+        finally:
+            f.close()
+
+    except Exception, e:
+        logging.getLogger("RunCTRL").warning(
+            "Error loading graph plan %s (%s); ignoring." % (filename, str(e)))
+        return None
+
+    return plan if isinstance(plan, GraphPlan) else None
+
+def saveGraphPlan(cache_directory, key, plan):
+
+    filename = _graphPlanFilename(cache_directory, key)
+    d = split(filename)[0]
+
+    try:
+        if not exists(d):
+            os.makedirs(d)
+
+        # Write to a temporary file first so a plan is never seen
+        # half written.
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+
+        f = open(temp_filename, 'wb')
+        try:
+            cPickle.dump(plan, f, protocol=-1)
+        finally:
+            f.close()
+
+        os.rename(temp_filename, filename)
+
+    except Exception, e:
+        logging.getLogger("RunCTRL").warning(
+            "Error saving graph plan %s (%s)." % (filename, str(e)))
+
+################################################################################
+# Printing dry runs
+
+def formatSize(size):
+    """
+    Returns the number of bytes `size` as a short string in B, KB, MB
+    or GB, or "?" if it is None.
+    """
+
+    if size is None:
+        return "?"
+
+    for unit in ["B", "KB", "MB", "GB"]:
+        if size < 1024 or unit == "GB":
+            return ("%d %s" % (size, unit)) if unit == "B" else ("%.1f %s" % (size, unit))
+
+        size /= 1024.0
+
+def formatTime(t):
+    """
+    Returns the number of seconds `t` as a short string in seconds,
+    minutes or hours, or "?" if it is None.
+    """
+
+    if t is None:
+        return "?"
+    elif t < 60:
+        return "%.1fs" % t
+    elif t < 3600:
+        return "%.1fm" % (t / 60.0)
+    else:
+        return "%.1fh" % (t / 3600.0)
+
+def formatPlan(entries):
+    """
+    Returns a list of lines showing the plan given by the list of
+    PlanEntry instances `entries` as a tree, followed by a summary.
+    """
+
+    rows = []
+
+    for e in entries:
+        label = "  " * e.depth + e.name + " [" + e.key + "]"
+
+        if e.repeated:
+            rows.append( (label, "(above)", "", "") )
+            continue
+
+        status = e.status + (" + setup" if e.module_needed else "")
+
+        rows.append( (label, status,
+                      formatSize(e.size) if e.status in ("disk", "remote") or e.size is not None else "",
+                      formatTime(e.estimated_time) if e.status == "compute" else "") )
+
+    header = ("Module", "Source", "Size", "Est. time")
+    widths = [max(len(r[i]) for r in rows + [header]) for i in xrange(4)]
+
+    def line(r):
+        return "  ".join(c.ljust(w) for c, w in zip(r, widths)).rstrip()
+
+    lines = [line(header), "-" * len(line(header))] + [line(r) for r in rows]
+
+    ##############################
+    # The summary
+
+    unique = [e for e in entries if not e.repeated]
+
+    def count(status):
+        return len([e for e in unique if e.status == status])
+
+    load_bytes = sum(e.size for e in unique if e.status == "disk" and e.size is not None)
+    compute = [e for e in unique if e.status == "compute"]
+    known_time = sum(e.estimated_time for e in compute if e.estimated_time is not None)
+    n_unknown = len([e for e in compute if e.estimated_time is None])
+
+    lines.append("")
+    if count("remote"):
+        fetch_bytes = sum(e.size for e in unique if e.status == "remote" and e.size is not None)
+        remote = ", %d from the shared cache (%s)" % (count("remote"), formatSize(fetch_bytes))
+    else:
+        remote = ""
+
+    lines.append("%d from disk (%s)%s, %d to compute (%s%s)."
+                 % (count("disk"), formatSize(load_bytes), remote,
+                    len(compute), formatTime(known_time),
+                    (" + %d unknown" % n_unknown) if n_unknown else ""))
+
+    return lines
@@ -1,4 +1,4 @@
 from pmodulebase import PModule
 from lookup import resetAndInitialize, addToRunQueue, finalize, getPModuleClass, \
-     getCurrentRunQueue, pmodule, isPModule
+     getCurrentRunQueue, pmodule, isPModule, getPModuleNames
 
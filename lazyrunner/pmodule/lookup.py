@@ -71,6 +71,8 @@ def pmodule(c):
         
     c.log = logging.getLogger(c._name)
 
+    c._resolveHooks()
+
     parameters.processPModule(c)
 
     parameters.registerPreset("r." + name, PModulePreset(name),
@@ -90,6 +92,14 @@ def getPModuleClass(name):
     except KeyError:
         raise NameError("Module '%s' not found." % name)
 
+def getPModuleNames():
+    """
+    Returns a sorted list of the names of the registered modules.
+    """
+    
+    global _pmodule_lookup
+    return sorted(_pmodule_lookup.iterkeys())
+
 def isPModule(name):
     global _pmodule_lookup
     return name in _pmodule_lookup
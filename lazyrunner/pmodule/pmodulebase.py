@@ -1,8 +1,77 @@
 from copy import deepcopy, copy
+from collections import OrderedDict
 import logging
+import threading
 from treedict import TreeDict
 import re
 from axisproxy import AxisProxy
+import inspect
+
+################################################################################
+# Resolving the signatures of the parameter dependent hooks
+
+_parameter_hooks = ["preprocessParameters",
+                    "module_dependencies",
+                    "result_dependencies",
+                    "parameter_dependencies",
+                    "disable_caching",
+                    "disable_results_caching",
+                    "disable_result_caching",
+                    "partitions",
+                    "partition_keys"]
+
+_constant = "constant"
+_unresolved = "unresolved"
+
+# Bound on the number of memoized hook results held per class; the
+# least recently used are dropped first
+_hook_memo_size = 2**16
+
+# Guards the memo tables, as graphs may be built on several threads
+_hook_memo_lock = threading.Lock()
+
+_hook_signature_error = (
+    "%s() for %s must be a string, list, tuple, set or "
+    "take either no parameters, the local parameter "
+    "tree, or the local and global parameter trees.")
+
+def _resolveHookSignature(cls, attr):
+    """
+    Returns the number of arguments (0, 1 or 2) that the hook `attr`
+    of `cls` takes, `_constant` if it is a value rather than a
+    callable, or `_unresolved` if it can't be introspected.
+    """
+
+    x = getattr(cls, attr)
+
+    if not callable(x):
+        return _constant
+
+    f = x
+
+    if inspect.ismethod(f):
+        if f.im_self is None:
+            raise TypeError(("%s in %s must be a @classmethod, a @staticmethod "
+                             "or a value.") % (attr, cls._name))
+        f = f.im_func
+        n_bound = 1
+
+    elif inspect.isfunction(f):
+        n_bound = 0
+
+    else:
+        return _unresolved
+
+    args, varargs, keywords, defaults = inspect.getargspec(f)
+
+    n_max = len(args) - n_bound
+    n_min = n_max - (len(defaults) if defaults else 0)
+
+    for n in [0, 1, 2]:
+        if n >= n_min and (n <= n_max or varargs is not None):
+            return n
+
+    raise TypeError(_hook_signature_error % (attr, cls._name))
     
 class PModule:
     """
@@ -29,22 +98,109 @@ class PModule:
         return local_parameters
 
     @classmethod
-    def _preprocessParameters(cls, parameters):
+    def _resolveHooks(cls):
+        """
+        Works out, once at registration time, how each of the
+        parameter dependent hooks (preprocessParameters, the
+        dependency specifications and the caching switches) is to be
+        called, and resets the table memoizing their results.  A
+        module setting `vectorize_over` without a runBatch() is
+        rejected here with a TypeError.
+        """
+
+        cls._hook_signatures = {}
+        cls._hook_memo = OrderedDict()
+
+        for attr in _parameter_hooks:
+            if hasattr(cls, attr):
+                cls._hook_signatures[attr] = _resolveHookSignature(cls, attr)
+
+        # The default preprocessParameters is the identity
+        if getattr(cls.preprocessParameters, "im_func", None) is PModule.preprocessParameters.im_func:
+            cls._hook_signatures["preprocessParameters"] = None
+
+        cls._getVectorizeOver()
+
+    @classmethod
+    def _getHookSignatures(cls):
+        if "_hook_signatures" not in cls.__dict__:
+            cls._resolveHooks()
+
+        return cls._hook_signatures
+
+    @classmethod
+    def _callHook(cls, attr, parameters, freeze_full = False):
+        """
+        Calls the hook `attr` with the argument list its signature
+        asks for, memoizing the result per class, version and hash of
+        the parameters it can actually see.
+        """
+
+        x = getattr(cls, attr)
+        n_args = cls._getHookSignatures().get(attr, _unresolved)
+
+        if n_args is _constant:
+            return x
 
         pb = parameters[cls._name]
 
-        for t in [[], [pb], [pb,parameters.copy(freeze=True)]]:
-            try:
-                p = cls.preprocessParameters(*t)
-                break
-            except TypeError, te:
+        if n_args is _unresolved:
+            # Not introspectable; fall back to trying each signature.
+            for t in [[], [pb], [pb, parameters]]:
+                try:
+                    return x(*t)
+                except TypeError, te:
+                    if attr in str(te):
+                        continue
+                    else:
+                        raise
 
-                if "preprocessParameters" in str(te):
-                    continue
-                else:
-                    raise
+            raise TypeError(_hook_signature_error % (attr, cls._name))
+
+        if n_args == 0:
+            key = (attr, cls._getVersion())
+        elif n_args == 1:
+            key = (attr, cls._getVersion(), parameters.hash(cls._name))
+        else:
+            key = (attr, cls._getVersion(), parameters.hash())
+
+        memo = cls._hook_memo
+
+        with _hook_memo_lock:
+            if key in memo:
+                # Moves it to the most recently used end
+                ret = memo[key] = memo.pop(key)
+                return ret
+
+        if n_args == 0:
+            ret = x()
+        elif n_args == 1:
+            ret = x(pb)
+        else:
+            ret = x(pb, parameters.copy(freeze=True) if freeze_full else parameters)
 
-        return p if p is not None else parameters[cls._name]
+        # A hook returning None may have modified the tree in place,
+        # which can't be replayed from the memo table.
+        if ret is not None:
+            with _hook_memo_lock:
+                memo[key] = ret
+
+                if len(memo) > _hook_memo_size:
+                    memo.popitem(last = False)
+
+        return ret
+
+    @classmethod
+    def _preprocessParameters(cls, parameters):
+
+        if cls._getHookSignatures().get("preprocessParameters", _unresolved) is None:
+            return parameters[cls._name]
+
+        p = cls._callHook("preprocessParameters", parameters, freeze_full = True)
+
+        # The memoized tree may be handed out more than once, so each
+        # caller gets its own copy.
+        return p.copy() if p is not None else parameters[cls._name]
 
     @classmethod
     def _getDependencies(cls, parameters):
@@ -80,37 +236,7 @@ class PModule:
                 return [se for se in s if se != ""]
 
             if hasattr(cls, dep_attr):
-                dependency_function = getattr(cls, dep_attr)
-
-                if type(dependency_function) in [list, tuple, set, str]:
-                    return process_dependency(dependency_function)
-
-                null_ = "_null_"
-
-                deps = null_
-                
-                pb = parameters[cls._name]
-                
-                for t in [[], [pb], [pb,parameters]]:
-                    try:
-                        deps = dependency_function(*t)
-                        break
-                    except TypeError, te:
-
-                        if dep_attr in str(te):
-                            continue
-                        else:
-                            raise
-
-                if deps is null_:
-                    raise TypeError(("%s() for %s must be a string, list, tuple, set or "
-                                     "take either no parameters, the local parameter "
-                                     "tree, or the local and global parameter trees.")
-                                    % (dep_attr, cls._name))
-
-                
-                return process_dependency(deps)   
-
+                return process_dependency(cls._callHook(dep_attr, parameters))
             else:
                 return []
 
@@ -133,6 +259,67 @@ class PModule:
         else:
             return None
 
+    @classmethod
+    def _getPartitions(cls, parameters):
+        """
+        Returns the number of shards the results are split into, or
+        None if the module isn't partitioned.
+        """
+
+        if not hasattr(cls, "partitions"):
+            return None
+
+        n = cls._callHook("partitions", parameters)
+
+        if type(n) not in [int, long] or n < 0:
+            raise TypeError("'partitions' for %s must be or return a non-negative integer."
+                            % cls._name)
+
+        return n
+
+    @classmethod
+    def _getPartitionKeys(cls, parameters, n):
+        """
+        Returns the list of per-shard items given by `partition_keys`,
+        or None if the module doesn't give them.
+        """
+
+        if not hasattr(cls, "partition_keys"):
+            return None
+
+        keys = list(cls._callHook("partition_keys", parameters))
+
+        if len(keys) != n:
+            raise ValueError("'partition_keys' for %s gives %d keys for %d partitions."
+                             % (cls._name, len(keys), n))
+
+        return keys
+
+    @classmethod
+    def _getVectorizeOver(cls):
+        """
+        Returns the list of local parameter names given by
+        `vectorize_over`, or None if the module isn't batched.
+        """
+
+        if not getattr(cls, "vectorize_over", None):
+            return None
+
+        names = cls.vectorize_over
+
+        if type(names) is str:
+            names = [names]
+
+        if not all(type(n) is str for n in names):
+            raise TypeError("'vectorize_over' for %s must be a parameter name or a list of them."
+                            % cls._name)
+
+        if cls.runBatch.im_func is PModule.runBatch.im_func:
+            raise TypeError("Module %s sets vectorize_over and must define runBatch()."
+                            % cls._name)
+
+        return list(names)
+
     @classmethod
     def _getLogger(cls):
         """
@@ -146,29 +333,13 @@ class PModule:
 
     @classmethod
     def __getBinaryAttr(self, attr, parameters):
-        
-        x = getattr(self, attr)
 
-        if x in [True, False]:
-            return x
-        else:
-            pb = parameters[self._name]
-
-            for t in [[], [pb], [pb, parameters]]:
-                try:
-                    ret = x(*t)
-                    break
-                except TypeError, te:
-
-                    if attr in str(te):
-                        continue
-                    else:
-                        raise
+        ret = self._callHook(attr, parameters)
 
-            if ret not in [True, False]:
-                raise TypeError("'%s' must evaluate to or "
-                                "return True or False." % attr)
-            return ret        
+        if ret not in [True, False]:
+            raise TypeError("'%s' must evaluate to or "
+                            "return True or False." % attr)
+        return ret        
 
     @classmethod
     def _allowsResultCaching(self, parameters):
@@ -278,10 +449,133 @@ class PModule:
         saved to cache and this method is always called when results
         from the module are requested.  Otherwise, they are loaded
         from cache if possible.
+
+        `run()` may also be a generator yielding the results in chunks.
+        The results are then a `ResultStream`; iterating over it gives
+        the chunks in order, producing them only as they are needed.
+        The chunks are written to the cache as they are produced, and
+        the cached copy is used once the stream has been read to the
+        end.
         """
         
         pass
 
+    def runPartition(self, index):
+        """
+        Produces shard `index` of the results of a partitioned module,
+        one that sets the class attribute `partitions` (the number of
+        shards, or a classmethod returning it from the parameters).
+        It is called instead of :ref:`run`, once per shard not already
+        in the cache; the results are then a sequence of the shards.
+        Shards may be run in parallel, in which case this must be
+        safe to call from several threads at once.
+
+        Each shard is cached on its own, under a key built from the
+        shard index, the module's parameters and, for partitioned
+        result dependencies with the same number of shards, just the
+        matching shard.  If the class also gives `partition_keys`, a
+        list with an item per shard (or a classmethod returning it),
+        shard i is taken to depend on the module's parameters only
+        through item i; a parameter change then only recomputes the
+        shards whose items changed.
+        """
+
+        raise NotImplementedError("Partitioned module %s must define runPartition()."
+                                  % self._name)
+
+    def runBatch(self, points):
+        """
+        Produces the results for several parameter settings at once,
+        for a module that sets the class attribute `vectorize_over` to
+        a list of local parameter names.  When the results for
+        several settings differing only in those parameters are
+        needed and not in the cache, this is called once, on the
+        module set up with the first setting, instead of :ref:`run`
+        once per setting.  `points` is a list of TreeDicts holding the
+        values of those parameters for each setting.
+
+        It returns either a list with the results for each point, or
+        a numpy array or TreeDict of arrays indexed by point along the
+        first axis; the results for point i are then the i-th entry of
+        each.  These are cached per setting, as though :ref:`run` had
+        given them.
+        """
+
+        raise NotImplementedError("Module %s must define runBatch()." % self._name)
+
+    def checkpoint(self, state, interval = None):
+        """
+        Saves `state`, any picklable object, to the cache as a
+        checkpoint of a long running :ref:`run`.  If `run()` is
+        interrupted, the next call to it (under the same parameters
+        and dependencies) can pick up from the last checkpoint saved
+        using :ref:`restoreCheckpoint`.  For example::
+
+          def run(self):
+              state = self.restoreCheckpoint()
+
+              if state is None:
+                  state = (0, [])
+
+              start, values = state
+
+              for i in xrange(start, self.p.n):
+                  values.append(self.step(i))
+                  self.checkpoint( (i + 1, values), interval = 600)
+
+              return TreeDict(values = values)
+
+        The checkpoint is skipped if less than `interval` seconds have
+        passed since the last one written, or since `run()` was
+        started.  If `interval` is None, the `checkpoint_interval`
+        option is used (by default 0, i.e. every checkpoint is
+        written).  Returns True if the checkpoint was written.
+
+        The checkpoint is removed once `run()` returns.  Nothing is
+        written if caching is disabled for the module.
+        """
+
+        return self._pnode.saveCheckpoint(state, interval)
+
+    def restoreCheckpoint(self, default = None):
+        """
+        Returns the state last saved with :ref:`checkpoint` by an
+        earlier, unfinished call to :ref:`run` under the same
+        parameters and dependencies, or `default` if there isn't one.
+        """
+
+        ret = self._pnode.restoreCheckpoint()
+
+        if ret is None:
+            return default
+
+        self.log.info("Resuming %s from checkpoint." % self._name)
+
+        return ret[1]
+
+    def checkCancelled(self):
+        """
+        Raises ModuleTimeout if :ref:`run` has gone on longer than the
+        module's time limit, or ModuleCancelled if the request was
+        cancelled; otherwise does nothing.  A long running
+        :ref:`run` should call this now and then, e.g. once per
+        iteration, to be stopped cleanly::
+
+          def run(self):
+              while not self.converged():
+                  self.checkCancelled()
+                  self.step()
+
+        The time limit is given by the class attribute `timeout`, in
+        seconds, or for all modules by the `timeout` argument of
+        getResults; by default there is none.  Nothing is cached for a
+        module stopped this way, but a :ref:`checkpoint` it saved is
+        kept.  Modules run in a worker process are killed once past
+        the limit even if they don't call this.
+        """
+
+        self._pnode.checkCancelled()
+
     ############################################################
     # Hash stuff
 
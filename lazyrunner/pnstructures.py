@@ -1,13 +1,29 @@
 from treedict import TreeDict
 from parameters import applyPreset
-from collections import defaultdict
-from os.path import join, abspath, exists, split
-from os import makedirs
-import hashlib, base64, weakref, sys, gc, logging
+from collections import defaultdict, deque
+from os.path import join, abspath, exists, split, getsize
+from os import makedirs, remove, rename, sep
+import hashlib, base64, weakref, sys, gc, logging, time, threading
+from types import GeneratorType
+from inspect import isgeneratorfunction
+from numpy import ndarray
 from itertools import chain
+from Queue import Queue, Empty
 from collections import namedtuple
-from pmodule import isPModule, getPModuleClass
-from diskio import saveResults, loadResults
+from pmodule import isPModule, getPModuleClass, pmodulebase
+from diskio import saveResults, loadResults, temporaryFilename
+from planning import graphPlanKey, loadGraphPlan, saveGraphPlan, buildGraphPlan, PlanEntry
+from history import historyFromOptions
+from scheduling import CriticalPathScheduler, estimateCosts
+from prefetch import Prefetcher
+from streams import ResultStream
+from partitions import PartitionedResults, shardKey, itemHash
+from cachebackends import LocalBackend
+from contentstore import ContentStore
+from cacheindex import VersionIndex
+from tracing import TracingTree, TraceIndex, localPaths
+from processes import runInProcess
+from exceptions import ModuleCancelled, ModuleTimeout
 
 
 ################################################################################
@@ -19,9 +35,11 @@ class PNodeModuleCacheContainer(object):
                  local_key, dependency_key,
                  specific_key = None,
                  is_disk_writable = True,
-                 is_persistent = True):
+                 is_persistent = True,
+                 versions = None):
 
         self.__pn_name = pn_name
+        self.__versions = versions
         self.__name = name
         self.__specific_key = specific_key
         self.__local_key = local_key
@@ -56,6 +74,10 @@ class PNodeModuleCacheContainer(object):
     def getObjectKey(self):
         return (self.__name, self.__specific_key)
 
+    def getVersions(self):
+        # The module versions the key depends on, if known; see cacheindex
+        return self.__versions
+
     def isNonPersistent(self):
         return self.__is_non_persistent
 
@@ -117,6 +139,10 @@ class _PNodeNonPersistentDeleter(object):
         self.common = common
         
     def __call__(self, container):
+        with self.common.lock:
+            self._replace(container)
+
+    def _replace(self, container):
         np_key = container.getNonPersistentKey()
 
         try:
@@ -134,61 +160,1085 @@ class _PNodeNonPersistentDeleter(object):
               
 
 # This class holds the runtime environment for the pnodes
+def _splitBatchResults(name, r, n):
+    # Splits what runBatch() returned into the results for each point
+
+    def checkLength(v):
+        if len(v) != n:
+            raise ValueError("runBatch() of %s returned %d results for %d points."
+                             % (name, len(v), n))
+
+    if type(r) in [list, tuple]:
+        checkLength(r)
+        return list(r)
+
+    elif isinstance(r, ndarray):
+        checkLength(r)
+        return [r[i] for i in xrange(n)]
+
+    elif type(r) is TreeDict:
+        rl = [TreeDict() for i in xrange(n)]
+
+        for k, v in r.iteritems():
+            if not isinstance(v, (ndarray, list, tuple)):
+                raise TypeError("runBatch() of %s returned a TreeDict with '%s' "
+                                "not an array or list." % (name, k))
+            checkLength(v)
+
+            for i in xrange(n):
+                rl[i][k] = v[i]
+
+        return rl
+
+    else:
+        raise TypeError("runBatch() of %s must return a list, a numpy array, "
+                        "or a TreeDict of arrays." % name)
+
 class PNodeCommon(object):
 
-    def __init__(self, opttree):
+    def __init__(self, opttree, history = None, writer = None, remote = None):
         self.log = logging.getLogger("RunCTRL")
 
         # This is for node filtering, i.e. eliminating duplicates
         self.pnode_lookup = weakref.WeakValueDictionary()
 
+        # (name, batch key) -> nodes run together; see claimBatch
+        self.batch_groups = defaultdict(weakref.WeakValueDictionary)
+
         self.non_persistant_pointer_lookup = weakref.WeakValueDictionary()
         self.non_persistant_deleter = _PNodeNonPersistentDeleter(self)
 
-        # This is for local cache lootup
-        self.cache_lookup = defaultdict(PNodeModuleCache)
+        # This is for local cache lootup
+        self.cache_lookup = defaultdict(PNodeModuleCache)
+
+        # Pending reference releases; see releaseReference
+        self.release_queue = deque()
+        self.releasing = False
+
+        self.cache_directory = opttree.cache_directory
+        self.disk_read_enabled = opttree.disk_read_enabled
+        self.disk_write_enabled = opttree.disk_write_enabled
+        
+        self.opttree = opttree
+
+        # Recorded run times and result sizes
+        self.history = history if history is not None else historyFromOptions(opttree)
+
+        # Running modules in parallel; see _instantiateInParallel.
+        # Module code on the worker threads holds the lock whenever it
+        # calls back into the graph.
+        self.parallel_workers = opttree.parallel_workers
+        self.scheduling = False
+        self.lock = threading.RLock()
+
+        # Modules setting io_bound run on a pool of their own; once
+        # any are in the graph, it's run through the scheduler even
+        # with one worker.  See PNode._isIOBound.
+        self.io_workers = opttree.io_workers
+        self.has_io_bound = False
+
+        # Once set, modules stop at their next checkCancelled() and no
+        # more are run; see cancel.  If not None, timeout replaces the
+        # timeout of every module run.
+        self.cancelled = threading.Event()
+        self.timeout = None
+
+        # If not None, the ProgressTracker the nodes report to; see
+        # progress.  planned maps the (name, key) of each node reported
+        # to it as planned to (status, module_needed), so each is
+        # probed once per run.
+        self.progress = None
+        self.planned = {}
+        self.condition = threading.Condition(self.lock)
+
+        # If not None, a WriteBehindQueue that saves to the cache
+        self.writer = writer
+
+        # Results container -> node for the nodes that used a
+        # checkpoint and whose results are being saved; see
+        # removeCheckpointWhenSaved
+        self.checkpoints_pending = {}
+
+        # If not None, the CacheBackend of a store shared behind the
+        # local cache directory; see fetchRemote.  remote_sizes caches
+        # what has been found there, by local filename.  Results are
+        # fetched into the cache directory even if it's read only, but
+        # only published if it isn't.
+        if self.disk_read_enabled and remote is not None:
+            self.local = LocalBackend(self.cache_directory)
+            self.remote = remote
+        else:
+            self.remote = None
+
+        self.remote_sizes = {}
+
+        # Identical cache files are stored once; see contentstore
+        if self.disk_write_enabled and opttree.cache_deduplication:
+            self.content = ContentStore(join(self.cache_directory, "__content__"))
+        else:
+            self.content = None
+
+        # Records the module versions of the entries written
+        if self.disk_write_enabled:
+            self.index = VersionIndex(join(self.cache_directory, "__versions__"))
+        else:
+            self.index = None
+
+        # The parameters read by earlier runs of traced modules
+        if self.disk_read_enabled:
+            self.traces = TraceIndex(join(self.cache_directory, "__traces__"))
+        else:
+            self.traces = None
+
+        # Loads cached results in the background; see startPrefetch
+        if self.disk_read_enabled and opttree.prefetch_workers > 0:
+            self.prefetcher = Prefetcher(opttree, opttree.prefetch_workers,
+                                         opttree.prefetch_memory_limit * 2**20)
+        else:
+            self.prefetcher = None
+
+    def getResults(self, parameters, names, use_graph_plan = False):
+        """
+        Returns the results of the modules in `names` under the
+        parameter tree `parameters`.  If `use_graph_plan` is True and
+        graph plans are enabled, a plan stored from an earlier
+        identical request is used to load the results directly from
+        the cache, and the plan of the graph built here is stored.
+        """
+
+        if type(names) is str:
+            single = True
+            names = [names]
+        else:
+            single = False
+
+        plan_key = None
+
+        if use_graph_plan and self.opttree.cache_graph_plans and self.disk_read_enabled:
+            plan_key = graphPlanKey(parameters, names)
+            plan = loadGraphPlan(self.cache_directory, plan_key)
+
+            if plan is not None and plan.isCurrent():
+                ret_list = self._getResultsFromPlan(parameters, plan)
+
+                if ret_list is not None:
+                    return ret_list[0] if single else ret_list
+            else:
+                plan = None
+
+        pn_list = [self._requestPNode(parameters, n) for n in names]
+        
+        assert len(set(id(pn) for pn in pn_list)) == len(set(names))
+
+        if plan_key is not None and self.disk_write_enabled:
+            new_plan = buildGraphPlan(pn_list)
+
+            if plan is None or plan.roots != new_plan.roots:
+                saveGraphPlan(self.cache_directory, plan_key, new_plan)
+
+        # The roots are instantiated one by one, so all are planned
+        # here; instantiate finds them planned already
+        if self.progress is not None:
+            self.progress.plan(self._plannedNodes([(pn, False) for pn in pn_list]))
+
+        ret_list = [pn.pullUpToResults().result for pn in pn_list]
+        
+        if single:
+            assert len(ret_list) == 1
+            return ret_list[0]
+        else:
+            return ret_list
+
+    def getResultsBatch(self, requests):
+        """
+        Returns, for each (parameters, names) pair in `requests`, the
+        list of results of the modules in `names` under the parameter
+        tree `parameters`, in the order requested.  The graphs of all
+        the requests are built before anything is run, so a node
+        needed by several of them is one node, counted once for each
+        request using it and released after the last; the nodes are
+        then instantiated together (see instantiate).
+        """
+
+        pn_lists = [[self._requestPNode(parameters, n) for n in names]
+                    for parameters, names in requests]
+
+        roots = []
+        seen = set()
+
+        for pn_list in pn_lists:
+            for pn in pn_list:
+                if pn not in seen:
+                    seen.add(pn)
+                    roots.append( (pn, False) )
+
+        self.instantiate(roots)
+
+        return [[pn.pullUpToResults().result for pn in pn_list] for pn_list in pn_lists]
+
+    def iterResults(self, parameters, names):
+        """
+        Yields (name, parameters, results) for each of the modules in
+        `names` under the parameter tree `parameters` as soon as its
+        results are ready, in the order they finish; `parameters` is
+        the module's branch of the tree.  The graph is run on a
+        background thread meanwhile.  Once yielded, the results are
+        no longer held by the graph.  If the caller stops early, the
+        run is cancelled (see cancel) and waited for.
+        """
+
+        if type(names) is str:
+            names = [names]
+
+        pn_list = [self._requestPNode(parameters, n) for n in names]
+
+        roots = []
+
+        for pn in pn_list:
+            if pn not in roots:
+                roots.append(pn)
+
+        finished = Queue()
+
+        def run():
+            try:
+                with self.lock:
+                    self.instantiate([(pn, False) for pn in roots], finished.put)
+            except Exception:
+                finished.put(sys.exc_info())
+
+        t = threading.Thread(target = run, name = "lazyrunner-results")
+        t.daemon = True
+        t.start()
+
+        complete = False
+
+        try:
+            for i in xrange(len(roots)):
+                # Waiting with a timeout keeps this thread responsive to
+                # KeyboardInterrupt.
+                while True:
+                    try:
+                        item = finished.get(True, 1.0)
+                        break
+                    except Empty:
+                        pass
+
+                if type(item) is tuple:
+                    raise item[0], item[1], item[2]
+
+                # Requested once for each time it's named
+                for n in xrange(pn_list.count(item)):
+                    with self.lock:
+                        pulled = item.pullUpToResults()
+
+                    yield item.name, pulled.parameters, pulled.result
+
+            complete = True
+
+        finally:
+            # Nothing more is wanted; stop what's still running
+            if not complete:
+                self.cancel()
+
+            while t.is_alive():
+                t.join(1.0)
+
+    def _requestPNode(self, parameters, n):
+        # Builds and registers the graph below a requested module
+        
+        if type(n) is not str:
+            raise TypeError("Module name not a string.")
+            
+        pn = PNode(self, parameters, n, 'results')
+        pn.initialize()
+            
+        pn = self.registerPNode(pn)
+        pn.increaseParameterReference()
+        pn.increaseResultReference()
+
+        return pn
+
+    def plan(self, parameters, names):
+        """
+        Builds the graph for the modules in `names` and probes the
+        cache, without calling setup() or run() on any module.
+        Returns a list of PlanEntry instances, one per node that a
+        call to getResults would need, in depth first order.
+        """
+
+        if type(names) is str:
+            names = [names]
+
+        pn_list = [self._requestPNode(parameters, n) for n in names]
+
+        self._probeRemote(pn_list)
+
+        entries = []
+
+        # key -> (status, module_needed)
+        visited = {}
+
+        stack = [(pn, 0, False) for pn in reversed(pn_list)]
+
+        while stack:
+            pn, depth, need_module = stack.pop()
+
+            if pn.key in visited:
+                status, had_module = visited[pn.key]
+                repeated = True
+                expand = need_module and not had_module and status != "compute"
+            else:
+                status = self._probeStatus(pn)
+                repeated = False
+                expand = need_module or status == "compute"
+
+            visited[pn.key] = (status, need_module or visited.get(pn.key, (None, False))[1])
+
+            if status == "disk":
+                size = self.storedSize(pn._newResultsContainer())
+                run_time = None
+            elif status == "remote":
+                size = self.remote_sizes.get(self._resultsFilename(pn))
+                run_time = None
+            else:
+                record = self.history.get(pn.name, pn.key)
+                size = record.size if record is not None else None
+                run_time = (self.history.estimateRunTime(pn.name, pn.key)
+                            if status == "compute" else None)
+
+            entries.append(PlanEntry(
+                depth = depth, name = pn.name, key = pn.key,
+                status = status, module_needed = need_module,
+                size = size, estimated_time = run_time, repeated = repeated))
+
+            if expand:
+                stack.extend(reversed(
+                    [(cpn, depth + 1, True) for ln, cpn in pn.module_dependencies.itervalues()]
+                    + [(cpn, depth + 1, False) for k, (ln, cpn) in pn.result_dependencies.iteritems()
+                       if k not in pn.module_dependencies]))
+
+        return entries
+
+    def _resultsFilename(self, pn):
+        return abspath(join(self.cache_directory, pn._newResultsContainer().getFilename()))
+
+    def cacheEntries(self, parameters, names):
+        """
+        Returns the keys (see _entryKey) of the cache files that a
+        call to getResults for the modules in `names` would load:
+        the stored results of the modules needed, but not of those
+        below them then not needed.  Results in the shared store are
+        fetched first.  Objects a module caches itself, and the
+        shards of partitioned modules, aren't included.
+        """
+
+        if type(names) is str:
+            names = [names]
+
+        pn_list = [self._requestPNode(parameters, n) for n in names]
+
+        keys = []
+
+        for pn in pn_list:
+            self.fetchRemote([(pn, False)])
+
+            for cpn, status in self._resultsToLoad([(pn, False)]):
+                if status == "disk" and exists(self._resultsFilename(cpn)):
+                    keys.append(self._entryKey(cpn._newResultsContainer()))
+
+        return keys
+
+    def _probeStatus(self, pn):
+        # Returns where the results of pn would come from if they
+        # aren't loaded yet: "disk", "remote" (the shared store) or
+        # "compute".
+
+        if self.disk_read_enabled and pn.is_result_disk_writable:
+            filename = self._resultsFilename(pn)
+
+            if exists(filename) or (self.writer is not None
+                                    and self.writer.lookup(filename) is not None):
+                return "disk"
+
+            if self.remote is not None and self._remoteSize(pn._newResultsContainer(), filename) is not None:
+                return "remote"
+
+        return "compute"
+
+    def _resultsToLoad(self, roots):
+        # Returns the nodes whose results instantiating the (node,
+        # need_module) pairs in roots will load from the cache, in the
+        # order they will be needed, along with where they are.  This
+        # follows the worklist in _instantiateInOrder.
+
+        ret = []
+        seen = set()
+        stack = list(reversed(roots))
+
+        while stack:
+            pn, pn_need_module = stack.pop()
+
+            if (pn, pn_need_module) in seen or pn._isInstantiated(pn_need_module):
+                continue
+
+            seen.add( (pn, pn_need_module) )
+
+            if not hasattr(pn, "results_container"):
+                status = self._probeStatus(pn)
+
+                if status in ("disk", "remote"):
+                    ret.append( (pn, status) )
+
+                    if not pn_need_module:
+                        continue
+
+            stack.extend( (cpn, cpn_need_module)
+                          for cpn, cpn_need_module, r in reversed(pn._uninstantiatedDependencies()))
+
+        return ret
+
+    def startPrefetch(self, roots):
+        """
+        Starts loading, in the background, the cached results that
+        instantiating the (node, need_module) pairs in `roots` will
+        load, in the order they will be needed.  Returns True if
+        anything was queued, in which case the prefetcher should be
+        cancelled once they are instantiated.
+        """
+
+        if self.prefetcher is None or not self.prefetcher.isIdle():
+            return False
+
+        files = []
+
+        for pn, status in self._resultsToLoad(roots):
+            filename = self._resultsFilename(pn)
+
+            if status == "disk" and exists(filename):
+                files.append( (filename, getsize(filename)) )
+
+        # Nothing to overlap with if only one file is loaded
+        if len(files) <= 1:
+            return False
+
+        self.prefetcher.start(files)
+
+        return True
+
+    def _probeRemote(self, pn_list):
+        # Checks, in one request, which of the results of the nodes
+        # below those in pn_list that aren't in the local cache are in
+        # the shared store.
+
+        if self.remote is None or not self.disk_read_enabled:
+            return
+
+        containers = {}
+        seen = set()
+        stack = list(pn_list)
+
+        while stack:
+            pn = stack.pop()
+
+            if pn.key in seen:
+                continue
+
+            seen.add(pn.key)
+
+            if pn.is_result_disk_writable and not hasattr(pn, "results_container"):
+                filename = self._resultsFilename(pn)
+
+                if filename not in self.remote_sizes and not exists(filename):
+                    containers[filename] = pn._newResultsContainer()
+
+            stack.extend(cpn for ln, cpn in pn.module_dependencies.itervalues())
+            stack.extend(cpn for ln, cpn in pn.result_dependencies.itervalues())
+
+        if not containers:
+            return
+
+        filenames = containers.keys()
+
+        try:
+            sizes = self.remote.probeMany([self._entryKey(containers[fn]) for fn in filenames])
+        except IOError, e:
+            self._remoteError(e)
+            return
+
+        self.remote_sizes.update(zip(filenames, sizes))
+
+    def fetchRemote(self, roots):
+        """
+        Copies the results that instantiating the (node, need_module)
+        pairs in `roots` will load from the shared store to the local
+        cache directory, fetching them all at once.
+        """
+
+        if self.remote is None or not self.disk_read_enabled:
+            return
+
+        self._probeRemote([pn for pn, need_module in roots])
+
+        containers = [pn._newResultsContainer()
+                      for pn, status in self._resultsToLoad(roots)
+                      if status == "remote"]
+
+        keys = dict( (self._entryKey(c), c) for c in containers)
+
+        if not keys:
+            return
+
+        self.log.info("Fetching %d result(s) from the shared cache." % len(keys))
+
+        try:
+            fetched = self.remote.getMany(keys.keys())
+        except IOError, e:
+            self._remoteError(e)
+            return
+
+        for key, container in keys.iteritems():
+            filename = abspath(join(self.cache_directory, container.getFilename()))
+
+            if key in fetched and self._storeFetched(key, fetched[key]):
+                self._cacheFileWritten(container, filename, fetched = True)
+            else:
+                self.remote_sizes[filename] = None
+
+    def _entryKey(self, container):
+        # The path of the container's file in the cache directory, '/'
+        # separated; the key used in the shared store and in bundles.
+        return container.getFilename().replace(sep, "/")
+
+    def _remoteSize(self, container, filename):
+        # The size of the container's object in the shared store, or
+        # None if it isn't there.
+
+        try:
+            return self.remote_sizes[filename]
+        except KeyError:
+            pass
+
+        remote = self.remote
+
+        if remote is None:
+            return None
+
+        try:
+            size = self.remote_sizes[filename] = remote.probe(self._entryKey(container))
+        except IOError, e:
+            self._remoteError(e)
+            return None
+
+        return size
+
+    def _fetchFromRemote(self, container, filename):
+        # Copies the container's object from the shared store to the
+        # local cache directory; returns True if it was there.
+
+        remote = self.remote
+
+        if remote is None or self.remote_sizes.get(filename, 0) is None:
+            return False
+
+        key = self._entryKey(container)
+
+        try:
+            data = remote.get(key)
+        except KeyError:
+            self.remote_sizes[filename] = None
+            return False
+        except IOError, e:
+            self._remoteError(e)
+            return False
+
+        if not self._storeFetched(key, data):
+            self.remote_sizes[filename] = None
+            return False
+
+        self.log.debug("--> Object fetched from the shared cache.")
+        self._cacheFileWritten(container, filename, fetched = True)
+
+        return True
+
+    def _storeFetched(self, key, data):
+        # Puts what was fetched from the shared store in the local
+        # cache directory; returns False if it can't be written there.
+
+        try:
+            self.local.put(key, data)
+        except (IOError, OSError), e:
+            self.log.warning("Could not copy %s from the shared cache to the cache directory: %s"
+                             % (key, str(e)))
+            return False
+
+        return True
+
+    def _publish(self, container):
+        # Puts the local cache file of the container in the shared store
+
+        remote = self.remote
+
+        if remote is None or not self.disk_write_enabled:
+            return
+
+        key = self._entryKey(container)
+
+        try:
+            f = open(self.local.path(key), 'rb')
+
+            try:
+                remote.putFile(key, f)
+            finally:
+                f.close()
+
+        except IOError, e:
+            self.log.warning("Could not put %s in the shared cache: %s" % (key, str(e)))
+
+    def _remoteError(self, e):
+        if self.remote is not None:
+            self.log.warning("Shared cache unavailable, continuing without it: %s" % str(e))
+            self.remote = None
+
+    def newResultStream(self, pn, chunks):
+        """
+        Returns a ResultStream over the generator `chunks` returned by
+        the run() method of `pn`, written to the cache if the results
+        of `pn` can be.
+        """
+
+        container = pn.results_container
+
+        if self.disk_write_enabled and container.isDiskWritable():
+            filename = abspath(join(self.cache_directory, container.getFilename()))
+        else:
+            filename = None
+
+        def finished(run_time):
+            self.history.record(pn.name, pn.key, run_time = run_time,
+                                size = self.storedSize(container))
+
+            if pn.checkpoint_used:
+                self.removeCheckpoint(pn)
+
+            if filename is not None:
+                self._cacheFileWritten(container, filename)
+
+        return ResultStream(chunks, filename, compress = self.opttree.cache_compression,
+                            on_finished = finished)
+
+    def shardContainer(self, name, key, is_disk_writable, versions = None):
+        """
+        Returns the container for the shard of module `name` with
+        shard key `key`, loaded from the cache if it's there.
+        """
+
+        container = PNodeModuleCacheContainer(
+            pn_name = name,
+            name = "__shard__",
+            local_key = None,
+            dependency_key = None,
+            specific_key = key,
+            is_disk_writable = is_disk_writable,
+            versions = versions)
+
+        with self.lock:
+            return self.loadContainer(container, no_local_caching = True)
+
+    def matchTrace(self, pn):
+        """
+        Returns the local key and parameter names of an earlier run of
+        the module of `pn` whose results hold under its parameters,
+        found by tracing, or None; see tracing.
+        """
+
+        if self.traces is None:
+            return None
+
+        return self.traces.match(pn.name, str(pn.p_class._getVersion()), pn.dependency_key,
+                                 pn.parameters[pn.name])
+
+    def recordTrace(self, pn, paths):
+        if self.traces is not None and self.disk_write_enabled:
+            self.traces.record(pn.name, str(pn.p_class._getVersion()), pn.dependency_key,
+                               pn.parameters[pn.name], paths, pn.local_key)
+
+    def _checkpointFilename(self, pn):
+        container = PNodeModuleCacheContainer(
+            pn_name = pn.name,
+            name = "__checkpoint__",
+            local_key = pn.local_key,
+            dependency_key = pn.dependency_key)
+
+        return abspath(join(self.cache_directory, container.getFilename()))
+
+    def saveCheckpoint(self, pn, state):
+        """
+        Writes `state` to the cache as the checkpoint of the module of
+        `pn`, replacing any earlier one.  Returns True if it was
+        written.
+        """
+
+        if not (self.disk_write_enabled and pn.is_disk_writable):
+            return False
+
+        filename = self._checkpointFilename(pn)
+
+        # Written in full before replacing the old one, so a crash
+        # while writing leaves the last checkpoint intact.
+        temp_filename = temporaryFilename(filename)
+
+        self.log.debug("Saving checkpoint of %s to %s." % (pn.name, filename))
+
+        try:
+            saveResults(self.opttree, temp_filename, state)
+            rename(temp_filename, filename)
+
+        except Exception, e:
+            self.log.error("Exception raised attempting to save checkpoint: \n%s" % str(e))
+
+            try:
+                remove(temp_filename)
+            except Exception:
+                pass
+
+            return False
+
+        return True
+
+    def loadCheckpoint(self, pn):
+        """
+        Returns (True, state) if a checkpoint of the module of `pn` is
+        in the cache, otherwise None.
+        """
+
+        if not (self.disk_read_enabled and pn.is_disk_writable):
+            return None
+
+        filename = self._checkpointFilename(pn)
+
+        if not exists(filename):
+            return None
+
+        try:
+            return True, loadResults(self.opttree, filename)
+        except Exception, e:
+            self.log.error("Exception raised while loading checkpoint %s: \n%s"
+                           % (filename, str(e)))
+            return None
+
+    def afterFork(self):
+        """
+        Called in a worker process right after it is forked to run a
+        module (see processes.runInProcess).  Another thread of the
+        parent may have held the graph lock then, so the worker gets
+        new locks; the background pools, whose threads weren't copied,
+        aren't used there.  The nodes the module reads were finished
+        before it started, so they are complete in the worker.
+        """
+
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+        self.history.lock = threading.RLock()
+        pmodulebase._hook_memo_lock = threading.Lock()
+
+        self.writer = None
+        self.prefetcher = None
+        self.progress = None
+
+    def removeCheckpointWhenSaved(self, pn):
+        """
+        Removes the checkpoint of `pn` once the results about to be set
+        in its results container are in place in the cache, or right
+        away if they won't be saved there.  If saving them fails, the
+        checkpoint is kept.
+        """
+
+        if self.disk_write_enabled and pn.results_container.isDiskWritable():
+            self.checkpoints_pending[pn.results_container] = pn
+        else:
+            self.removeCheckpoint(pn)
+
+    def removeCheckpoint(self, pn):
+
+        if not self.disk_write_enabled:
+            return
+
+        filename = self._checkpointFilename(pn)
+
+        if exists(filename):
+            self.log.debug("Removing checkpoint %s." % filename)
+
+            try:
+                remove(filename)
+            except OSError:
+                pass
+
+    def storedSize(self, container):
+        """
+        Returns the size in bytes of the stored copy of the container's
+        object, or None if it isn't stored.
+        """
+
+        if self.cache_directory is None or not container.isDiskWritable():
+            return None
+
+        filename = join(self.cache_directory, container.getFilename())
+
+        return getsize(filename) if exists(filename) else None
+
+    def _getResultsFromPlan(self, parameters, plan):
+        # Returns the list of results for the roots of the plan if all
+        # of them can be loaded from the cache, otherwise None.
+
+        ret_list = []
+
+        for name, key in plan.roots:
+            node = plan.nodes[key]
+
+            if not node.is_result_disk_writable:
+                return None
+
+            # This is cheap, as the graph below isn't built, and
+            # checks the plan against the current local parameters.
+            pn = PNode(self, parameters, name, 'results')
+
+            if pn.local_key != node.local_key:
+                return None
+
+            container = PNodeModuleCacheContainer(
+                pn_name = name,
+                name = "__results__",
+                local_key = node.local_key,
+                dependency_key = node.dependency_key,
+                is_disk_writable = False)
+
+            if not self._loadFromDisk(container, set_save_hook = False):
+                return None
+
+            if self.progress is not None:
+                self.progress.loaded(name, key, getsize(join(self.cache_directory, container.getFilename())))
+
+            ret_list.append( (pn, container.getObject()) )
+
+        self.log.debug("Results loaded using stored graph plan.")
+
+        for pn, r in ret_list:
+            pn._reportResults(r)
+
+        return [r for pn, r in ret_list]
+        
+    def instantiate(self, roots, on_complete = None):
+        """
+        Sets up and runs, or loads, the modules of the nodes in
+        `roots`, a list of (node, need_module) pairs, and everything
+        below them, together: the shared store is checked and the
+        cache prefetched once for all of them, and with parallel
+        workers the whole graph is scheduled at once.
+
+        If given, `on_complete(node)` is called for each of the root
+        nodes as soon as it is instantiated, holding the lock.  The
+        graph is then run through the scheduler even with one worker,
+        so the lock is free while modules run.
+        """
+
+        waiting = set(pn for pn, need_module in roots)
+
+        def done(pn):
+            if on_complete is not None and pn in waiting:
+                waiting.discard(pn)
+                on_complete(pn)
+
+        for pn, need_module in roots:
+            if pn._isInstantiated(need_module):
+                done(pn)
+
+        roots = [(pn, need_module) for pn, need_module in roots
+                 if not pn._isInstantiated(need_module)]
+
+        if not roots:
+            return
+
+        if self.progress is not None:
+            self.progress.plan(self._plannedNodes(roots))
+
+        self.fetchRemote(roots)
+        prefetching = self.startPrefetch(roots)
+
+        try:
+            if ((self.parallel_workers > 1 or self.has_io_bound or on_complete is not None)
+                and not self.scheduling):
+
+                self._instantiateInParallel(roots, done)
+            else:
+                self._instantiateInOrder(roots)
+        finally:
+            if prefetching:
+                self.prefetcher.cancel()
+
+        for pn, need_module in roots:
+            done(pn)
+
+    def _plannedNodes(self, roots):
+        # Returns (name, key, status) for each node that instantiating
+        # the (node, need_module) pairs in roots will load or compute,
+        # with the status as given by _probeStatus, leaving out those
+        # planned by earlier calls; see plan.
+
+        ret = []
+
+        # (name, key) -> (status, module_needed)
+        visited = self.planned
+
+        stack = list(reversed(roots))
+
+        while stack:
+            pn, need_module = stack.pop()
+            k = (pn.name, pn.key)
+
+            if k in visited:
+                status, had_module = visited[k]
+
+                if not need_module or had_module or status == "compute":
+                    continue
+
+                visited[k] = (status, True)
+
+            else:
+                if pn._isInstantiated(need_module):
+                    continue
+
+                if hasattr(pn, "results_container") and pn.results_container.objectIsLoaded():
+                    status = "memory"
+                else:
+                    status = self._probeStatus(pn)
+
+                visited[k] = (status, need_module)
+                ret.append( (pn.name, pn.key, status) )
+
+                if not need_module and status != "compute":
+                    continue
+
+            stack.extend( (cpn, True) for ln, cpn in pn.module_dependencies.itervalues())
+            stack.extend( (cpn, False) for k, (ln, cpn) in pn.result_dependencies.iteritems()
+                          if k not in pn.module_dependencies)
+
+        return ret
+
+    def _instantiateInOrder(self, roots):
+
+        # The dependencies are instantiated bottom up from an explicit
+        # worklist, so the depth of the dependency chain never shows
+        # up on the python stack; by the time a node is built, all of
+        # the children it pulls from are already instantiated.
+
+        stack = [(pn, need_module, False) for pn, need_module in reversed(roots)]
+
+        while stack:
+            pn, pn_need_module, children_ready = stack.pop()
+
+            # Another thread may be running this one
+            if pn.computing:
+                self.waitWhileComputing(pn)
+
+            if children_ready:
+                if not pn._isInstantiated(pn_need_module):
+                    pn._instantiateModule()
+
+            elif not pn._isInstantiated(pn_need_module) and not pn._loadResults(pn_need_module):
+                stack.append( (pn, pn_need_module, True) )
+                stack.extend(reversed(pn._uninstantiatedDependencies()))
+
+    def _instantiateInParallel(self, roots, done):
+
+        # First load everything possible from the cache; what's left
+        # are the nodes that need their modules set up or run.
+        # node -> (need_module, nodes it waits on)
+        tasks = {}
+        stack = list(reversed(roots))
+
+        while stack:
+            pn, pn_need_module = stack.pop()
+
+            if pn in tasks:
+                if pn_need_module and not tasks[pn][0]:
+                    tasks[pn] = (True, tasks[pn][1])
+                continue
+
+            if pn._isInstantiated(pn_need_module) or pn._loadResults(pn_need_module):
+                done(pn)
+                continue
+
+            pending = pn._uninstantiatedDependencies()
+
+            tasks[pn] = (pn_need_module, [cpn for cpn, cpn_need_module, r in pending])
+            stack.extend( (cpn, cpn_need_module) for cpn, cpn_need_module, r in reversed(pending))
+
+        if not tasks:
+            return
+
+        costs = estimateCosts(tasks, lambda pn: self.history.estimateRunTime(pn.name, pn.key))
+
+        def dispatch(pn):
+            if pn._isInstantiated(tasks[pn][0]):
+                done(pn)
+                return None
+
+            if pn.computing:
+                # Being run from within another module's run()
+                return lambda: self.waitWhileComputing(pn)
+
+            pn.computing = True
+
+            try:
+                pulled = pn._pullDependencies()
+            except Exception:
+                self.doneComputing(pn)
+                raise
+
+            # The rest of its batch is claimed now, before its nodes
+            # are dispatched on their own
+            if pn.batch_key is not None and not pn.results_container.objectIsLoaded():
+                pn.batch_members = self.claimBatch(pn)
 
-        self.cache_directory = opttree.cache_directory
-        self.disk_read_enabled = opttree.disk_read_enabled
-        self.disk_write_enabled = opttree.disk_write_enabled
-        
-        self.opttree = opttree
+            def work():
+                try:
+                    return pn._buildModule(*pulled)
+                except Exception:
+                    self.releaseBatch(pn)
+                    self.doneComputing(pn)
+                    raise
 
+            return work
 
-    def getResults(self, parameters, names):
+        def complete(pn, built):
+            if built is not None:
+                try:
+                    pn._finishModule(*built)
+                finally:
+                    self.doneComputing(pn)
 
-        if type(names) is str:
-            single = True
-            names = [names]
-        else:
-            single = False
+            done(pn)
 
-        def getPN(n):
-            if type(n) is not str:
-                raise TypeError("Module name not a string.")
-            
-            pn = PNode(self, parameters, n, 'results')
-            pn.initialize()
-            
-            pn = self.registerPNode(pn)
-            pn.increaseParameterReference()
-            pn.increaseResultReference()
+        self.scheduling = True
 
-            return pn
-        
-        pn_list = [getPN(n) for n in names]
-        
-        assert len(set(id(pn) for pn in pn_list)) == len(set(names))
+        try:
+            CriticalPathScheduler(self.parallel_workers, self.condition, self.io_workers).run(
+                dict( (pn, deps) for pn, (nm, deps) in tasks.iteritems()),
+                costs, dispatch, complete, lambda pn: pn._isIOBound())
+        finally:
+            self.scheduling = False
+
+    def cancel(self):
+        """
+        Stops the modules running at their next checkCancelled(), and
+        keeps any more from being run; the call getting the results
+        raises ModuleCancelled.  Nothing is cached for the modules
+        stopped.
+        """
+
+        self.cancelled.set()
 
-        ret_list = [pn.pullUpToResults().result for pn in pn_list]
-        
-        if single:
-            assert len(ret_list) == 1
-            return ret_list[0]
-        else:
-            return ret_list
-    
-        
     def registerPNode(self, pn):
 
         # see if it's a duplicate
@@ -203,6 +1253,12 @@ class PNodeCommon(object):
         else:
             self.pnode_lookup[key] = pn_ret = pn
 
+            if getattr(pn, "batch_key", None) is not None:
+                self.batch_groups[(pn.name, pn.batch_key)][pn.key] = pn
+
+            if self.io_workers > 0 and pn._isIOBound():
+                self.has_io_bound = True
+
         pn_ret.buildReferences()
             
         return pn_ret
@@ -215,10 +1271,91 @@ class PNodeCommon(object):
         del self.pnode_lookup[key]
         
 
+    def claimBatch(self, pn):
+        """
+        Returns the other nodes whose results can be produced in the
+        same runBatch() call as those of `pn`, i.e. those of the same
+        module differing only in the parameters it vectorizes over,
+        that are needed and not yet in the cache or being computed.
+        They are marked as computing; call doneComputing on each once
+        their results are set.
+        """
+
+        group_key = (pn.name, pn.batch_key)
+
+        with self.lock:
+            group = self.batch_groups.get(group_key)
+
+            if group is None:
+                return []
+
+            members = []
+
+            for key, m in sorted(group.items()):
+                if m is pn or m.computing or m.is_only_parameter_dependency:
+                    continue
+
+                if hasattr(m, "results_container"):
+                    if m.results_container.objectIsLoaded():
+                        continue
+
+                elif m._loadResults(False) or m.results_container.objectIsLoaded():
+                    continue
+
+                m.computing = True
+                members.append(m)
+
+            if not group:
+                del self.batch_groups[group_key]
+
+            return members
+
+    def releaseBatch(self, pn):
+        """
+        Marks the nodes claimed for the batch of `pn` and not run as
+        no longer computing.
+        """
+
+        members, pn.batch_members = pn.batch_members, None
+
+        for m in members or []:
+            self.doneComputing(m)
+
+    def releaseReference(self, release_function):
+        # Dropping a reference can cascade down an arbitrarily long
+        # chain of dependencies, so releases triggered while others
+        # are in progress are queued and run from a single loop.
+
+        self.release_queue.append(release_function)
+
+        if self.releasing:
+            return
+
+        self.releasing = True
+
+        try:
+            while self.release_queue:
+                self.release_queue.popleft()()
+        finally:
+            self.releasing = False
+
+    def waitWhileComputing(self, pn):
+        # Blocks until a node being computed on another thread is
+        # done; only needed while modules are run in parallel.
+
+        with self.condition:
+            while pn.computing and self.scheduling:
+                self.condition.wait()
+
+    def doneComputing(self, pn):
+        with self.condition:
+            pn.computing = False
+            self.condition.notify_all()
+
     def _getCache(self, pn, use_local, use_dependencies, should_exist):
         
         key = (pn.name if pn is not None else None,
-               pn.local_key if use_local else None,
+               pn.own_local_key if use_local else None,
                pn.dependency_key if use_dependencies else None)
 
         if should_exist:
@@ -283,26 +1420,44 @@ class PNodeCommon(object):
                 container.setNonPersistentObjectSaveHook(self.non_persistant_deleter)
 
         # now see if it can be loaded from disk
-        self._loadFromDisk(container)
+        if container.isDiskWritable():
+            self._loadFromDisk(container)
 
         return container
 
     
-    def _loadFromDisk(self, container):
-
-        if not container.isDiskWritable():
-            return
+    def _loadFromDisk(self, container, set_save_hook = True):
+        # Returns True if the object was loaded. 
 
         if self.disk_read_enabled:
             filename = abspath(join(self.cache_directory, container.getFilename()))
 
             self.log.debug("Trying to load %s from %s" % (container.getKeyAsString(), filename))
 
+            queued = self.writer.lookup(filename) if self.writer is not None else None
+
+            if queued is not None:
+                self.log.debug("--> Object taken from the write queue.")
+                container.setObject(queued[1])
+                return True
+
+            if not exists(filename) and self.remote is not None:
+                self._fetchFromRemote(container, filename)
+
             if exists(filename):
                 error_loading = False
+
+                prefetched = (self.prefetcher.take(filename)
+                              if self.prefetcher is not None else None)
                 
                 try:
-                    pt = loadResults(self.opttree, filename)
+                    # If loading it in the background failed, try again
+                    # here before giving up on it.
+                    if prefetched is not None and prefetched[0]:
+                        pt = prefetched[1]
+                    else:
+                        pt = loadResults(self.opttree, filename)
+                    
                 except Exception, e:
                     self.log.error("Exception Raised while loading %s: \n%s"
                                    % (filename, str(e)))
@@ -312,16 +1467,18 @@ class PNodeCommon(object):
 
                     self.log.debug("--> Object successfully loaded.")
                     container.setObject(pt)
-                    return
+                    return True
                 else:
                     pass # go to the disk write enabled part
                 
             else:
                 self.log.debug("--> File does not exist.")
 
-        if self.disk_write_enabled and container.isDiskWritable():
+        if set_save_hook and self.disk_write_enabled and container.isDiskWritable():
             container.setObjectSaveHook(self._saveToDisk)
 
+        return False
+
     def _saveToDisk(self, container):
 
         assert self.disk_write_enabled and container.isDiskWritable()
@@ -329,21 +1486,59 @@ class PNodeCommon(object):
         filename = join(self.cache_directory, container.getFilename())
         obj = container.getObject()
 
+        # Streams write their own entry as the chunks are produced
+        if isinstance(obj, ResultStream):
+            return
+
+        if self.writer is not None:
+            self.log.debug("Queueing object  %s to be saved to %s." % (container.getKeyAsString(), filename))
+            self.writer.submit(abspath(filename), obj,
+                               lambda f: self._cacheFileWritten(container, f))
+            return
+
         self.log.debug("Saving object  %s to   %s." % (container.getKeyAsString(), filename))
 
+        # Replaced rather than rewritten, as other keys may share the
+        # file; see contentstore.
+        temp_filename = temporaryFilename(filename)
+
         try:
-            saveResults(self.opttree, filename, obj)
-            assert exists(filename)
+            saveResults(self.opttree, temp_filename, obj)
+            rename(temp_filename, filename)
             
         except Exception, e:
             
             self.log.error("Exception raised attempting to save object to cache: \n%s" % str(e))
 
             try:
-                remove(filename)
+                remove(temp_filename)
             except Exception:
                 pass
 
+            return
+
+        self._cacheFileWritten(container, filename)
+
+    def _cacheFileWritten(self, container, filename, fetched = False):
+        # Called once a cache file is in place; fetched is True for
+        # files copied from the shared store.
+
+        if self.content is not None:
+            self.content.add(filename)
+
+        versions = container.getVersions()
+
+        if self.index is not None and versions is not None:
+            self.index.record(self._entryKey(container), versions)
+
+        if not fetched:
+            self._publish(container)
+
+        pn = self.checkpoints_pending.pop(container, None)
+
+        if pn is not None:
+            self.removeCheckpoint(pn)
+
     def _debug_referencesDone(self):
         import gc
         gc.collect()
@@ -374,7 +1569,7 @@ class PNodeCommon(object):
                            % (cache.reference_count,
                               "null" if t[0] is None else pn.name,
                               pn.key,
-                              "null" if not t[1] else pn.local_key,
+                              "null" if not t[1] else pn.own_local_key,
                               "null" if not t[2] else pn.dependency_key))
 
             if hasattr(pn, "module") and pn.module is not None:
@@ -452,7 +1647,20 @@ class PNode(object):
             
             self.local_key = base64.b64encode(h.digest(), "az")[:8]
 
+            # The local key from the node's own parameters; local_key
+            # may be replaced by that of a traced earlier run, but the
+            # objects the module caches itself are kept under this.
+            self.own_local_key = self.local_key
+
             self.results_reported = False
+            self.computing = False
+
+            # Set while the module is run; see saveCheckpoint
+            self.checkpoint_time = None
+
+            # When run() has to be done by; see checkCancelled
+            self.deadline = None
+            self.checkpoint_used = False
             self.full_key = self.parameters.hash()
 
             # Reference counting isn't used in the parameter classes
@@ -472,10 +1680,27 @@ class PNode(object):
 
     def initialize(self):
         # This extra step is needed as the child pnodes must be
-        # consolidated into the right levels first
+        # consolidated into the right levels first.  Dependency chains
+        # can be arbitrarily deep, so this is done with an explicit
+        # worklist instead of recursing: each node creates its
+        # children, then is finalized once all its children are.
 
         assert self.is_pmodule
 
+        stack = [(self, False)]
+
+        while stack:
+            pn, children_done = stack.pop()
+
+            if children_done:
+                pn._finalizeDependencies()
+            else:
+                pn._createDependencies()
+                stack.append( (pn, True) )
+                stack.extend( (cpn, False) for n, cpn in pn.result_dependencies.itervalues())
+
+    def _createDependencies(self):
+
         def _processDependencySet(p_type, dl):
 
             rs = {}
@@ -485,10 +1710,13 @@ class PNode(object):
                 t = type(s)
 
                 if t is str:
-                    if s != self.name:
 
-                        # delay the creation until we know we need it
-                        h = self.full_key if parameters is self.parameters else parameters.hash()
+                    # delay the creation until we know we need it
+                    h = self.full_key if parameters is self.parameters else parameters.hash()
+
+                    # A module may depend on itself under different
+                    # parameters (e.g. a Delta of the previous step)
+                    if s != self.name or h != self.full_key:
                         rs[(s, h)] = (s if first_order else name_override, parameters, s, p_type)
 
                 elif t is list or t is tuple or t is set:
@@ -532,9 +1760,7 @@ class PNode(object):
                 if k in self.module_dependencies:
                    self.module_dependencies[k] = v 
 
-        # Go through and instantiate all the children
-        for n, pn in self.result_dependencies.itervalues():
-            pn.initialize()
+    def _finalizeDependencies(self):
 
         # Now go through and eliminate duplicates
         for k, (n, pn) in self.result_dependencies.items():
@@ -562,10 +1788,41 @@ class PNode(object):
 
         self.dependency_key = base64.b64encode(h.digest(), "az")[:8]
 
+        # Partitioned results are cached shard by shard instead
+        self.n_partitions = self.p_class._getPartitions(self.parameters)
+
+        # If an earlier run read only parameters that match these, its
+        # key is used instead; see tracing.
+        self.is_traced = self._isTraced()
+        self.trace_paths = None
+
+        if self.is_traced:
+            match = self.common.matchTrace(self)
+
+            if match is not None:
+                self.local_key, self.trace_paths = match
+
         h.update(self.local_key)
 
         self.key = base64.b64encode(h.digest(), "az")[:8]
 
+        # The versions of the modules the keys depend on, by name, as
+        # strings; see cacheindex.
+        self.dependency_versions = {}
+
+        for k, (ln, pn) in self.result_dependencies.iteritems():
+            self.dependency_versions.update(pn.versions)
+
+        self.versions = dict(self.dependency_versions)
+        self.versions[self.name] = str(self.p_class._getVersion())
+
+        # Nodes differing only in the parameters the module vectorizes
+        # over share a batch key; see _runBatch.  batch_members holds
+        # the nodes claimed to be run with this one, if claimed before
+        # it is run.
+        self.batch_key = self._batchKey()
+        self.batch_members = None
+
         # Load the parameter tree
         self.dependency_parameter_tree = TreeDict()
 
@@ -579,6 +1836,42 @@ class PNode(object):
         self.is_result_disk_writable = (False if not self.is_disk_writable else
                                         self.p_class._allowsResultCaching(self.dependency_parameter_tree))
 
+        if self.n_partitions is not None:
+            self.is_result_disk_writable = False
+
+    def _isTraced(self):
+        # Shards aren't keyed on the local key, so tracing doesn't apply
+
+        if self.n_partitions is not None:
+            return False
+
+        t = getattr(self.p_class, "trace_parameters", None)
+
+        return bool(self.common.opttree.trace_parameter_access if t is None else t)
+
+    def _batchKey(self):
+
+        names = self.p_class._getVectorizeOver()
+
+        # A node run under the key of a traced run is left alone
+        if names is None or self.n_partitions is not None or self.is_traced:
+            return None
+
+        local = self.parameters[self.name].copy()
+
+        for n in names:
+            if n not in local:
+                raise ValueError("Parameter '%s' in vectorize_over of %s is not in %s."
+                                 % (n, self.name, self.name))
+            del local[n]
+
+        h = hashlib.md5()
+        h.update(str(self.p_class._getVersion()))
+        h.update(self.dependency_key)
+        h.update(local.hash())
+
+        return base64.b64encode(h.digest(), "az")[:8]
+
     def buildReferences(self):
 
         if not self.is_only_parameter_dependency and not self.children_have_reference:
@@ -601,15 +1894,18 @@ class PNode(object):
         if self.children_have_reference:
 
             ########################################
-            # Do reference counting with all the children
+            # Do reference counting with all the children; these are
+            # queued as they may cascade down the dependency chain
+            release = self.common.releaseReference
+
             for k, (n, pn) in self.module_dependencies.items():
-                pn.decreaseModuleReference()
+                release(pn.decreaseModuleReference)
 
             for k, (n, pn) in self.result_dependencies.items():
-                pn.decreaseResultReference()
+                release(pn.decreaseResultReference)
 
             for k, (n, pn) in self.parameter_dependencies.items():
-                pn.decreaseParameterReference()
+                release(pn.decreaseParameterReference)
 
             self.children_have_reference = False
 
@@ -617,37 +1913,79 @@ class PNode(object):
     # Instantiating things
 
     def _instantiate(self, need_module):
+        self.common.instantiate([(self, need_module)])
+
+    def _isIOBound(self):
+        return self.is_pmodule and bool(getattr(self.p_class, "io_bound", False))
+
+    def _isInstantiated(self, need_module):
+        return (not self.computing
+                and hasattr(self, "results_container")
+                and self.results_container.objectIsLoaded()
+                and (not need_module or hasattr(self, "module")))
+
+    def _uninstantiatedDependencies(self):
+
+        pending = []
+
+        for k, (load_name, pn) in self.module_dependencies.iteritems():
+            if not pn._isInstantiated(True):
+                pending.append( (pn, True, False) )
+
+        for k, (load_name, pn) in self.result_dependencies.iteritems():
+            if k not in self.module_dependencies and not pn._isInstantiated(False):
+                pending.append( (pn, False, False) )
+
+        return pending
+
+    def _loadResults(self, need_module):
+        # Returns True if nothing more is needed to instantiate the
+        # node, i.e. the results were loaded and no module is needed.
 
         if not hasattr(self, "results_container"):
 
             # Attempt to load the results from cache
             self.results_container = self.common.loadContainer(
-                PNodeModuleCacheContainer(
-                    pn_name = self.name,
-                    name = "__results__",
-                    local_key = self.local_key,
-                    dependency_key = self.dependency_key,
-                    is_disk_writable = self.is_result_disk_writable),
-                no_local_caching = True)
-
-            have_loaded_results = self.results_container.objectIsLoaded()
+                self._newResultsContainer(), no_local_caching = True)
 
             # we're done if the results are loaded and that's all we need    
-            if have_loaded_results:
+            if self.results_container.objectIsLoaded():
+
+                if self.common.progress is not None:
+                    self.common.progress.loaded(self.name, self.key,
+                                              self.common.storedSize(self.results_container))
 
                 self._reportResults(self.results_container.getObject())
 
                 if self.module_reference_count == 0:
                     assert not need_module
                     self.dropUnneededReferences()
-                    return
+                    return True
                 
                 if not need_module:
-                    return
-        else:
-            have_loaded_results = self.results_container.objectIsLoaded()
+                    return True
+
+        return False
+
+    def _newResultsContainer(self):
+        return PNodeModuleCacheContainer(
+            pn_name = self.name,
+            name = "__results__",
+            local_key = self.local_key,
+            dependency_key = self.dependency_key,
+            is_disk_writable = self.is_result_disk_writable,
+            versions = self.versions)
+
+    def _instantiateModule(self):
 
-        # Okay, not done yet
+        self.computing = True
+
+        try:
+            self._finishModule(*self._buildModule(*self._pullDependencies()))
+        finally:
+            self.common.doneComputing(self)
+
+    def _pullDependencies(self):
 
         ########################################
         # This pulls all the dependency parts
@@ -699,29 +2037,370 @@ class PNode(object):
         self.children_have_reference = False
 
         self.increaseModuleAccessCount()
-        
-        # Now instantiate the module
+
+        return params, results, modules
+
+    def _buildModule(self, params, results, modules):
+        # Sets up the module and runs it if the results aren't
+        # loaded.  This touches nothing else in the graph, so it may
+        # be called from a worker thread.  Returns the results, the
+        # time run() took (None if it wasn't called), and the (node,
+        # results) pairs of the other nodes of its batch that were run
+        # with it, for _finishModule to finish.
+
+        if self.results_container.objectIsLoaded():
+            self.module = self.p_class(self, params, results, modules)
+            return self.results_container.getObject(), None, []
+
+        if self.is_traced:
+            accessed = set()
+            params = TracingTree(params, "", accessed)
+        else:
+            accessed = None
+
         self.module = self.p_class(self, params, results, modules)
 
-        if not have_loaded_results:
-            r = self.module.run()
+        start_time = self.checkpoint_time = time.time()
+        batch = []
 
-            if type(r) is TreeDict:
-                r.freeze()
-                
-            self.results_container.setObject(r)
+        timeout = self._timeout()
+        self.deadline = (start_time + timeout) if timeout is not None else None
+
+        self.checkCancelled()
+
+        progress = self.common.progress
+
+        if progress is not None:
+            progress.started(self.name, self.key)
+
+        try:
+            if self.n_partitions is not None:
+                r = self._runPartitions()
+            elif self.batch_key is not None:
+                r, batch = self._runBatch()
+            elif self._runsInProcess():
+                r = self._runInProcess(accessed)
+            else:
+                r = self.module.run()
+        except:
+            if progress is not None:
+                progress.stopped(self.name, self.key)
+            raise
+
+        # A batch's time is shared out between its points
+        run_time = (time.time() - start_time) / (1 + len(batch))
+
+        if self.is_traced:
+            self._checkTrace(accessed, r)
+
+        if type(r) is TreeDict:
+            r.freeze()
+        elif type(r) is GeneratorType:
+            r = self.common.newResultStream(self, r)
+
+        # A stream removes it once it's complete
+        if self.checkpoint_used and not isinstance(r, ResultStream):
+            self.common.removeCheckpointWhenSaved(self)
+
+        self.results_container.setObject(r)
+
+        if progress is not None:
+            progress.done(self.name, self.key)
+
+        return r, run_time, batch
+
+    def _runBatch(self):
+        # Runs the module's runBatch() for this node and the others of
+        # its batch that are needed, setting the results of the
+        # others.  Returns the results of this one and the (node,
+        # results) pairs of the others, which are still marked as
+        # computing until _finishModule is done with them.
+
+        common = self.common
+
+        if self.batch_members is not None:
+            members, self.batch_members = self.batch_members, None
+        else:
+            members = common.claimBatch(self)
+
+        if not members:
+            return self.module.run(), []
+
+        try:
+            names = self.p_class._getVectorizeOver()
+            nodes = [self] + members
+            points = []
+
+            for pn in nodes:
+                pt = TreeDict()
+
+                for n in names:
+                    pt[n] = pn.parameters[pn.name][n]
+
+                pt.freeze()
+                points.append(pt)
+
+            self.module.log.info("Running %d parameter settings in one batch." % len(points))
+
+            rl = _splitBatchResults(self.name, self.module.runBatch(points), len(points))
+
+            for pn, r in zip(members, rl[1:]):
+                if type(r) is TreeDict:
+                    r.freeze()
+
+                pn.results_container.setObject(r)
+
+        except:
+            for pn in members:
+                common.doneComputing(pn)
+
+            raise
+
+        return rl[0], zip(members, rl[1:])
+
+    def _timeout(self):
+        if self.common.timeout is not None:
+            return self.common.timeout
+
+        return getattr(self.p_class, "timeout", None)
+
+    def checkCancelled(self):
+        # Raises ModuleCancelled or ModuleTimeout if run() should stop
+
+        if self.common.cancelled.is_set():
+            raise ModuleCancelled("Run of %s was cancelled." % self.name)
+
+        if self.deadline is not None and time.time() > self.deadline:
+            raise ModuleTimeout("%s did not finish within its time limit of %g seconds."
+                                % (self.name, self._timeout()))
+
+    def _runsInProcess(self):
+        # Generators can't be sent back from another process
+
+        if self.n_partitions is not None or isgeneratorfunction(self.p_class.run):
+            return False
+
+        # Mostly waiting anyway; see PNodeCommon.io_workers
+        if self._isIOBound() and getattr(self.p_class, "run_in_process", None) is None:
+            return False
+
+        t = getattr(self.p_class, "run_in_process", None)
+
+        if t is None:
+            return bool(self.common.opttree.parallel_processes and self.common.parallel_workers > 1)
+        else:
+            return bool(t)
+
+    def _runInProcess(self, accessed):
+        # Runs run() in a worker process; see processes.  What the
+        # node itself keeps track of during run() is sent back along
+        # with the results.
+
+        # Any results it requests are computed in the worker process
+        # and are lost with it; see PNodeCommon.afterFork.  A worker
+        # still running past the time limit, or once cancelled, is
+        # killed.
+
+        common = self.common
+        opttree = common.opttree
+
+        def run():
+            return self.module.run(), accessed, self.checkpoint_used
+
+        r, child_accessed, self.checkpoint_used = runInProcess(
+            run, opttree.shared_memory_directory, opttree.shared_memory_threshold,
+            "lazyrunner-%s" % self.name, common.afterFork, self.checkCancelled)
+
+        if accessed is not None:
+            accessed.update(child_accessed)
+
+        return r
+
+    def _checkTrace(self, accessed, r):
+        # Called before the results are saved.  A generator reads its
+        # parameters as it goes, so what it reads isn't known yet.
 
-            self._reportResults(r)
+        paths = localPaths(accessed, self.name) if type(r) is not GeneratorType else None
 
+        if self.trace_paths is not None:
+            # Run under the key of an earlier run; the results can be
+            # cached under it only if nothing more was read.
+            if paths is None or not paths <= self.trace_paths:
+                self.module.log.warning(
+                    "%s read parameters an earlier run with the same key did not; "
+                    "the results are not cached." % self.name)
+                self.results_container.disableDiskWriting()
+
+        elif (paths is not None and r is not None
+              and self.results_container.isDiskWritable()):
+            self.common.recordTrace(self, paths)
+
+    def _shardKeys(self):
+        # Each shard depends on the matching shard of partitioned
+        # results with the same number of shards, and on everything
+        # else the node depends on as a whole.
+
+        n = self.n_partitions
+        items = self.p_class._getPartitionKeys(self.parameters, n)
+
+        shared = []
+        per_shard = [[] for i in xrange(n)]
+
+        for k, (load_name, pn) in sorted(self.parameter_dependencies.iteritems()):
+            if k not in self.result_dependencies:
+                shared.append("%s:%s" % (k[0], pn.parameter_key))
+                continue
+
+            r = self.child_pull_dict[k][1]
+
+            if isinstance(r, PartitionedResults) and len(r) == n:
+                for i in xrange(n):
+                    per_shard[i].append("%s:%s" % (k[0], r.keys[i]))
+
+            elif isinstance(r, PartitionedResults):
+                shared.extend("%s:%s" % (k[0], sk) for sk in r.keys)
+
+            else:
+                shared.append("%s:%s" % (k[0], pn.key))
+
+        version = self.p_class._getVersion()
+
+        return [shardKey(self.name, version, i,
+                         itemHash(items[i]) if items is not None else self.parameter_key,
+                         shared + per_shard[i])
+                for i in xrange(n)]
+
+    def _runPartitions(self):
+        # Runs the shards that aren't in the cache; returns the
+        # PartitionedResults.
+
+        common = self.common
+        name = self.name
+        keys = self._shardKeys()
+
+        is_disk_writable = self.is_disk_writable
+        keep_in_memory = not (common.disk_write_enabled and is_disk_writable)
+
+        shards = {}
+        missing = []
+
+        for i, key in enumerate(keys):
+            container = common.shardContainer(name, key, is_disk_writable, self.versions)
+
+            if not container.objectIsLoaded():
+                missing.append( (i, container) )
+
+            elif keep_in_memory:
+                shards[i] = container.getObject()
+
+        def runShard(i, container):
+            obj = self.module.runPartition(i)
+            container.setObject(obj)
+
+            if keep_in_memory:
+                shards[i] = obj
+
+        if missing:
+            self.module.log.info("Running %d of %d partitions." % (len(missing), len(keys)))
+
+        if self._isIOBound() and common.io_workers > 0:
+            n_workers = common.io_workers
+        else:
+            n_workers = common.parallel_workers
+
+        if n_workers > 1 and len(missing) > 1:
+            containers = dict(missing)
+
+            CriticalPathScheduler(n_workers, threading.Condition()).run(
+                dict( (i, []) for i, c in missing),
+                dict( (i, 1.0) for i, c in missing),
+                lambda i: (lambda: runShard(i, containers[i])),
+                lambda i, value: None)
         else:
-            r = self.results_container.getObject()
+            for i, container in missing:
+                runShard(i, container)
+
+        def load(i):
+            container = common.shardContainer(name, keys[i], is_disk_writable)
+
+            if not container.objectIsLoaded():
+                raise RuntimeError("Shard %d of %s is no longer in the cache." % (i, name))
+
+            return container.getObject()
+
+        return PartitionedResults(keys, shards, load)
+
+    def _finishModule(self, r, run_time, batch):
+
+        try:
+            if run_time is not None:
+                # Streams record their run time once they are done
+                if not isinstance(r, ResultStream):
+                    self.common.history.record(self.name, self.key, run_time = run_time,
+                                               size = self.common.storedSize(self.results_container))
+
+                self._reportResults(r)
+
+            self.module._setResults(r)
+
+            self.dependent_modules_pulled = True
+
+            self.decreaseModuleAccessCount()
+
+        finally:
+            self._finishBatch(batch, run_time)
+
+    def _finishBatch(self, batch, run_time):
+        # Finishes the other nodes run in the same batch as this one,
+        # whose results _runBatch has set.
+
+        common = self.common
 
-        self.module._setResults(r)
+        try:
+            for pn, r in batch:
+                common.history.record(pn.name, pn.key, run_time = run_time,
+                                      size = common.storedSize(pn.results_container))
+                pn._reportResults(r)
+
+                if common.progress is not None:
+                    common.progress.done(pn.name, pn.key)
 
-        self.dependent_modules_pulled = True
+                if pn.module_reference_count == 0:
+                    pn.dropUnneededReferences()
 
-        self.decreaseModuleAccessCount()
+        finally:
+            for pn, r in batch:
+                common.doneComputing(pn)
             
+    def saveCheckpoint(self, state, interval):
+        # Returns True if the checkpoint was written.
+
+        if interval is None:
+            interval = self.common.opttree.checkpoint_interval
+
+        if self.checkpoint_time is None:
+            raise RuntimeError("checkpoint() may only be called while %s is run." % self.name)
+
+        now = time.time()
+
+        if now - self.checkpoint_time < interval:
+            return False
+
+        self.checkpoint_used = True
+        self.checkpoint_time = now
+
+        return self.common.saveCheckpoint(self, state)
+
+    def restoreCheckpoint(self):
+        # Returns (True, state) or None
+
+        ret = self.common.loadCheckpoint(self)
+
+        if ret is not None:
+            self.checkpoint_used = True
+
+        return ret
+
     ##################################################
     # Interfacing stuff
 
@@ -733,17 +2412,24 @@ class PNode(object):
 
         if mrc_zero and mac_zero and self.dependent_modules_pulled:
 
-            # Get rid of everything but the results
-            self.module._destroy()
+            # Get rid of everything but the results, unless the
+            # module is still producing them as a stream.
+            r = getattr(self.module, "local_results", None)
+
+            if not (isinstance(r, ResultStream) and not r.isComplete()):
+                self.module._destroy()
+
             del self.module
 
             # propegate all the dependencies
+            release = self.common.releaseReference
+
             for k, (load_name, pn) in self.module_dependencies.iteritems():
-                pn.decreaseModuleAccessCount()
+                release(pn.decreaseModuleAccessCount)
 
             if hasattr(self, "additional_module_nodes_accessed"):
                 for pn in self.additional_module_nodes_accessed:
-                    pn.decreaseModuleAccessCount()
+                    release(pn.decreaseModuleAccessCount)
 
                 del self.additional_module_nodes_accessed
 
@@ -850,7 +2536,7 @@ class PNode(object):
         
         assert self.result_reference_count >= 1
 
-        if not hasattr(self, "results_container"):
+        if not self._isInstantiated(False):
             self._instantiate(False)
             
         r = self.results_container.getObject()
@@ -869,7 +2555,7 @@ class PNode(object):
         # print "Pulling module for module %s." % self.name
         assert self.module_reference_count >= 0
 
-        if not hasattr(self, "module") or not hasattr(self, "results_container"):
+        if not self._isInstantiated(True):
             self._instantiate(True)
 
         r = self.results_container.getObject()
@@ -892,16 +2578,23 @@ class PNode(object):
     def getCacheContainer(self, obj_name, key, ignore_module, ignore_local,
                           ignore_dependencies, is_disk_writable, is_persistent):
 
+        versions = {} if ignore_dependencies else dict(self.dependency_versions)
+
+        if not ignore_local:
+            versions[self.name] = self.versions[self.name]
+
         container = PNodeModuleCacheContainer(
             pn_name = None if ignore_module else self.name,
             name = obj_name,
-            local_key = None if ignore_local else self.local_key,
+            local_key = None if ignore_local else self.own_local_key,
             dependency_key = None if ignore_dependencies else self.dependency_key,
             specific_key = key,
             is_disk_writable = is_disk_writable and self.is_disk_writable,
-            is_persistent = is_persistent)
-            
-        return self.common.loadContainer(container)
+            is_persistent = is_persistent,
+            versions = versions)
+
+        with self.common.lock:
+            return self.common.loadContainer(container)
 
     def _resolveRequestInfo(self, r):
 
@@ -924,6 +2617,12 @@ class PNode(object):
         
     def getSpecific(self, r_type, r):
 
+        # This may be called from modules running on worker threads
+        with self.common.lock:
+            return self._getSpecific(r_type, r)
+
+    def _getSpecific(self, r_type, r):
+
         name, ptree, key = self._resolveRequestInfo(r)
 
         lookup_key = (name, key)
@@ -0,0 +1,153 @@
+"""
+Loading cached results ahead of when they are needed.  Once the graph
+for a request is built, the results files it will load are known, so
+they are read and unpickled on background threads in the order they
+will be used, overlapping the disk reads with the computation.
+"""
+
+import threading
+from collections import deque
+from diskio import loadResults
+
+class Prefetcher(object):
+    """
+    Loads cache files on up to `n_workers` background threads.  No
+    more are loaded while the files of the results loaded but not
+    taken yet add up to `memory_limit` bytes.  This counts the files
+    as stored, so with compression the results themselves may take
+    several times the limit in memory.
+    """
+
+    def __init__(self, opttree, n_workers, memory_limit):
+        self.opttree = opttree
+        self.n_workers = n_workers
+        self.memory_limit = memory_limit
+
+        self.condition = threading.Condition()
+
+        # Files waiting to be loaded, as (filename, size)
+        self.pending = deque()
+        self.pending_set = set()
+
+        # filename -> size, for the ones being loaded now
+        self.loading = {}
+
+        # Files being loaded now that were cancelled
+        self.dropped = set()
+
+        # filename -> (size, succeeded, object or exception)
+        self.loaded = {}
+
+        self.held_bytes = 0
+        self.n_threads = 0
+
+    def isIdle(self):
+        with self.condition:
+            return not (self.pending or self.loading or self.loaded)
+
+    def start(self, files):
+        """
+        Queues loading the files in `files`, a list of (filename,
+        size) pairs in the order they will be taken.
+        """
+
+        with self.condition:
+            for filename, size in files:
+                if (filename not in self.pending_set and filename not in self.loading
+                    and filename not in self.loaded):
+
+                    self.pending.append( (filename, size) )
+                    self.pending_set.add(filename)
+
+            while self.n_threads < min(self.n_workers, len(self.pending)):
+                t = threading.Thread(target = self._work, name = "lazyrunner-prefetch")
+                t.daemon = True
+                t.start()
+                self.n_threads += 1
+
+    def take(self, filename):
+        """
+        Returns None if `filename` isn't being prefetched; otherwise
+        waits until it's loaded and returns (True, object) or, if
+        loading it failed, (False, exception).
+        """
+
+        with self.condition:
+            if filename in self.pending_set:
+                # Not started yet; the caller is better off loading
+                # it directly.
+                self.pending_set.remove(filename)
+                self.pending = deque(t for t in self.pending if t[0] != filename)
+                return None
+
+            while filename in self.loading and filename not in self.dropped:
+                self.condition.wait()
+
+            if filename not in self.loaded:
+                return None
+
+            size, ok, value = self.loaded.pop(filename)
+            self.held_bytes -= size
+            self.condition.notify_all()
+
+            return ok, value
+
+    def cancel(self):
+        """
+        Drops everything not yet taken.  Files being loaded at the
+        moment are dropped once they are done.
+        """
+
+        with self.condition:
+            self.pending.clear()
+            self.pending_set.clear()
+
+            for size, ok, value in self.loaded.itervalues():
+                self.held_bytes -= size
+
+            self.loaded.clear()
+            self.dropped.update(self.loading)
+            self.condition.notify_all()
+
+    def _work(self):
+
+        self.condition.acquire()
+
+        try:
+            while True:
+                # Always allow one file, even if larger than the limit,
+                # so things keep moving.
+                while (self.pending and self.held_bytes != 0
+                       and self.held_bytes + self.pending[0][1] > self.memory_limit):
+                    self.condition.wait()
+
+                if not self.pending:
+                    self.n_threads -= 1
+                    return
+
+                filename, size = self.pending.popleft()
+                self.pending_set.remove(filename)
+                self.loading[filename] = size
+                self.held_bytes += size
+
+                self.condition.release()
+
+                try:
+                    ret = (size, True, loadResults(self.opttree, filename, buffered = True))
+                except Exception, e:
+                    ret = (size, False, e)
+
+                self.condition.acquire()
+
+                del self.loading[filename]
+
+                if filename in self.dropped:
+                    self.dropped.remove(filename)
+                    self.held_bytes -= size
+                else:
+                    self.loaded[filename] = ret
+
+                self.condition.notify_all()
+
+        finally:
+            self.condition.release()
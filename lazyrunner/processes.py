@@ -0,0 +1,292 @@
+"""
+Running a module's run() in a forked worker process.  Pickling a
+large array through a pipe holds it twice in memory, once on each
+side, and costs a full copy each way; instead, the numpy arrays in
+the results are written once into memory mapped files (in /dev/shm
+where available) and only their descriptions go through the pipe.
+The parent maps each file read-only and removes its name right away,
+so the memory is freed once the last array using it is dropped, i.e.
+when the results are released with the node holding them.
+
+Only the return value of run() gets back to the parent; any other
+changes the module makes to itself or the graph are lost with the
+worker process.  A worker that has to be stopped is killed, and the
+files it wrote are found by its pid, part of their names.
+
+Only the forking thread is copied into the worker, while the other
+threads of the parent keep running; a lock one of them holds at that
+moment stays locked in the worker for good.  Nothing is held across
+the fork; instead the worker replaces the locks it may need, those of
+logging and whatever the caller's `at_fork` replaces.
+"""
+
+import os, mmap, tempfile, traceback, logging, threading
+from os.path import isdir, join
+from glob import glob
+from multiprocessing import Process, Pipe
+from numpy import ndarray, dtype
+from treedict import TreeDict
+
+def sharedMemoryDirectory(directory = None):
+    """
+    Returns the directory the shared arrays are written to:
+    `directory` if given, else /dev/shm if it exists, else the
+    temporary directory.
+    """
+
+    if directory:
+        return directory
+    elif isdir("/dev/shm"):
+        return "/dev/shm"
+    else:
+        return tempfile.gettempdir()
+
+class SharedArray(object):
+    """
+    Describes an array written to the file `filename`.
+    """
+
+    def __init__(self, filename, dtype_str, shape, fortran_order):
+        self.filename = filename
+        self.dtype_str = dtype_str
+        self.shape = shape
+        self.fortran_order = fortran_order
+
+def _filePrefix(pid):
+    return "lazyrunner-%d-" % pid
+
+def _shareArray(a, directory, files):
+
+    fd, filename = tempfile.mkstemp(prefix = _filePrefix(os.getpid()), suffix = ".shm",
+                                    dir = directory)
+    files.append(filename)
+
+    try:
+        os.ftruncate(fd, a.nbytes)
+        m = mmap.mmap(fd, a.nbytes)
+    finally:
+        os.close(fd)
+
+    fortran_order = a.flags.f_contiguous and not a.flags.c_contiguous
+
+    try:
+        ndarray(a.shape, a.dtype, buffer = m, order = 'F' if fortran_order else 'C')[...] = a
+    finally:
+        m.close()
+
+    return SharedArray(filename, a.dtype.str, a.shape, fortran_order)
+
+def share(obj, directory, threshold, files):
+    """
+    Returns a copy of `obj` with the arrays of at least `threshold`
+    bytes within it written to files in `directory` and replaced by
+    SharedArray descriptions.  Arrays are found within TreeDicts,
+    dicts, lists and tuples.  The names of the files written are
+    appended to `files`.
+    """
+
+    def s(v):
+        if type(v) is ndarray:
+            if v.nbytes >= max(threshold, 1) and not v.dtype.hasobject:
+                return _shareArray(v, directory, files)
+            return v
+
+        elif isinstance(v, TreeDict):
+            t = v.copy()
+
+            for k, tv in v.iteritems():
+                sv = s(tv)
+
+                if sv is not tv:
+                    t[k] = sv
+
+            return t
+
+        elif type(v) is dict:
+            return dict( (k, s(dv)) for k, dv in v.iteritems())
+        elif type(v) is list:
+            return [s(lv) for lv in v]
+        elif type(v) is tuple:
+            return tuple(s(tv) for tv in v)
+        else:
+            return v
+
+    return s(obj)
+
+def _attachArray(sa):
+
+    fd = os.open(sa.filename, os.O_RDONLY)
+
+    try:
+        size = os.fstat(fd).st_size
+        m = mmap.mmap(fd, size, access = mmap.ACCESS_READ) if size > 0 else ""
+    finally:
+        os.close(fd)
+        os.remove(sa.filename)
+
+    return ndarray(sa.shape, dtype(sa.dtype_str), buffer = m,
+                   order = 'F' if sa.fortran_order else 'C')
+
+def attach(obj):
+    """
+    Returns a copy of `obj` with the SharedArray descriptions in it
+    replaced by read-only arrays mapping their files; the file names
+    are removed.
+    """
+
+    def a(v):
+        if isinstance(v, SharedArray):
+            return _attachArray(v)
+
+        elif isinstance(v, TreeDict):
+            t = v.copy()
+
+            for k, tv in v.iteritems():
+                if isinstance(tv, (SharedArray, dict, list, tuple)):
+                    t[k] = a(tv)
+
+            return t
+
+        elif type(v) is dict:
+            return dict( (k, a(dv)) for k, dv in v.iteritems())
+        elif type(v) is list:
+            return [a(lv) for lv in v]
+        elif type(v) is tuple:
+            return tuple(a(tv) for tv in v)
+        else:
+            return v
+
+    return a(obj)
+
+def release(obj):
+    """
+    Removes the files of the SharedArray descriptions in `obj`
+    without mapping them.
+    """
+
+    for f in _filenames(obj):
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+def _filenames(v):
+    if isinstance(v, SharedArray):
+        return [v.filename]
+    elif isinstance(v, TreeDict):
+        return sum((_filenames(tv) for k, tv in v.iteritems()), [])
+    elif type(v) is dict:
+        return sum((_filenames(dv) for dv in v.itervalues()), [])
+    elif type(v) in (list, tuple):
+        return sum((_filenames(lv) for lv in v), [])
+    else:
+        return []
+
+def _removeAll(files):
+    for f in files:
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+def _resetLoggingLocks():
+    # Gives logging and its handlers new locks; called in the worker
+
+    logging._lock = threading.RLock() if logging._lock is not None else None
+
+    for r in list(logging._handlerList):
+        h = r()
+
+        if h is not None and h.lock is not None:
+            h.createLock()
+
+def runInProcess(f, directory = None, threshold = 0, name = "lazyrunner-process", at_fork = None,
+                 check = None, check_interval = 0.1):
+    """
+    Calls `f` in a forked process and returns its return value, with
+    the arrays of at least `threshold` bytes in it passed back
+    through memory mapped files in `directory` (see
+    sharedMemoryDirectory).  An exception raised by `f` is re-raised
+    here, after its traceback in the worker process is logged.
+
+    If given, `check()` is called every `check_interval` seconds
+    while waiting; if it raises, the process is killed and the
+    exception passed on.
+
+    Only the calling thread is copied into the new process, so a lock
+    another thread holds when it is forked stays locked there.  The
+    locks of logging are replaced in the new process, and if given,
+    `at_fork()` is called there before `f` to replace any others `f`
+    may need.
+    """
+
+    directory = sharedMemoryDirectory(directory)
+    receiver, sender = Pipe(duplex = False)
+
+    def child():
+        receiver.close()
+        files = []
+
+        _resetLoggingLocks()
+
+        try:
+            if at_fork is not None:
+                at_fork()
+
+            message = (True, share(f(), directory, threshold, files))
+        except Exception, e:
+            _removeAll(files)
+            message = (False, (e, traceback.format_exc()))
+
+        try:
+            sender.send(message)
+        except Exception, e:
+            # Not picklable
+            _removeAll(files)
+            sender.send( (False, (None, traceback.format_exc())) )
+
+        sender.close()
+
+    p = Process(target = child, name = name)
+    p.start()
+
+    sender.close()
+
+    try:
+        if check is not None:
+            try:
+                while not receiver.poll(check_interval):
+                    check()
+            except:
+                p.terminate()
+                p.join()
+                _removeAll(glob(join(directory, _filePrefix(p.pid) + "*")))
+                raise
+
+        try:
+            ok, value = receiver.recv()
+        except EOFError:
+            p.join()
+            raise RuntimeError("Worker process exited with code %s before returning its results."
+                               % str(p.exitcode))
+    finally:
+        receiver.close()
+
+    p.join()
+
+    if ok:
+        try:
+            return attach(value)
+        except:
+            release(value)
+            raise
+
+    e, tb = value
+
+    logging.getLogger("RunCTRL").error("Exception raised in worker process:\n%s" % tb)
+
+    if e is None:
+        raise RuntimeError("Results of worker process could not be returned: %s"
+                           % tb.strip().split("\n")[-1])
+
+    raise e
@@ -0,0 +1,276 @@
+"""
+Progress reports for long runs.  When a ProgressTracker is attached
+to a run (see `_RunManager.setProgressCallback`), the graph reports
+to it the nodes it plans to load or compute, and each node as it is
+loaded, started and done; the tracker passes on a Progress snapshot
+to a callback every so often.  The time left is estimated from the
+run times recorded for the modules (see history), shared out over
+the parallel workers.  With no tracker attached, the graph does
+nothing more than check for one.
+"""
+
+import sys, time, threading
+from planning import formatSize, formatTime
+
+class Progress(object):
+    """
+    A snapshot of a run: the number of nodes planned (to be loaded or
+    computed), loaded, running and done (computed), the bytes of
+    results loaded, the seconds since the start, and the estimated
+    seconds left, or None if nothing is known to estimate it from.
+    `finished` is True for the last report of a run.
+    """
+
+    def __init__(self, n_planned, n_loaded, n_running, n_done, bytes_loaded,
+                 elapsed, eta, finished):
+        self.n_planned = n_planned
+        self.n_loaded = n_loaded
+        self.n_running = n_running
+        self.n_done = n_done
+        self.bytes_loaded = bytes_loaded
+        self.elapsed = elapsed
+        self.eta = eta
+        self.finished = finished
+
+    def fraction(self):
+        """
+        Returns the fraction of the planned nodes loaded or done.
+        """
+
+        if self.n_planned == 0:
+            return 1.0
+
+        return min(1.0, float(self.n_loaded + self.n_done) / self.n_planned)
+
+    def __repr__(self):
+        return ("<Progress: %d/%d loaded or done, %d running, %s loaded, eta %s>"
+                % (self.n_loaded + self.n_done, self.n_planned, self.n_running,
+                   formatSize(self.bytes_loaded), formatTime(self.eta)))
+
+# The shortest interval between reports; the background thread
+# would otherwise spin with an interval of 0
+min_interval = 0.05
+
+class ProgressTracker(object):
+    """
+    Counts the nodes of a run as they are reported, calling
+    `callback(progress)` with a Progress at most once every
+    `interval` seconds, and once more on `close`.  While modules are
+    running, it's also called every `interval` seconds from a
+    background thread, so the time left keeps counting down; the
+    callback is called on whichever thread made the report.  The
+    interval is at least `min_interval`.  `estimate(name, key)` gives
+    the expected run time of a node, or None if unknown; the time left
+    is divided among `n_workers`.
+    """
+
+    def __init__(self, callback, estimate, n_workers = 1, interval = 0.5):
+        self.callback = callback
+        self.estimate = estimate
+        self.n_workers = max(1, n_workers)
+        self.interval = max(interval, min_interval)
+
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.last_report = None
+
+        # Reports while modules run; started with the first one
+        self.ticker = None
+        self.closed = threading.Event()
+
+        # Nodes are given by module name and node key.  (name, key)
+        # -> "load" or "compute" for each node planned or seen
+        self.planned = {}
+
+        # compute node -> estimated run time (None if unknown)
+        self.estimates = {}
+
+        # running node -> time started; nodes loaded or done
+        self.running = {}
+        self.loaded_nodes = set()
+        self.done_nodes = set()
+
+        self.bytes_loaded = 0
+
+    def plan(self, nodes):
+        """
+        Adds the (name, key, status) triples in `nodes` to the nodes
+        planned; the status is "disk" or "remote" for nodes to be
+        loaded, "compute" for ones to be run, and "memory" for ones
+        already there, which are ignored.
+        """
+
+        estimates = [((name, key), self.estimate(name, key))
+                     for name, key, status in nodes if status == "compute"]
+
+        with self.lock:
+            for name, key, status in nodes:
+                if status in ("disk", "remote"):
+                    self.planned.setdefault((name, key), "load")
+
+            for k, e in estimates:
+                if self.planned.get(k) != "compute":
+                    self.planned[k] = "compute"
+                    self.estimates[k] = e
+
+        self._report()
+
+    def loaded(self, name, key, size):
+        """
+        Reports that the results of module `name` under node key
+        `key`, `size` bytes if known, were loaded from the cache.
+        """
+
+        k = (name, key)
+
+        with self.lock:
+            self.planned.setdefault(k, "load")
+            self.loaded_nodes.add(k)
+            self.bytes_loaded += size or 0
+
+        self._report()
+
+    def started(self, name, key):
+        """
+        Reports that the node started running.
+        """
+
+        with self.lock:
+            k = self._computed(name, key)
+            self.running[k] = time.time()
+
+            if self.ticker is None:
+                self.ticker = threading.Thread(target = self._tick, name = "lazyrunner-progress")
+                self.ticker.daemon = True
+                self.ticker.start()
+
+        self._report()
+
+    def stopped(self, name, key):
+        """
+        Reports that the node stopped running without results.
+        """
+
+        with self.lock:
+            self.running.pop((name, key), None)
+
+        self._report()
+
+    def done(self, name, key):
+        """
+        Reports that the results of the node were computed.
+        """
+
+        with self.lock:
+            k = self._computed(name, key)
+            self.running.pop(k, None)
+            self.done_nodes.add(k)
+
+        self._report()
+
+    def _computed(self, name, key):
+        # Called with the lock held; a node may be run without having
+        # been planned, e.g. when a module requests it from run()
+
+        k = (name, key)
+
+        if self.planned.get(k) != "compute":
+            self.planned[k] = "compute"
+            self.estimates[k] = None
+
+        return k
+
+    def close(self):
+        """
+        Makes the last report of the run.
+        """
+
+        self.closed.set()
+
+        if self.ticker is not None:
+            self.ticker.join()
+
+        self._report(finished = True)
+
+    def _tick(self):
+        while not self.closed.wait(self.interval):
+            if self.running:
+                self._report()
+
+    def snapshot(self, finished = False):
+        """
+        Returns the Progress of the run now.
+        """
+
+        with self.lock:
+            now = time.time()
+
+            known = [e for e in self.estimates.itervalues() if e is not None]
+            fill = (sum(known) / len(known)) if known else None
+
+            remaining = 0.0
+
+            for k, e in self.estimates.iteritems():
+                if k in self.done_nodes:
+                    continue
+
+                if e is None:
+                    e = fill
+
+                if e is None:
+                    remaining = None
+                    break
+
+                if k in self.running:
+                    e = max(0.0, e - (now - self.running[k]))
+
+                remaining += e
+
+            return Progress(
+                n_planned = len(self.planned),
+                n_loaded = len(self.loaded_nodes),
+                n_running = len(self.running),
+                n_done = len(self.done_nodes),
+                bytes_loaded = self.bytes_loaded,
+                elapsed = now - self.start_time,
+                eta = (remaining / self.n_workers) if remaining is not None else None,
+                finished = finished)
+
+    def _report(self, finished = False):
+
+        now = time.time()
+
+        with self.lock:
+            if (not finished and self.last_report is not None
+                and now - self.last_report < self.interval):
+
+                return
+
+            self.last_report = now
+
+        self.callback(self.snapshot(finished))
+
+class ProgressBar(object):
+    """
+    A progress callback drawing a one line progress bar on the
+    terminal `stream`, by default standard error.
+    """
+
+    def __init__(self, stream = None, width = 30):
+        self.stream = stream if stream is not None else sys.stderr
+        self.width = width
+
+    def __call__(self, progress):
+
+        n = int(round(progress.fraction() * self.width))
+
+        line = ("\r[%s%s] %d/%d: %d loaded (%s), %d running, %d done; %s elapsed, %s left  "
+                % ("#" * n, " " * (self.width - n),
+                   progress.n_loaded + progress.n_done, progress.n_planned,
+                   progress.n_loaded, formatSize(progress.bytes_loaded),
+                   progress.n_running, progress.n_done,
+                   formatTime(progress.elapsed),
+                   formatTime(progress.eta) if not progress.finished else formatTime(0)))
+
+        self.stream.write(line + ("\n" if progress.finished else ""))
+        self.stream.flush()
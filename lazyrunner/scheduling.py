@@ -0,0 +1,244 @@
+"""
+Running the computations of a dependency graph on a pool of worker
+threads.  Ready nodes are started longest remaining path first: each
+node is ranked by its own estimated cost plus the largest rank of the
+nodes that depend on it (the upward rank of HEFT list scheduling), so
+a long branch is started as soon as it can be instead of whenever a
+topological ordering happens to reach it.
+"""
+
+import threading, heapq, sys
+from Queue import Queue
+from collections import deque
+
+# Assumed cost, in seconds, of a node when nothing at all is known
+# about it or any other node being scheduled.
+default_cost = 1.0
+
+def estimateCosts(nodes, estimate):
+    """
+    Returns a dict mapping each node in `nodes` to its estimated
+    cost.  `estimate(node)` gives the cost or None if unknown;
+    unknown costs are taken as the mean of the known ones.
+    """
+
+    costs = dict( (n, estimate(n)) for n in nodes)
+
+    known = [c for c in costs.itervalues() if c is not None]
+    fill = (sum(known) / len(known)) if known else default_cost
+
+    for n, c in costs.iteritems():
+        if c is None:
+            costs[n] = fill
+
+    return costs
+
+def upwardRanks(dependencies, costs):
+    """
+    Returns a dict mapping each node to its upward rank, the total
+    cost of the longest path from the node up through the nodes that
+    depend on it.  `dependencies` maps each node to the list of nodes
+    it depends on; dependencies not in `dependencies` are ignored.
+    """
+
+    dependents = dict( (n, []) for n in dependencies)
+
+    for n, deps in dependencies.iteritems():
+        for d in deps:
+            if d in dependents:
+                dependents[d].append(n)
+
+    # A node's rank is known once the ranks of all the nodes
+    # depending on it are.
+    n_waiting = dict( (n, len(dl)) for n, dl in dependents.iteritems())
+    ready = [n for n, c in n_waiting.iteritems() if c == 0]
+
+    ranks = {}
+
+    while ready:
+        n = ready.pop()
+
+        ranks[n] = costs[n] + max([ranks[d] for d in dependents[n]] or [0])
+
+        for d in dependencies[n]:
+            if d in n_waiting:
+                n_waiting[d] -= 1
+
+                if n_waiting[d] == 0:
+                    ready.append(d)
+
+    if len(ranks) != len(dependencies):
+        raise ValueError("Dependency graph contains a cycle.")
+
+    return ranks
+
+class CriticalPathScheduler(object):
+    """
+    Runs the nodes of a dependency graph on `n_workers` threads.
+    Nodes for which `io_bound(node)` is True, ones that mostly wait
+    on disk or other processes, run instead on a separate pool of
+    `n_io_workers` threads, so many of them can be waiting at once
+    without holding up the rest.
+
+    The scheduling itself is done on the calling thread, holding the
+    lock of `condition`; it is released only while waiting for the
+    workers.  For each node, once all its dependencies are done,
+    `dispatch(node)` is called and returns either None, if nothing
+    needs to be run, or a function to call on a worker thread.  When
+    that function returns, `complete(node, value)` is called on the
+    calling thread with its return value.  If any of these raise, no
+    new nodes are started and the exception is re-raised once the
+    running ones have finished; those finishing meanwhile are still
+    completed.
+    """
+
+    def __init__(self, n_workers, condition, n_io_workers = 0):
+        self.n_workers = n_workers
+        self.n_io_workers = n_io_workers
+        self.condition = condition
+
+    def run(self, dependencies, costs, dispatch, complete, io_bound = None):
+
+        ranks = upwardRanks(dependencies, costs)
+
+        dependents = dict( (n, []) for n in dependencies)
+        n_remaining = {}
+
+        for n, deps in dependencies.iteritems():
+            deps = [d for d in deps if d in dependents]
+            n_remaining[n] = len(deps)
+
+            for d in deps:
+                dependents[d].append(n)
+
+        # The pool each node runs in; True for the I/O one
+        if self.n_io_workers > 0 and io_bound is not None:
+            pool = dict( (n, bool(io_bound(n))) for n in dependencies)
+        else:
+            pool = dict( (n, False) for n in dependencies)
+
+        # Ties are broken by the order the nodes were listed in.
+        order = dict( (n, i) for i, n in enumerate(dependencies))
+        ready = {False : [], True : []}
+
+        def makeReady(n):
+            heapq.heappush(ready[pool[n]], (-ranks[n], order[n], n))
+
+        def finish(n):
+            for d in dependents[n]:
+                n_remaining[d] -= 1
+
+                if n_remaining[d] == 0:
+                    makeReady(d)
+
+        for n, c in n_remaining.iteritems():
+            if c == 0:
+                makeReady(n)
+
+        work_queues = {False : Queue(), True : Queue()}
+        finished = deque()
+        threads = {False : [], True : []}
+
+        def worker(work_queue):
+            while True:
+                item = work_queue.get()
+
+                if item is None:
+                    return
+
+                n, work = item
+
+                try:
+                    ret = (n, True, work())
+                except Exception:
+                    ret = (n, False, sys.exc_info())
+
+                self.condition.acquire()
+                try:
+                    finished.append(ret)
+                    self.condition.notify_all()
+                finally:
+                    self.condition.release()
+
+        for is_io, limit, name in [(False, self.n_workers, "lazyrunner-worker-%d"),
+                                   (True, self.n_io_workers, "lazyrunner-io-worker-%d")]:
+
+            n_nodes = sum(1 for p in pool.itervalues() if p == is_io)
+
+            for i in xrange(min(limit, n_nodes)):
+                t = threading.Thread(target = worker, args = (work_queues[is_io],), name = name % i)
+                t.daemon = True
+                t.start()
+                threads[is_io].append(t)
+
+        error = None
+        n_running = {False : 0, True : 0}
+
+        self.condition.acquire()
+
+        try:
+            while True:
+                # Dispatching a node that needs nothing run can make
+                # nodes of the other pool ready, so go until neither
+                # can start any more.
+                started = True
+
+                while started and error is None:
+                    started = False
+
+                    for is_io in (False, True):
+                        while (ready[is_io] and error is None
+                               and n_running[is_io] < len(threads[is_io])):
+
+                            rank, i, n = heapq.heappop(ready[is_io])
+                            started = True
+
+                            try:
+                                work = dispatch(n)
+                            except Exception:
+                                error = sys.exc_info()
+                                break
+
+                            if work is None:
+                                finish(n)
+                            else:
+                                n_running[is_io] += 1
+                                work_queues[is_io].put( (n, work) )
+
+                if n_running[False] + n_running[True] == 0:
+                    break
+
+                # Waiting with a timeout keeps the main thread
+                # responsive to KeyboardInterrupt.
+                while not finished:
+                    self.condition.wait(1.0)
+
+                n, ok, value = finished.popleft()
+                n_running[pool[n]] -= 1
+
+                if not ok:
+                    error = error or value
+                else:
+                    try:
+                        complete(n, value)
+                    except Exception:
+                        error = error or sys.exc_info()
+                    else:
+                        finish(n)
+
+        finally:
+            self.condition.release()
+
+            all_threads = threads[False] + threads[True]
+
+            for is_io in (False, True):
+                for t in threads[is_io]:
+                    work_queues[is_io].put(None)
+
+            # If interrupted, don't wait on modules still running
+            if n_running[False] + n_running[True] == 0:
+                for t in all_threads:
+                    t.join()
+
+        if error is not None:
+            raise error[0], error[1], error[2]
@@ -0,0 +1,243 @@
+"""
+Streamed results.  A module's run() may be a generator; its results
+are then a ResultStream, which downstream modules iterate over to get
+the chunks in order.  Chunks are produced only as they are asked for
+and appended to a chunked cache entry as they arrive, so neither side
+needs to hold the whole result in memory.
+
+A chunked entry is a header line followed by one record per chunk,
+each a length and the (optionally bz2 compressed) pickle of the chunk.
+It is written under a temporary name and renamed into place once the
+generator is exhausted, so only complete streams are ever loaded from
+the cache.  If the results can't be cached, the chunks go to a
+temporary file instead, which is removed along with the stream.
+"""
+
+import os, struct, threading, time, tempfile, bz2
+import cPickle
+from os.path import exists
+
+_magic = "LAZYRUNNER-STREAM-1"
+_length = struct.Struct("<Q")
+
+def isStreamFile(filename):
+    """
+    Returns True if `filename` holds a chunked (streamed) entry.
+    """
+
+    f = open(filename, 'rb')
+    try:
+        return f.read(len(_magic)) == _magic
+    finally:
+        f.close()
+
+class ResultStream(object):
+    """
+    An iterable over the chunks of a streamed result.  Each iteration
+    starts from the first chunk; chunks already produced are read back
+    from the stream's file, the rest are pulled from the generator.
+
+    `chunks` is the generator; `filename` is the cache file to write,
+    or None to use a temporary file.  `on_finished`, if given, is
+    called with the total time spent in the generator once it is
+    exhausted.
+    """
+
+    def __init__(self, chunks, filename = None, compress = True, on_finished = None):
+
+        self._lock = threading.RLock()
+        self._source = chunks
+        self._compress = compress
+        self._on_finished = on_finished
+        self._run_time = 0.0
+        self._error = None
+
+        # Where each chunk's record starts in the file
+        self._offsets = []
+
+        if filename is None:
+            fd, self._path = tempfile.mkstemp(prefix = "lazyrunner-stream-", suffix = ".dat")
+            self._out = os.fdopen(fd, 'wb')
+            self._filename = None
+        else:
+            d = os.path.split(filename)[0]
+
+            if not exists(d):
+                os.makedirs(d)
+
+            self._path = "%s.%d-%d.tmp" % (filename, os.getpid(), id(self))
+            self._out = open(self._path, 'wb')
+            self._filename = filename
+
+        self._out.write("%s %s\n" % (_magic, "bz2" if compress else "raw"))
+        self._out.flush()
+
+    @classmethod
+    def fromFile(cls, filename):
+        """
+        Opens a complete chunked entry written earlier.
+        """
+
+        self = cls.__new__(cls)
+
+        self._lock = threading.RLock()
+        self._source = None
+        self._on_finished = None
+        self._error = None
+        self._out = None
+        self._path = self._filename = filename
+        self._offsets = []
+
+        f = open(filename, 'rb')
+
+        try:
+            header = f.readline().split()
+
+            if len(header) != 2 or header[0] != _magic:
+                raise IOError("%s is not a chunked results file." % filename)
+
+            self._compress = (header[1] == "bz2")
+
+            # Just note where each record starts
+            while True:
+                offset = f.tell()
+                s = f.read(_length.size)
+
+                if not s:
+                    break
+
+                self._offsets.append(offset)
+                f.seek(_length.unpack(s)[0], os.SEEK_CUR)
+        finally:
+            f.close()
+
+        return self
+
+    def isComplete(self):
+        """
+        Returns True once all the chunks have been produced.
+        """
+
+        return self._source is None
+
+    def __iter__(self):
+        f = None
+        i = 0
+
+        try:
+            while True:
+                with self._lock:
+                    if i < len(self._offsets):
+                        offset, chunk = self._offsets[i], None
+                    elif self._source is None:
+                        if self._error is not None:
+                            raise RuntimeError("Producing the stream failed: %s" % self._error)
+                        return
+                    else:
+                        offset, chunk = None, self._pull()
+
+                        if chunk is _end:
+                            return
+
+                if offset is not None:
+                    if f is None:
+                        f = open(self._path, 'rb')
+
+                    chunk = self._read(f, offset)
+
+                i += 1
+                yield chunk
+        finally:
+            if f is not None:
+                f.close()
+
+    def _read(self, f, offset):
+        f.seek(offset)
+        n = _length.unpack(f.read(_length.size))[0]
+        data = f.read(n)
+
+        return cPickle.loads(bz2.decompress(data) if self._compress else data)
+
+    def _pull(self):
+        # Gets the next chunk from the generator and appends it to the
+        # file; called with the lock held.
+
+        start_time = time.time()
+
+        try:
+            chunk = self._source.next()
+        except StopIteration:
+            self._run_time += time.time() - start_time
+            self._finish()
+            return _end
+        except Exception, e:
+            self._abandon(str(e))
+            raise
+
+        self._run_time += time.time() - start_time
+
+        data = cPickle.dumps(chunk, protocol = -1)
+
+        if self._compress:
+            data = bz2.compress(data)
+
+        self._offsets.append(self._out.tell())
+        self._out.write(_length.pack(len(data)))
+        self._out.write(data)
+        self._out.flush()
+
+        return chunk
+
+    def _finish(self):
+        self._out.close()
+        self._out = None
+        self._source = None
+
+        if self._filename is not None:
+            os.rename(self._path, self._filename)
+            self._path = self._filename
+
+        if self._on_finished is not None:
+            self._on_finished(self._run_time)
+            self._on_finished = None
+
+    def _abandon(self, error):
+        self._error = error
+        self._source = None
+        self._offsets = []
+
+        self._out.close()
+        self._out = None
+        self._removeTemporary()
+
+    def _removeTemporary(self):
+        if self._path is not None and self._path != self._filename:
+            try:
+                os.remove(self._path)
+            except OSError:
+                pass
+
+            self._path = None
+
+    def __del__(self):
+        try:
+            if self._out is not None:
+                self._out.close()
+        finally:
+            self._removeTemporary()
+
+    def __reduce__(self):
+        # A complete stream in the cache can be referred to by name
+        if self._source is None and self._filename is not None and self._path == self._filename:
+            return (_openStream, (self._filename,))
+
+        raise cPickle.PicklingError("Only complete, cached result streams can be pickled.")
+
+    def __repr__(self):
+        return "<ResultStream: %d chunk(s)%s>" % (
+            len(self._offsets), "" if self._source is None else " so far")
+
+_end = object()
+
+def _openStream(filename):
+    return ResultStream.fromFile(filename)
@@ -0,0 +1,274 @@
+"""
+Parameter access tracing.  The cache key of a module covers its whole
+local parameter branch, so changing a parameter the module never
+reads still means running it again.  For a module with tracing
+enabled, the parameters handed to setup() and run() record the names
+of the values read; once the results are saved, that set is stored
+along with the key.  A later request for the same module, version
+and dependencies whose local parameters agree with an earlier run on
+every value it read then uses that run's key, and so that run's cached
+results.  Modules depending on it still see its whole branch, so
+their own keys are unaffected.
+
+This assumes run() is deterministic given what it reads.  As a check,
+when a module is run under the key of an earlier run (its results
+having been removed, say), the results are only cached if it read
+nothing beyond what the earlier run did.
+"""
+
+import os, json, logging
+from os.path import join, exists, isdir
+from treedict import TreeDict
+
+# Methods of TreeDict that look at the tree but not at its values
+_structure_methods = frozenset([
+    "branchName", "treeName", "isRoot", "isFrozen", "isMutable", "isRegistered",
+    "isDangling", "structureIsFrozen", "valuesAreFrozen"])
+
+class TracingTree(object):
+    """
+    Stands in for the TreeDict `tree`, adding the full name of each
+    value read through it to the set `accessed`.  Branches are
+    returned wrapped in turn.  Anything depending on the whole of a
+    branch (iterating over it, hashing or copying it, ...) adds the
+    name of the branch; the empty string stands for the whole tree.
+
+    As with a TreeDict, the methods of TreeDict hide parameters of the
+    same name as attributes; `p["copy"]` or `p.get("copy")` reads the
+    parameter `copy`, and is traced as reading just that.  Code that
+    checks the type of a parameter tree won't see a TreeDict.
+    """
+
+    __slots__ = ["_tree", "_prefix", "_accessed"]
+
+    def __init__(self, tree, prefix, accessed):
+        object.__setattr__(self, "_tree", tree)
+        object.__setattr__(self, "_prefix", prefix)
+        object.__setattr__(self, "_accessed", accessed)
+
+    def _whole(self):
+        self._accessed.add(self._prefix[:-1])
+
+    def _lookup(self, key):
+        name = self._prefix + key
+
+        try:
+            value = self._tree[key]
+        except KeyError:
+            self._accessed.add(name)
+            raise
+
+        if isinstance(value, TreeDict):
+            return TracingTree(value, name + ".", self._accessed)
+
+        self._accessed.add(name)
+        return value
+
+    def __getattr__(self, attr):
+        if attr in _structure_methods:
+            return getattr(self._tree, attr)
+
+        if attr.startswith("__") or hasattr(TreeDict, attr):
+            # Any other method of the tree; assume it looks at
+            # everything
+            self._whole()
+            return getattr(self._tree, attr)
+
+        try:
+            return self._lookup(attr)
+        except KeyError:
+            raise AttributeError("'%s' does not exist in the parameter tree." % (self._prefix + attr))
+
+    def __setattr__(self, attr, value):
+        setattr(self._tree, attr, value)
+
+    def __getitem__(self, key):
+        return self._lookup(key)
+
+    def get(self, key, default = None):
+        try:
+            return self._lookup(key)
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        self._accessed.add(self._prefix + key)
+        return key in self._tree
+
+    has_key = __contains__
+
+    def __iter__(self):
+        self._whole()
+        return iter(self._tree)
+
+    def __len__(self):
+        self._whole()
+        return len(self._tree)
+
+    def __eq__(self, other):
+        self._whole()
+
+        if isinstance(other, TracingTree):
+            other._whole()
+            other = other._tree
+
+        return self._tree == other
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __repr__(self):
+        self._whole()
+        return repr(self._tree)
+
+    def __str__(self):
+        self._whole()
+        return str(self._tree)
+
+    def __reduce__(self):
+        self._whole()
+        return (_unwrap, (self._tree,))
+
+def _unwrap(tree):
+    return tree
+
+def localPaths(accessed, name):
+    """
+    Returns the names, relative to the branch `name`, of the values in
+    `accessed` within it, or None if the whole branch was read.
+    """
+
+    prefix = name + "."
+    paths = set()
+
+    for a in accessed:
+        if a == "" or a == name:
+            return None
+
+        if a.startswith(prefix):
+            paths.add(a[len(prefix):])
+
+    return paths
+
+_missing = object()
+
+def traceHash(tree, paths):
+    """
+    Returns a hash of the values at `paths` in `tree`, telling apart
+    values that aren't there.
+    """
+
+    items = []
+
+    for p in sorted(paths):
+        v = tree.get(p, _missing)
+
+        if v is _missing:
+            items.append( (p, 0, None) )
+        elif isinstance(v, TreeDict):
+            items.append( (p, 1, v.hash()) )
+        else:
+            items.append( (p, 2, v) )
+
+    return TreeDict(key = items).hash()
+
+class TraceIndex(object):
+    """
+    The traces recorded in `directory`, one log file per module, each
+    line a JSON object.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log = logging.getLogger("RunCTRL")
+
+        # name -> list of trace dicts, newest first
+        self.traces = {}
+
+    def _load(self, name):
+        try:
+            return self.traces[name]
+        except KeyError:
+            pass
+
+        traces = []
+        seen = set()
+        filename = join(self.directory, name + ".log")
+
+        if exists(filename):
+            f = open(filename, 'r')
+
+            try:
+                lines = f.readlines()
+            finally:
+                f.close()
+
+            for line in reversed(lines):
+                try:
+                    t = json.loads(line)
+                    k = (t["version"], t["dependency_key"], t["values"], t["local_key"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+                if k not in seen:
+                    seen.add(k)
+                    # json gives unicode; TreeDict keys must be str
+                    t["paths"] = frozenset(str(p) for p in t["paths"])
+                    t["local_key"] = str(t["local_key"])
+                    traces.append(t)
+
+        self.traces[name] = traces
+
+        return traces
+
+    def match(self, name, version, dependency_key, tree):
+        """
+        Returns the local key and the set of parameter names of the
+        newest trace of module `name` at `version` with dependencies
+        `dependency_key` whose values agree with the local branch
+        `tree`, or None if there isn't one.
+        """
+
+        for t in self._load(name):
+            if (t["version"] == version and t["dependency_key"] == dependency_key
+                and traceHash(tree, t["paths"]) == t["values"]):
+
+                return t["local_key"], t["paths"]
+
+        return None
+
+    def record(self, name, version, dependency_key, tree, paths, local_key):
+        """
+        Records that the results of module `name` with local key
+        `local_key` were produced reading just `paths` of the local
+        branch `tree`.
+        """
+
+        t = {"version" : version,
+             "dependency_key" : dependency_key,
+             "paths" : sorted(paths),
+             "values" : traceHash(tree, paths),
+             "local_key" : local_key}
+
+        try:
+            if not isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    if not isdir(self.directory):
+                        raise
+
+            # Written in one call so concurrent appends don't mix
+            f = open(join(self.directory, name + ".log"), 'a')
+
+            try:
+                f.write(json.dumps(t, sort_keys = True) + "\n")
+            finally:
+                f.close()
+
+        except (IOError, OSError), e:
+            self.log.warning("Could not record the parameters read by %s: %s" % (name, str(e)))
+            return
+
+        t["paths"] = frozenset(paths)
+        self._load(name).insert(0, t)
@@ -0,0 +1,162 @@
+"""
+Writing results to the cache on background threads.  Saving a large
+result (pickling and bz2 compression) can take a long time; with
+write-behind enabled, the object is queued and the next module starts
+right away.  Until written, queued objects are served from the queue,
+and each file is written under a temporary name and renamed into
+place, so a cache entry only appears once it is complete.
+"""
+
+import os, threading, logging
+from os.path import exists
+from collections import deque
+from diskio import saveResults, temporaryFilename
+
+class WriteBehindQueue(object):
+    """
+    Writes cache files on `n_workers` background threads.  At most
+    `max_pending` objects wait in the queue; queueing more blocks
+    until one is written.
+    """
+
+    def __init__(self, opttree, n_workers, max_pending):
+        self.opttree = opttree
+        self.n_workers = n_workers
+        self.max_pending = max(1, max_pending)
+        self.log = logging.getLogger("RunCTRL")
+
+        self.condition = threading.Condition()
+
+        # filenames in the order queued, and filename -> object for
+        # everything not yet written (including ones being written)
+        self.queue = deque()
+        self.pending = {}
+
+        # (filename, error message) for writes that failed
+        self.errors = []
+
+        # filename -> on_written, for the same
+        self.callbacks = {}
+
+        self.threads = []
+        self.closed = False
+
+    def submit(self, filename, obj, on_written = None):
+        """
+        Queues `obj` to be written to `filename`.  If given,
+        `on_written(filename)` is called on the writing thread once
+        the file is in place.
+        """
+
+        with self.condition:
+            while len(self.pending) >= self.max_pending:
+                self.condition.wait()
+
+            if filename not in self.queue:
+                self.queue.append(filename)
+
+            self.pending[filename] = obj
+            self.callbacks[filename] = on_written
+
+            if len(self.threads) < self.n_workers:
+                t = threading.Thread(target = self._work, name = "lazyrunner-writer")
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+            self.condition.notify_all()
+
+    def lookup(self, filename):
+        """
+        Returns (True, obj) if `obj` is queued to be written to
+        `filename`, otherwise None.
+        """
+
+        with self.condition:
+            if filename in self.pending:
+                return True, self.pending[filename]
+            else:
+                return None
+
+    def flush(self):
+        """
+        Waits until everything queued has been written.  Returns the
+        list of (filename, error message) pairs for the writes that
+        failed since the last flush.
+        """
+
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+            errors, self.errors = self.errors, []
+
+        if errors:
+            self.log.warning("%d result(s) could not be written to the cache." % len(errors))
+
+        return errors
+
+    def close(self):
+        """
+        Flushes the queue and stops the background threads; the
+        queue can't be used after this.  Returns what flush() does.
+        """
+
+        errors = self.flush()
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        for t in self.threads:
+            t.join()
+
+        return errors
+
+    def _work(self):
+
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+
+                if not self.queue:
+                    return
+
+                filename = self.queue.popleft()
+                obj = self.pending[filename]
+                on_written = self.callbacks[filename]
+
+            self.log.debug("Writing %s." % filename)
+
+            temp_filename = temporaryFilename(filename)
+
+            try:
+                saveResults(self.opttree, temp_filename, obj)
+                os.rename(temp_filename, filename)
+                error = None
+
+                if on_written is not None:
+                    on_written(filename)
+
+            except Exception, e:
+                error = str(e)
+
+                self.log.error("Exception raised attempting to save object to cache: \n%s" % error)
+
+                try:
+                    if exists(temp_filename):
+                        os.remove(temp_filename)
+                except Exception:
+                    pass
+
+            with self.condition:
+                if error is not None:
+                    self.errors.append( (filename, error) )
+
+                # Unless it was queued again in the mean time
+                if filename not in self.queue:
+                    del self.pending[filename]
+                    del self.callbacks[filename]
+
+                self.condition.notify_all()
@@ -0,0 +1,10 @@
+import chains
+import hooks
+import sleepers
+import streaming
+import shards
+import resumable
+import same
+import traced
+import workers
+import sweep
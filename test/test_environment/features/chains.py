@@ -0,0 +1,39 @@
+from lazyrunner import pmodule, PModule, preset, defaults, Delta
+from treedict import TreeDict
+
+@pmodule
+class Chain(PModule):
+    """
+    Counts down to zero, each step depending on the results of the
+    step below it, so the graph is `depth` nodes deep.
+    """
+
+    p = defaults()
+    p.depth = 10
+
+    @preset
+    def setDepth(p, depth = 10):
+        p.depth = depth
+
+    version = 0.01
+
+    # The depths the dependencies were asked for, and those run
+    lookups = []
+    runs = []
+
+    @classmethod
+    def result_dependencies(cls, p):
+        cls.lookups.append(p.depth)
+
+        if p.depth > 0:
+            return [Delta('chain', local_delta = TreeDict(depth = p.depth - 1), name = 'below')]
+        else:
+            return []
+
+    def run(self):
+        Chain.runs.append(self.p.depth)
+
+        if self.p.depth == 0:
+            return 0
+        else:
+            return self.results.below + 1
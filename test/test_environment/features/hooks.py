@@ -0,0 +1,50 @@
+from lazyrunner import pmodule, PModule, preset, defaults
+from treedict import TreeDict
+
+@pmodule
+class Hooked(PModule):
+    """
+    Records each call of its parameter dependent hooks, which take
+    each of the signatures allowed.
+    """
+
+    p = defaults()
+    p.a = 1
+    p.scratch = 0
+
+    version = 0.01
+
+    calls = []
+
+    @preset
+    def setA(p, a = 1):
+        p.a = a
+
+    @preset
+    def setScratch(p, scratch = 0):
+        p.scratch = scratch
+
+    @classmethod
+    def preprocessParameters(cls, p):
+        cls.calls.append("preprocessParameters")
+        q = p.copy()
+        del q["scratch"]
+        return q
+
+    @staticmethod
+    def module_dependencies():
+        Hooked.calls.append("module_dependencies")
+        return []
+
+    @classmethod
+    def result_dependencies(cls, p):
+        cls.calls.append("result_dependencies")
+        return []
+
+    @classmethod
+    def disable_caching(cls, p, parameters):
+        cls.calls.append("disable_caching")
+        return False
+
+    def run(self):
+        return self.p.a * 10
@@ -0,0 +1,34 @@
+from lazyrunner import pmodule, PModule, preset, defaults
+from treedict import TreeDict
+
+@pmodule
+class Resumable(PModule):
+    """
+    Squares the numbers below `n`, checkpointing after each one;
+    fails at `fail_at` if that is set.
+    """
+
+    p = defaults()
+    p.n = 6
+
+    version = 0.01
+
+    fail_at = None
+    starts = []
+
+    @preset
+    def setN(p, n = 6):
+        p.n = n
+
+    def run(self):
+        start, values = self.restoreCheckpoint((0, []))
+        Resumable.starts.append(start)
+
+        for i in xrange(start, self.p.n):
+            if i == Resumable.fail_at:
+                raise RuntimeError("Failing at %d." % i)
+
+            values.append(i * i)
+            self.checkpoint((i + 1, values))
+
+        return TreeDict(squares = values)
@@ -0,0 +1,38 @@
+from lazyrunner import pmodule, PModule, preset, defaults, Delta
+from treedict import TreeDict
+
+@pmodule
+class Same(PModule):
+    """
+    Gives the same results whatever `y` is, so the results for
+    different values are identical files in the cache.
+    """
+
+    p = defaults()
+    p.y = 1
+
+    version = 0.01
+
+    @preset
+    def setY(p, y = 1):
+        p.y = y
+
+    def run(self):
+        return TreeDict(numbers = range(100))
+
+@pmodule
+class UsesSame(PModule):
+    """
+    Depends on the results of Same for two values of `y`; its own
+    aren't cached, so they are loaded from there each time.
+    """
+
+    version = 0.01
+
+    disable_result_caching = True
+
+    result_dependencies = [Delta('same', local_delta = TreeDict(y = 1), name = 'one'),
+                           Delta('same', local_delta = TreeDict(y = 2), name = 'two')]
+
+    def run(self):
+        return sum(self.results.one.numbers) + sum(self.results.two.numbers)
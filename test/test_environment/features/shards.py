@@ -0,0 +1,64 @@
+from lazyrunner import pmodule, PModule, preset, defaults
+
+@pmodule
+class Source(PModule):
+    """
+    One shard per value in `xs`.
+    """
+
+    p = defaults()
+    p.xs = [1, 2, 3, 4]
+
+    version = 0.01
+
+    calls = []
+
+    @preset
+    def setXs(p, *xs):
+        p.xs = list(xs)
+
+    @classmethod
+    def partitions(cls, p):
+        return len(p.xs)
+
+    @classmethod
+    def partition_keys(cls, p):
+        return p.xs
+
+    def runPartition(self, i):
+        Source.calls.append(i)
+        return [self.p.xs[i]] * 3
+
+@pmodule
+class Double(PModule):
+    """
+    Doubles each shard of Source.
+    """
+
+    p = defaults()
+
+    version = 0.01
+
+    partitions = 4
+    result_dependencies = ['source']
+
+    calls = []
+
+    def runPartition(self, i):
+        Double.calls.append(i)
+        return [2 * x for x in self.results.source[i]]
+
+@pmodule
+class Total(PModule):
+    """
+    Sums all the shards of Double.
+    """
+
+    p = defaults()
+
+    version = 0.01
+
+    result_dependencies = ['double']
+
+    def run(self):
+        return sum(sum(s) for s in self.results.double)
@@ -0,0 +1,106 @@
+from lazyrunner import pmodule, PModule, preset, defaults, Delta
+from treedict import TreeDict
+import time
+
+@pmodule
+class Sleeper(PModule):
+    """
+    Sleeps for `seconds`, stopping early if cancelled, and returns its
+    index; fails at once if the index is `fail_index`.
+    """
+
+    p = defaults()
+    p.seconds = 0.0
+    p.index = 0
+
+    version = 0.01
+
+    # The indices run
+    runs = []
+
+    fail_index = None
+
+    def run(self):
+        Sleeper.runs.append(self.p.index)
+
+        if self.p.index == Sleeper.fail_index:
+            raise RuntimeError("Failing at %d." % self.p.index)
+
+        end_time = time.time() + self.p.seconds
+
+        while time.time() < end_time:
+            self.checkCancelled()
+            time.sleep(min(0.01, max(0, end_time - time.time())))
+
+        return self.p.index
+
+@pmodule
+class Fan(PModule):
+    """
+    Sums the results of `width` independent sleepers.
+    """
+
+    p = defaults()
+    p.width = 4
+    p.seconds = 0.0
+
+    version = 0.01
+
+    @preset
+    def wide(p, width = 4, seconds = 0.0):
+        p.width = width
+        p.seconds = seconds
+
+    @classmethod
+    def result_dependencies(cls, p):
+        return [Delta('sleeper', local_delta = TreeDict(index = i, seconds = p.seconds),
+                      name = 'r%d' % i)
+                for i in xrange(p.width)]
+
+    def run(self):
+        return sum(self.results['r%d' % i] for i in xrange(self.p.width))
+
+@pmodule
+class Waiter(PModule):
+    """
+    Waits for `seconds` as though on an external program, and returns
+    its index.
+    """
+
+    p = defaults()
+    p.seconds = 0.0
+    p.index = 0
+
+    version = 0.01
+
+    io_bound = True
+
+    def run(self):
+        time.sleep(self.p.seconds)
+        return self.p.index
+
+@pmodule
+class WaitFan(PModule):
+    """
+    Sums the results of `width` independent waiters.
+    """
+
+    p = defaults()
+    p.width = 4
+    p.seconds = 0.0
+
+    version = 0.01
+
+    @preset
+    def wide(p, width = 4, seconds = 0.0):
+        p.width = width
+        p.seconds = seconds
+
+    @classmethod
+    def result_dependencies(cls, p):
+        return [Delta('waiter', local_delta = TreeDict(index = i, seconds = p.seconds),
+                      name = 'r%d' % i)
+                for i in xrange(p.width)]
+
+    def run(self):
+        return sum(self.results['r%d' % i] for i in xrange(self.p.width))
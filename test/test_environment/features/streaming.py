@@ -0,0 +1,31 @@
+from lazyrunner import pmodule, PModule, preset, defaults
+
+@pmodule
+class Counter(PModule):
+    """
+    Yields the numbers below `n`, one chunk each.
+    """
+
+    p = defaults()
+    p.n = 5
+
+    version = 0.01
+
+    def run(self):
+        for i in xrange(self.p.n):
+            yield i
+
+@pmodule
+class CounterSum(PModule):
+    """
+    Sums the chunks streamed by Counter.
+    """
+
+    p = defaults()
+
+    version = 0.01
+
+    result_dependencies = ['counter']
+
+    def run(self):
+        return sum(self.results.counter)
@@ -0,0 +1,50 @@
+from lazyrunner import pmodule, PModule, preset, defaults, Delta
+from treedict import TreeDict
+from numpy import array
+
+@pmodule
+class Point(PModule):
+    """
+    Squares `x`, producing the squares of several values at once.
+    """
+
+    p = defaults()
+    p.x = 0
+
+    version = 0.01
+
+    vectorize_over = ['x']
+
+    # The number of points in each call of runBatch, 1 for run()
+    batches = []
+
+    def run(self):
+        Point.batches.append(1)
+        return self.p.x ** 2
+
+    def runBatch(self, points):
+        Point.batches.append(len(points))
+        return array([pt.x for pt in points]) ** 2
+
+@pmodule
+class Sweep(PModule):
+    """
+    Adds up the squares of the numbers below `n`.
+    """
+
+    p = defaults()
+    p.n = 4
+
+    version = 0.01
+
+    @preset
+    def setN(p, n = 4):
+        p.n = n
+
+    @classmethod
+    def result_dependencies(cls, p):
+        return [Delta('point', local_delta = TreeDict(x = i), name = 'x%d' % i)
+                for i in xrange(p.n)]
+
+    def run(self):
+        return sum(self.results['x%d' % i] for i in xrange(self.p.n))
@@ -0,0 +1,35 @@
+from lazyrunner import pmodule, PModule, preset, defaults
+from treedict import TreeDict
+
+@pmodule
+class Traced(PModule):
+    """
+    Reads only `a`, unless `read_other` is set, caching what it
+    returns as the object 'total' too.
+    """
+
+    p = defaults()
+    p.a = 1
+    p.other = 0
+
+    version = 0.01
+
+    trace_parameters = True
+
+    read_other = False
+    runs = []
+
+    @preset
+    def setOther(p, other = 0):
+        p.other = other
+
+    def run(self):
+        Traced.runs.append(self.p.a)
+
+        def total():
+            if Traced.read_other:
+                return self.p.a + self.p.other
+            else:
+                return self.p.a
+
+        return self.loadFromCache("total", creation_function = total)
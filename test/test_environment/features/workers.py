@@ -0,0 +1,21 @@
+from lazyrunner import pmodule, PModule, preset, defaults
+from treedict import TreeDict
+from numpy import arange
+import os
+
+@pmodule
+class InProcess(PModule):
+    """
+    Returns an array of `n` numbers and the pid of the process run()
+    was called in.
+    """
+
+    p = defaults()
+    p.n = 100000
+
+    version = 0.01
+
+    run_in_process = True
+
+    def run(self):
+        return TreeDict(numbers = arange(self.p.n), pid = os.getpid())
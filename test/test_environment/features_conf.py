@@ -0,0 +1,11 @@
+
+from lazyrunner import configTree
+
+config = configTree()
+
+# The configuration of the copies of this directory the tests in
+# ProjectTestCase run on; unlike conf.py, it leaves the cache
+# directory and the other options to the ones each test gives.
+
+config.import_list  = []
+config.auto_import  = True
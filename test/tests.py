@@ -1,7 +1,32 @@
-from lazyrunner import manager, initialize, reset, PCall
+from lazyrunner import manager, initialize, reset, PCall, PModule, pmodule
+from lazyrunner.pmodule import pmodulebase
+from lazyrunner.pmodule import getPModuleClass
+from lazyrunner.planning import formatPlan, loadGraphPlan, formatSize, formatTime
+from lazyrunner.progress import ProgressTracker, min_interval
+from lazyrunner.scheduling import CriticalPathScheduler, upwardRanks, estimateCosts
+from lazyrunner.prefetch import Prefetcher
+from lazyrunner.writebehind import WriteBehindQueue
+from lazyrunner.diskio import loadResults
+from lazyrunner.tracing import TracingTree
+from lazyrunner.exceptions import CancelledError
+from lazyrunner.processes import runInProcess
+from lazyrunner import diskio, streams, writebehind, pnstructures, ResultStream, ModuleCancelled, ModuleTimeout
+from lazyrunner.parameters import getParameterTree, completePreset, presets
+from lazyrunner.parameters.presets import parsePreset
+from lazyrunner.parameters.presetindex import PresetIndex, editDistance
+from lazyrunner.cachebackends import HTTPBackend
+from lazyrunner.cacheindex import VersionIndex
+from lazyrunner.cacheserver import CacheServer
 from treedict import TreeDict
-from os.path import exists, join
+from os.path import exists, join, abspath, getsize
+from os import listdir, walk, remove, stat, makedirs, getpid
+from numpy import arange
 import shutil
+import logging
+import tempfile
+import threading
+import time
+import sys
 import unittest
 
 
@@ -44,8 +69,58 @@ def runTest(preset_list, module, test_tree):
     test(opttree)
     
     shutil.rmtree(opttree.cache_directory, ignore_errors = True)
-    
-    
+
+
+class ProjectTestCase(unittest.TestCase):
+    """
+    Runs each test on its own copy of the test environment, with a
+    cache in a temporary directory shared by the managers the test
+    creates.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.project_directory = join(self.directory, "project")
+        self.cache_directory = join(self.directory, "cache")
+
+        shutil.copytree(project_directory, self.project_directory,
+                        ignore = shutil.ignore_patterns(".cache", "*.pyc"))
+
+    def tearDown(self):
+        reset()
+        self.forgetModules()
+        shutil.rmtree(self.directory, ignore_errors = True)
+
+    def forgetModules(self):
+        # Drops the project modules imported, here or by the tests
+        # run on the original environment, so the next manager imports
+        # them again and they are registered again.
+
+        bases = [abspath(self.project_directory), abspath(project_directory)]
+
+        for k, m in sys.modules.items():
+            filename = getattr(m, "__file__", None)
+
+            if filename is not None and any(abspath(filename).startswith(b) for b in bases):
+                del sys.modules[k]
+
+    def newManager(self, **options):
+        # Returns a new manager for the project, as a fresh session
+        # would get.
+
+        reset()
+        self.forgetModules()
+
+        opttree = TreeDict.fromdict(options)
+        opttree.project_directory = self.project_directory
+        opttree.setdefault("cache_directory", self.cache_directory)
+        opttree.setdefault("config_file", "features_conf")
+
+        initialize(opttree)
+
+        return manager()
+
+
 class TestBasic(unittest.TestCase):
     
     
@@ -131,7 +206,1261 @@ class TestBasic(unittest.TestCase):
 
     def test23(self):
         runTest([('process.returnvalue', ['a'])], 'process', 1)
-        
-        
+
+
+class TestDeepGraphs(ProjectTestCase):
+
+    def testChainDeeperThanRecursionLimit(self):
+        depth = sys.getrecursionlimit() + 500
+
+        m = self.newManager()
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:%d' % depth])['chain'], depth)
+        self.assertEqual(sorted(getPModuleClass("chain").runs), range(depth + 1))
+
+        # And again from the cache, running nothing
+        m = self.newManager()
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:%d' % depth])['chain'], depth)
+        self.assertEqual(getPModuleClass("chain").runs, [])
+
+        # One step deeper runs only the top
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:%d' % (depth + 1)])['chain'], depth + 1)
+        self.assertEqual(getPModuleClass("chain").runs, [depth + 1])
+
+    def testChainWithoutCache(self):
+        m = self.newManager(cache_directory = None)
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:50'])['chain'], 50)
+        self.assertEqual(sorted(getPModuleClass("chain").runs), range(51))
+
+
+class TestHooks(ProjectTestCase):
+
+    def testHookResultsMemoized(self):
+        m = self.newManager(cache_directory = None)
+        calls = getPModuleClass("hooked").calls
+
+        self.assertEqual(m.getResults(['hooked'], ['hooked.setA:2'])['hooked'], 20)
+
+        for hook in ["preprocessParameters", "module_dependencies",
+                     "result_dependencies", "disable_caching"]:
+            self.assert_(hook in calls, hook)
+
+        n_calls = len(calls)
+
+        self.assertEqual(m.getResults(['hooked'], ['hooked.setA:2'])['hooked'], 20)
+        self.assertEqual(len(calls), n_calls)
+
+        self.assertEqual(m.getResults(['hooked'], ['hooked.setA:3'])['hooked'], 30)
+        self.assert_(len(calls) > n_calls)
+
+    def testHooksResolvedAtRegistration(self):
+        self.newManager(cache_directory = None)
+        signatures = getPModuleClass("hooked")._getHookSignatures()
+
+        self.assertEqual(signatures["preprocessParameters"], 1)
+        self.assertEqual(signatures["module_dependencies"], 0)
+        self.assertEqual(signatures["result_dependencies"], 1)
+        self.assertEqual(signatures["disable_caching"], 2)
+
+    def testLeastRecentlyUsedDropped(self):
+        m = self.newManager(cache_directory = None)
+        hooked = getPModuleClass("hooked")
+
+        def run(a):
+            m.getResults(['hooked'], ['hooked.setA:%d' % a])
+
+        run(2)
+        run(3)
+
+        memo_size = pmodulebase._hook_memo_size
+        pmodulebase._hook_memo_size = len(hooked._hook_memo)
+
+        try:
+            # The memo is full; using 2 again makes 3 the oldest,
+            # which is dropped for 4 while 2 is kept.
+            run(2)
+            run(4)
+
+            n_calls = len(hooked.calls)
+            run(2)
+            self.assertEqual(len(hooked.calls), n_calls)
+
+            run(3)
+            self.assert_(len(hooked.calls) > n_calls)
+        finally:
+            pmodulebase._hook_memo_size = memo_size
+
+    def testVectorizeOverNeedsRunBatch(self):
+        self.newManager(cache_directory = None)
+
+        class NoRunBatch(PModule):
+            vectorize_over = "x"
+
+        self.assertRaises(TypeError, lambda: pmodule(NoRunBatch))
+
+
+class TestGraphPlans(ProjectTestCase):
+
+    def newManager(self, **options):
+        options.setdefault("cache_graph_plans", True)
+        return ProjectTestCase.newManager(self, **options)
+
+    def testPlanSkipsBuildingGraph(self):
+        m = self.newManager()
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:20'])['chain'], 20)
+        self.assertEqual(len(getPModuleClass("chain").lookups), 21)
+        self.assert_(len(listdir(join(self.cache_directory, "__plans__"))) == 1)
+
+        m = self.newManager()
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:20'])['chain'], 20)
+        self.assert_(len(getPModuleClass("chain").lookups) <= 1)
+
+    def testPlanIgnoredWithoutResults(self):
+        m = self.newManager()
+        m.getResults(['chain'], ['chain.setDepth:5'])
+
+        for dirpath, dirnames, filenames in walk(join(self.cache_directory, "chain")):
+            for fn in filenames:
+                remove(join(dirpath, fn))
+
+        m = self.newManager()
+        self.assertEqual(m.getResults(['chain'], ['chain.setDepth:5'])['chain'], 5)
+        self.assertEqual(len(getPModuleClass("chain").lookups), 6)
+
+    def testPlansDisabled(self):
+        m = self.newManager(cache_graph_plans = False)
+        m.getResults(['chain'], ['chain.setDepth:5'])
+        self.failIf(exists(join(self.cache_directory, "__plans__")))
+
+    def testPlansOffByDefault(self):
+        m = ProjectTestCase.newManager(self)
+        m.getResults(['chain'], ['chain.setDepth:5'])
+        self.failIf(exists(join(self.cache_directory, "__plans__")))
+
+    def testPlanHoldsRoots(self):
+        m = self.newManager()
+        m.getResults(['chain', 'same'], ['chain.setDepth:5'])
+
+        plan_directory = join(self.cache_directory, "__plans__")
+        plan = loadGraphPlan(self.cache_directory, listdir(plan_directory)[0][:-len(".plan")])
+
+        self.assertEqual([name for name, key in plan.roots], ['chain', 'same'])
+        self.assertEqual(sorted(plan.nodes), sorted(key for name, key in plan.roots))
+        self.assertEqual(sorted(plan.versions), ['chain', 'same'])
+
+
+class TestPlanning(ProjectTestCase):
+
+    def testPlanBeforeAndAfterRun(self):
+        m = self.newManager()
+
+        entries = m.plan(['chain'], ['chain.setDepth:3'])
+        self.assertEqual([(e.name, e.status, e.depth) for e in entries],
+                         [('chain', 'compute', d) for d in xrange(4)])
+        self.assert_(all(e.estimated_time is None for e in entries))
+
+        m.getResults(['chain'], ['chain.setDepth:3'])
+
+        entries = m.plan(['chain'], ['chain.setDepth:3'])
+        self.assertEqual([e.status for e in entries], ['disk'])
+        self.assert_(entries[0].size > 0)
+
+        # One step deeper is computed on top of the cached results, in
+        # about the time the others took
+        entries = m.plan(['chain'], ['chain.setDepth:4'])
+        self.assertEqual([e.status for e in entries], ['compute', 'disk'])
+        self.assert_(entries[0].estimated_time is not None)
+
+        self.assert_(formatPlan(entries)[-1].startswith("1 from disk"))
+
+    def testPlanRunsNothing(self):
+        m = self.newManager()
+
+        chain = getPModuleClass("chain")
+        chain_run = chain.run
+        runs = []
+
+        def run(self):
+            runs.append(self.p.depth)
+            return chain_run(self)
+
+        chain.run = run
+
+        def cacheFiles():
+            return [join(dirpath, fn) for dirpath, dirnames, filenames
+                    in walk(self.cache_directory) for fn in filenames]
+
+        m.plan(['chain'], ['chain.setDepth:3'])
+        self.assertEqual([e.status for e in m.plan(['chain'], ['chain.setDepth:3'])], ['compute'] * 4)
+
+        self.assertEqual(runs, [])
+        self.assertEqual(cacheFiles(), [])
+
+        m.getResults(['chain'], ['chain.setDepth:3'])
+
+        self.assertEqual(sorted(runs), [0, 1, 2, 3])
+        self.assert_(cacheFiles())
+
+
+class TestScheduling(ProjectTestCase):
+
+    def testUpwardRanks(self):
+        ranks = upwardRanks({'a' : [], 'b' : ['a'], 'c' : ['b'], 'd' : []},
+                            {'a' : 1, 'b' : 1, 'c' : 1, 'd' : 2})
+
+        self.assertEqual(ranks, {'a' : 3, 'b' : 2, 'c' : 1, 'd' : 2})
+
+    def testLongestPathStartedFirst(self):
+        started = []
+
+        def dispatch(n):
+            started.append(n)
+
+        dependencies = {'short' : [], 'x1' : [], 'x2' : ['x1'], 'x3' : ['x2']}
+        costs = estimateCosts(dependencies, lambda n: None)
+
+        CriticalPathScheduler(1, threading.Condition()).run(
+            dependencies, costs, dispatch, None)
+
+        self.assertEqual(started, ['x1', 'x2', 'x3', 'short'])
+
+    def testParallelWorkers(self):
+        m = self.newManager(parallel_workers = 4)
+
+        start_time = time.time()
+        self.assertEqual(m.getResults(['fan'], [PCall('fan.wide', 4, 0.3)])['fan'], 6)
+        self.assert_(time.time() - start_time < 0.9)
+
+
+class TestPrefetch(ProjectTestCase):
+
+    def resultFiles(self, name):
+        d = join(self.cache_directory, name, "__results__")
+        return sorted(join(d, fn) for fn in listdir(d))
+
+    def testPrefetchOffByDefault(self):
+        self.assertEqual(self.newManager().opttree.prefetch_workers, 0)
+
+    def waitForLoaded(self, prefetcher, n):
+        end_time = time.time() + 10
+
+        while len(prefetcher.loaded) < n and time.time() < end_time:
+            time.sleep(0.01)
+
+    def testLoadsInBackground(self):
+        m = self.newManager()
+        m.getResults(['fan'], ['fan.wide:4'])
+
+        files = self.resultFiles("sleeper")
+        self.assertEqual(len(files), 4)
+
+        prefetcher = Prefetcher(m.opttree, 2, 2**20)
+        prefetcher.start([(fn, getsize(fn)) for fn in files])
+        self.waitForLoaded(prefetcher, 4)
+
+        loaded = [prefetcher.take(fn) for fn in files]
+        self.assertEqual(sorted(loaded), [(True, i) for i in xrange(4)])
+        self.assert_(prefetcher.isIdle())
+
+    def testMemoryLimit(self):
+        m = self.newManager()
+        m.getResults(['fan'], ['fan.wide:4'])
+
+        files = self.resultFiles("sleeper")
+
+        # A limit below the size of any file lets one through at a time
+        prefetcher = Prefetcher(m.opttree, 2, 1)
+        prefetcher.start([(fn, getsize(fn)) for fn in files])
+        self.waitForLoaded(prefetcher, 1)
+        time.sleep(0.1)
+
+        self.assertEqual(len(prefetcher.loaded), 1)
+        self.assertEqual(len(prefetcher.pending), 3)
+
+        prefetcher.take(prefetcher.loaded.keys()[0])
+        self.waitForLoaded(prefetcher, 1)
+        self.assertEqual(len(prefetcher.pending), 2)
+
+        prefetcher.cancel()
+        self.assert_(prefetcher.isIdle())
+
+    def testResultsWithPrefetch(self):
+        m = self.newManager()
+        m.getResults(['fan'], ['fan.wide:4'])
+
+        files = self.resultFiles("sleeper")
+
+        start, take = Prefetcher.start, Prefetcher.take
+        started = []
+        taken = []
+
+        def recordStart(prefetcher, file_list):
+            started.extend(fn for fn, size in file_list)
+            return start(prefetcher, file_list)
+
+        def recordTake(prefetcher, filename):
+            # Waits for the load to start, so the results always come
+            # from the prefetcher
+            end_time = time.time() + 10
+
+            while filename in prefetcher.pending_set and time.time() < end_time:
+                time.sleep(0.01)
+
+            r = take(prefetcher, filename)
+
+            if r is not None and r[0]:
+                taken.append(filename)
+
+            return r
+
+        Prefetcher.start = recordStart
+        Prefetcher.take = recordTake
+
+        try:
+            m = self.newManager(prefetch_workers = 2)
+            self.assertEqual(m.getResults(['fan'], ['fan.wide:6'])['fan'], 15)
+        finally:
+            Prefetcher.start = start
+            Prefetcher.take = take
+
+        # Only the cached results were prefetched, and all were used
+        self.assertEqual(sorted(started), files)
+        self.assertEqual(sorted(taken), files)
+
+
+class TestWriteBehind(ProjectTestCase):
+
+    def testQueueServesUnwritten(self):
+        m = self.newManager()
+
+        filename = join(self.directory, "x.dat")
+        written = []
+
+        queue = WriteBehindQueue(m.opttree, 1, 4)
+        queue.submit(filename, TreeDict(x = 1), written.append)
+
+        ret = queue.lookup(filename)
+        self.assert_(ret is None or ret == (True, TreeDict(x = 1)))
+
+        self.assertEqual(queue.close(), [])
+        self.assertEqual(written, [filename])
+        self.assertEqual(queue.lookup(filename), None)
+        self.assertEqual(loadResults(m.opttree, filename), TreeDict(x = 1))
+
+    def testResultsWrittenBehind(self):
+        m = self.newManager(write_behind_workers = 2, write_behind_queue_size = 1)
+        self.assertEqual(m.getResults(['fan'], ['fan.wide:4'])['fan'], 6)
+        self.assertEqual(m.flush(), [])
+
+        m = self.newManager()
+        self.assertEqual(sorted(e.status for e in m.plan(['fan'], ['fan.wide:5'])),
+                         ['compute'] * 2 + ['disk'] * 4)
+
+
+class TestStreaming(ProjectTestCase):
+
+    def testStreamedResults(self):
+        m = self.newManager()
+        r = m.getResults(['counter', 'countersum'])
+
+        self.assert_(isinstance(r['counter'], ResultStream))
+        self.assertEqual(list(r['counter']), range(5))
+        self.assertEqual(r['countersum'], 10)
+
+        # Both come back from the cache
+        m = self.newManager()
+        self.assertEqual(sorted(e.status for e in m.plan(['counter', 'countersum'])), ['disk', 'disk'])
+
+        r = m.getResults(['counter', 'countersum'])
+        self.assertEqual(list(r['counter']), range(5))
+        self.assertEqual(r['countersum'], 10)
+
+    def testOrdinaryResultsNotCheckedForStreams(self):
+        m = self.newManager()
+        m.getResults(['countersum'])
+
+        checked = []
+
+        def isStreamFile(filename):
+            checked.append(filename)
+            return streams.isStreamFile(filename)
+
+        diskio.isStreamFile = isStreamFile
+
+        try:
+            m = self.newManager()
+            self.assertEqual(m.getResults(['counter', 'countersum'])['countersum'], 10)
+        finally:
+            diskio.isStreamFile = streams.isStreamFile
+
+        self.assertEqual(len(checked), 1)
+        self.assert_("/counter/" in checked[0])
+
+
+class TestPartitions(ProjectTestCase):
+
+    def testShardsReused(self):
+        m = self.newManager()
+        r = m.getResults(['total', 'double'])
+
+        self.assertEqual(r['total'], 60)
+        self.assertEqual(list(r['double'])[2], [6, 6, 6])
+        self.assertEqual(sorted(getPModuleClass("source").calls), [0, 1, 2, 3])
+        self.assertEqual(sorted(getPModuleClass("double").calls), [0, 1, 2, 3])
+
+        # Changing one value recomputes only its shard downstream
+        m = self.newManager()
+        r = m.getResults(['total', 'double'], [PCall('source.setXs', 1, 2, 9, 4)])
+
+        self.assertEqual(r['total'], 96)
+        self.assertEqual(list(r['double'])[2], [18, 18, 18])
+        self.assertEqual(getPModuleClass("source").calls, [2])
+        self.assertEqual(getPModuleClass("double").calls, [2])
+
+    def testShardsWithoutCache(self):
+        m = self.newManager(cache_directory = None)
+        self.assertEqual(m.getResults(['total'], [PCall('source.setXs', 1, 1, 1, 1)])['total'], 24)
+
+
+class TestCheckpoints(ProjectTestCase):
+
+    def checkpoints(self):
+        d = join(self.cache_directory, "resumable", "__checkpoint__")
+        return listdir(d) if exists(d) else []
+
+    def testResumeAfterFailure(self):
+        m = self.newManager()
+        getPModuleClass("resumable").fail_at = 3
+
+        self.assertRaises(RuntimeError, lambda: m.getResults(['resumable']))
+        self.assertEqual(len(self.checkpoints()), 1)
+
+        m = self.newManager()
+        self.assertEqual(m.getResults(['resumable'])['resumable'].squares, [0, 1, 4, 9, 16, 25])
+        self.assertEqual(getPModuleClass("resumable").starts, [3])
+
+        # Done with once the results are in
+        self.assertEqual(self.checkpoints(), [])
+
+    def testWithoutCache(self):
+        m = self.newManager(cache_directory = None)
+        self.assertEqual(m.getResults(['resumable'])['resumable'].squares, [0, 1, 4, 9, 16, 25])
+
+    def failFirstRun(self):
+        m = self.newManager()
+        getPModuleClass("resumable").fail_at = 3
+
+        self.assertRaises(RuntimeError, lambda: m.getResults(['resumable']))
+        self.assertEqual(len(self.checkpoints()), 1)
+
+    def testKeptUntilWrittenBehind(self):
+        self.failFirstRun()
+
+        save = writebehind.saveResults
+        release = threading.Event()
+
+        def slowSave(opttree, filename, obj):
+            release.wait(10)
+            return save(opttree, filename, obj)
+
+        writebehind.saveResults = slowSave
+
+        try:
+            m = self.newManager(write_behind_workers = 1)
+            self.assertEqual(m.getResults(['resumable'])['resumable'].squares, [0, 1, 4, 9, 16, 25])
+
+            # The results are only queued, so it's still needed
+            self.assertEqual(len(self.checkpoints()), 1)
+
+            release.set()
+            self.assertEqual(m.flush(), [])
+        finally:
+            release.set()
+            writebehind.saveResults = save
+
+        self.assertEqual(self.checkpoints(), [])
+
+    def testKeptIfSaveFails(self):
+        self.failFirstRun()
+
+        save = pnstructures.saveResults
+
+        def failingSave(opttree, filename, obj):
+            raise IOError("No space left on device")
+
+        pnstructures.saveResults = failingSave
+
+        try:
+            m = self.newManager()
+            self.assertEqual(m.getResults(['resumable'])['resumable'].squares, [0, 1, 4, 9, 16, 25])
+        finally:
+            pnstructures.saveResults = save
+
+        self.assertEqual(len(self.checkpoints()), 1)
+
+
+class TestCacheBackends(ProjectTestCase):
+
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+
+        self.server = CacheServer(join(self.directory, "store"))
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        ProjectTestCase.tearDown(self)
+
+    def testDefaultsToLocalHost(self):
+        self.assertEqual(self.server.server_address[0], "127.0.0.1")
+
+    def testHTTPRoundTrip(self):
+        b = HTTPBackend(self.server.url)
+
+        try:
+            b.put("a/x", "abc")
+            self.assertEqual(b.get("a/x"), "abc")
+            self.assertEqual(b.probe("a/x"), 3)
+            self.assertEqual(b.probe("a/y"), None)
+            self.assertEqual(b.probeMany(["a/x", "a/y"]), [3, None])
+
+            filename = join(self.directory, "upload")
+
+            with open(filename, 'wb') as f:
+                f.write("z" * 200000)
+
+            with open(filename, 'rb') as f:
+                b.putFile("b/y", f)
+
+            self.assertEqual(b.get("b/y"), "z" * 200000)
+            self.assertEqual(b.list(), ["a/x", "b/y"])
+            self.assertEqual(b.list("b/"), ["b/y"])
+
+            self.assertTrue(b.delete("a/x"))
+            self.assertFalse(b.delete("a/x"))
+            self.assertRaises(KeyError, lambda: b.get("a/x"))
+        finally:
+            b.close()
+
+    def testSharedThroughServer(self):
+        m = self.newManager(cache_backend = self.server.url)
+        getPModuleClass("resumable").starts = []
+        self.assertEqual(m.getResults(['resumable'])['resumable'].squares, [0, 1, 4, 9, 16, 25])
+        self.assertEqual(getPModuleClass("resumable").starts, [0])
+
+        # Another machine, with its own cache directory, gets them
+        # from the server; read only clients too.
+
+        for read_only in [False, True]:
+            m = self.newManager(cache_backend = self.server.url,
+                                cache_directory = join(self.directory, "other-%s" % read_only),
+                                cache_read_only = read_only)
+
+            getPModuleClass("resumable").starts = []
+            self.assertEqual(m.getResults(['resumable'])['resumable'].squares, [0, 1, 4, 9, 16, 25])
+            self.assertEqual(getPModuleClass("resumable").starts, [])
+
+    def testReadOnlyDoesNotPublish(self):
+        m = self.newManager(cache_backend = self.server.url, cache_read_only = True)
+        m.getResults(['resumable'])
+
+        self.assertEqual(HTTPBackend(self.server.url).list(), [])
+
+
+class TestDeduplication(ProjectTestCase):
+
+    def cacheFiles(self):
+        ret = []
+
+        for d, dirs, files in walk(join(self.cache_directory, "same")):
+            ret += [join(d, f) for f in files]
+
+        return sorted(ret)
+
+    def runSame(self, **options):
+        m = self.newManager(**options)
+
+        for y in [1, 2]:
+            self.assertEqual(m.getResults(['same'], [PCall('same.setY', y)])['same'].numbers, range(100))
+
+    def testIdenticalResultsStoredOnce(self):
+        self.runSame(cache_deduplication = True)
+
+        files = self.cacheFiles()
+        self.assertEqual(len(files), 2)
+        self.assertEqual(stat(files[0]).st_ino, stat(files[1]).st_ino)
+
+        # Still loaded from where they were
+        self.runSame(cache_deduplication = True)
+
+    def testOffByDefault(self):
+        self.runSame()
+
+        files = self.cacheFiles()
+        self.assertEqual(len(files), 2)
+        self.assertNotEqual(stat(files[0]).st_ino, stat(files[1]).st_ino)
+        self.assertFalse(exists(join(self.cache_directory, "__content__")))
+
+
+class TestBundles(ProjectTestCase):
+
+    def testRoundTripWithDuplicates(self):
+        bundle = join(self.directory, "bundle.tar.gz")
+
+        m = self.newManager(cache_deduplication = True)
+        self.assertEqual(m.getResults(['usessame'])['usessame'], 9900)
+
+        keys = m.exportCache(bundle, ['usessame'])
+        self.assertEqual(len(keys), 2)
+
+        # Into a fresh cache, deduplicating again there
+        m = self.newManager(cache_directory = join(self.directory, "other"),
+                            cache_deduplication = True)
+
+        self.assertEqual(sorted(m.importCache(bundle)), sorted(keys))
+        self.assertEqual(m.getResults(['usessame'])['usessame'], 9900)
+
+        # A second import finds everything there already
+        self.assertEqual(m.importCache(bundle), [])
+
+
+class TestPruning(ProjectTestCase):
+
+    def resultFiles(self, directory, name):
+        ret = []
+
+        for d, dirs, files in walk(join(directory, name)):
+            ret += [join(d, f) for f in files]
+
+        return ret
+
+    def runWithNewVersion(self, **options):
+        # Caches the results of resumable and same, then starts again
+        # with resumable one version on.
+
+        m = self.newManager(**options)
+        m.getResults(['resumable', 'same'])
+
+        m = self.newManager(**options)
+        getPModuleClass("resumable").version = 0.02
+
+        return m
+
+    def testPruneStale(self):
+        m = self.runWithNewVersion()
+        old = self.resultFiles(self.cache_directory, "resumable")
+        self.assertEqual(len(old), 1)
+        size = getsize(old[0])
+
+        self.assertEqual(m.pruneStaleCache(), (1, size))
+
+        self.assertEqual(self.resultFiles(self.cache_directory, "resumable"), [])
+        self.assertEqual(len(self.resultFiles(self.cache_directory, "same")), 1)
+
+        # Nothing more to do
+        self.assertEqual(m.pruneStaleCache(), (0, 0))
+
+    def testPruneToArchive(self):
+        archive = join(self.directory, "archive")
+        m = self.runWithNewVersion(cache_prune_archive = archive)
+
+        self.assertEqual(m.pruneStaleCache()[0], 1)
+        self.assertEqual(self.resultFiles(self.cache_directory, "resumable"), [])
+        self.assertEqual(len(self.resultFiles(archive, "resumable")), 1)
+
+    def testRecordDuringPruneKept(self):
+        self.runWithNewVersion()
+
+        index = VersionIndex(join(self.cache_directory, "__versions__"))
+        log_filename = index._logFilename("resumable/x")
+
+        key = "resumable/__results__/new.dat"
+        open(join(self.cache_directory, *key.split("/")), 'w').close()
+
+        read = index._read
+
+        def readThenRecord(filename):
+            # Another process records an entry once prune has read the
+            # log, before it's rewritten
+            records = read(filename)
+
+            if filename == log_filename and key not in records:
+                index.record(key, {"resumable" : "0.02"})
+
+            return records
+
+        index._read = readThenRecord
+        self.assertEqual(index.prune(self.cache_directory, {"resumable" : "0.02"})[0], 1)
+
+        self.assertEqual(read(log_filename).keys(), [key])
+
+
+class TestTracing(ProjectTestCase):
+
+    def files(self, *path):
+        ret = []
+
+        for d, dirs, files in walk(join(self.cache_directory, "traced", *path)):
+            ret += [join(d, f) for f in files]
+
+        return ret
+
+    def getTraced(self, other, **options):
+        m = self.newManager(**options)
+        return m.getResults(['traced'], [PCall('traced.setOther', other)])['traced']
+
+    def testTraceKeyReused(self):
+        self.assertEqual(self.getTraced(0), 1)
+        self.assertEqual(getPModuleClass("traced").runs, [1])
+
+        # Only reads a, so other doesn't matter
+        self.assertEqual(self.getTraced(5), 1)
+        self.assertEqual(getPModuleClass("traced").runs, [])
+
+    def testObjectsUnderOwnKey(self):
+        self.getTraced(0)
+        self.assertEqual(len(self.files("total")), 1)
+
+        for filename in self.files("__results__"):
+            remove(filename)
+
+        # Run again under the key of the first run, reading more
+        # than it did; neither the results nor the object it caches
+        # may go under that key.
+        m = self.newManager()
+        getPModuleClass("traced").read_other = True
+        self.assertEqual(m.getResults(['traced'], [PCall('traced.setOther', 5)])['traced'], 6)
+
+        self.assertEqual(self.files("__results__"), [])
+        self.assertEqual(len(self.files("total")), 2)
+
+        self.assertEqual(self.getTraced(0), 1)
+
+    def testTracingTree(self):
+        t = TreeDict()
+        t["copy"] = 1
+        t.a.b = 2
+        t.c = 3
+        t.freeze()
+
+        accessed = set()
+        p = TracingTree(t, "", accessed)
+
+        self.assertEqual(p["copy"], 1)
+        self.assertEqual(p.get("copy"), 1)
+        self.assertEqual(p.a.b, 2)
+        self.assertTrue(p.isFrozen())
+        self.assertEqual(accessed, set(["copy", "a.b"]))
+
+        # As with a TreeDict, methods hide parameters of the same
+        # name, and are taken to read everything
+        self.assertEqual(p.copy, t.copy)
+        self.assertTrue("" in accessed)
+        self.assertEqual(sorted(p.keys()), ["a.b", "c", "copy"])
+
+
+class TestProcesses(ProjectTestCase):
+
+    def setUp(self):
+        ProjectTestCase.setUp(self)
+        self.shm_directory = join(self.directory, "shm")
+        makedirs(self.shm_directory)
+
+    def testRunInProcess(self):
+        r = runInProcess(lambda: TreeDict(x = arange(10000), pid = getpid()),
+                         self.shm_directory, threshold = 1000)
+
+        self.assertNotEqual(r.pid, getpid())
+        self.assertTrue((r.x == arange(10000)).all())
+        self.assertFalse(r.x.flags.writeable)
+
+        # The names are removed once mapped
+        self.assertEqual(listdir(self.shm_directory), [])
+
+    def testErrorPassedOn(self):
+        def fail():
+            raise KeyError("missing")
+
+        self.assertRaises(KeyError, lambda: runInProcess(fail, self.shm_directory))
+        self.assertEqual(listdir(self.shm_directory), [])
+
+    def testForkWhileLocksHeld(self):
+        # Another thread holds the logging lock and the graph lock,
+        # as when it's writing a message or building the graph
+        m = self.newManager()
+        common = m._newCommon()
+
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with common.lock:
+                logging._acquireLock()
+
+                try:
+                    held.set()
+                    release.wait(10)
+                finally:
+                    logging._releaseLock()
+
+        t = threading.Thread(target = hold)
+        t.start()
+        held.wait(10)
+
+        def f():
+            # Both are free again in the worker
+            logging.getLogger("RunCTRL").debug("Logging in the worker.")
+
+            with common.lock:
+                return getpid()
+
+        try:
+            start_time = time.time()
+            pid = runInProcess(f, self.shm_directory, at_fork = common.afterFork)
+            self.assertTrue(time.time() - start_time < 5)
+        finally:
+            release.set()
+            t.join()
+
+        self.assertNotEqual(pid, getpid())
+
+    def testModuleInProcess(self):
+        m = self.newManager(shared_memory_directory = self.shm_directory)
+        r = m.getResults(['inprocess'])['inprocess']
+
+        self.assertNotEqual(r.pid, getpid())
+        self.assertTrue((r.numbers == arange(100000)).all())
+        self.assertEqual(listdir(self.shm_directory), [])
+
+        # Cached as any other results
+        m = self.newManager(shared_memory_directory = self.shm_directory)
+        self.assertTrue((m.getResults(['inprocess'])['inprocess'].numbers == arange(100000)).all())
+
+
+class TestBatches(ProjectTestCase):
+
+    def testBatchSplitIntoPoints(self):
+        for workers in [1, 4]:
+            m = self.newManager(parallel_workers = workers,
+                                cache_directory = join(self.directory, "cache-%d" % workers))
+
+            self.assertEqual(m.getResults(['sweep'], [PCall('sweep.setN', 5)])['sweep'], 30)
+            self.assertEqual(getPModuleClass("point").batches, [5])
+
+            # Each point is cached on its own
+            m = self.newManager(parallel_workers = workers,
+                                cache_directory = join(self.directory, "cache-%d" % workers))
+
+            self.assertEqual(m.getResults(['point'])['point'], 0)
+            self.assertEqual(m.getResults(['sweep'], [PCall('sweep.setN', 6)])['sweep'], 55)
+            self.assertEqual(getPModuleClass("point").batches, [1])
+
+
+class TestPresetCache(ProjectTestCase):
+
+    def testTreesReused(self):
+        m = self.newManager()
+
+        t = getParameterTree([PCall('hooked.setA', 3)])
+        self.assertTrue(getParameterTree([PCall('hooked.setA', 3)]) is t)
+        self.assertEqual(t.hooked.a, 3)
+        self.assertEqual(getParameterTree([PCall('hooked.setA', 4)]).hooked.a, 4)
+
+    def testGivenTreeModified(self):
+        m = self.newManager()
+        getParameterTree([PCall('hooked.setA', 3)])
+
+        # A tree passed in is the one returned, even if the same
+        # presets were applied to the default tree before
+        t = getParameterTree([]).copy()
+        self.assertTrue(getParameterTree([PCall('hooked.setA', 3)], t) is t)
+        self.assertEqual(t.hooked.a, 3)
+        self.assertTrue(t.isFrozen())
+
+    def testParsedArgumentsNotShared(self):
+        m = self.newManager()
+
+        pi = parsePreset('hooked.setA:3')
+        pi.list_args.append(4)
+
+        self.assertEqual(parsePreset('hooked.setA:3').list_args, [3])
+
+    def testLeastRecentlyUsedDropped(self):
+        m = self.newManager()
+
+        cache_size = presets._parameter_tree_cache_size
+        presets._parameter_tree_cache_size = 2
+
+        def tree(a):
+            return getParameterTree([PCall('hooked.setA', a)])
+
+        try:
+            t1, t2 = tree(1), tree(2)
+
+            # 1 is used again, so 2 is the one dropped for 3
+            self.assertTrue(tree(1) is t1)
+            tree(3)
+
+            self.assertTrue(tree(1) is t1)
+            self.assertFalse(tree(2) is t2)
+        finally:
+            presets._parameter_tree_cache_size = cache_size
+
+    def testClearedOnReset(self):
+        m = self.newManager()
+        self.assertEqual(m.getResults(['hooked'], [PCall('hooked.setA', 3)])['hooked'], 30)
+
+        # The preset changes between sessions
+        filename = join(self.project_directory, "features", "hooks.py")
+
+        with open(filename) as f:
+            source = f.read()
+
+        with open(filename, 'w') as f:
+            f.write(source.replace("        p.a = a\n", "        p.a = a + 1\n"))
+
+        # Written within the same second as the compiled file may be
+        if exists(filename + "c"):
+            remove(filename + "c")
+
+        m = self.newManager()
+        self.assertEqual(m.getResults(['hooked'], [PCall('hooked.setA', 3)])['hooked'], 40)
+
+
+class TestPresetIndex(ProjectTestCase):
+
+    def testIndex(self):
+        index = PresetIndex()
+        index.add("fan.wide", ["width", "seconds"])
+        index.add("fan.narrow")
+        index.add("chain.setdepth", ["depth"])
+        index.add("fan.wide")
+
+        self.assertEqual(index.complete("fan."),
+                         ["fan.narrow", "fan.wide", "fan.wide:seconds=", "fan.wide:width="])
+        self.assertEqual(index.complete("fan.wide:w"), ["fan.wide:width="])
+        self.assertEqual(index.complete("fan.", limit = 1), ["fan.narrow"])
+        self.assertEqual(index.complete("x"), [])
+
+        self.assertEqual(index.closest("fan.wdie", 1), ["fan.wide"])
+        self.assertEqual(index.closest("chain.setdepht", 2)[0], "chain.setdepth")
+
+        # Saved for completion without loading the project
+        filename = join(self.directory, "completions")
+        index.save(filename)
+
+        loaded = PresetIndex.load(filename)
+        self.assertEqual(loaded.complete("fan.wide"), index.complete("fan.wide"))
+        self.assertEqual(loaded.closest("fan.wdie", 1), ["fan.wide"])
+
+    def testEditDistance(self):
+        self.assertEqual(editDistance("wide", "wide"), 0)
+        self.assertEqual(editDistance("wide", "wdie"), 2)
+        self.assertEqual(editDistance("", "abc"), 3)
+        self.assertEqual(editDistance("kitten", "sitting"), 3)
+
+    def testProjectPresets(self):
+        m = self.newManager()
+
+        self.assertEqual(completePreset("fan.w"),
+                         ["fan.wide", "fan.wide:seconds=", "fan.wide:width="])
+        self.assertTrue("chain.setdepth" in completePreset("chain."))
+
+
+class TestAsync(ProjectTestCase):
+
+    def newManager(self, **options):
+        options.setdefault("cache_directory", None)
+        return ProjectTestCase.newManager(self, **options)
+
+    def submit(self, m, width, seconds):
+        return m.getResultsAsync(['fan'], [PCall('fan.wide', width, seconds)])['fan']
+
+    def testFutures(self):
+        m = self.newManager()
+
+        f = self.submit(m, 3, 0.0)
+        self.assertEqual(f.result(timeout = 10), 3)
+        self.assertTrue(f.done())
+        self.assertFalse(f.cancelled())
+        self.assertEqual(f.exception(), None)
+
+        called = []
+        f.addDoneCallback(called.append)
+        self.assertEqual(called, [f])
+
+    def testSameRequestShared(self):
+        m = self.newManager()
+
+        f1 = self.submit(m, 2, 0.2)
+        f2 = self.submit(m, 2, 0.2)
+        self.assertFalse(f1 is f2)
+
+        self.assertEqual((f1.result(10), f2.result(10)), (1, 1))
+        self.assertEqual(sorted(getPModuleClass("sleeper").runs), [0, 1])
+
+    def testQueuedTreesShareNodes(self):
+        m = self.newManager()
+
+        # Keeps the worker busy while the others are queued
+        busy = self.submit(m, 1, 0.3)
+
+        f3 = self.submit(m, 3, 0.0)
+        f4 = self.submit(m, 4, 0.0)
+
+        self.assertEqual((busy.result(10), f3.result(10), f4.result(10)), (0, 3, 6))
+
+        # Without the cache, the sleepers the two have in common are
+        # only run once because they are in the same pass.
+        self.assertEqual(sorted(getPModuleClass("sleeper").runs), [0, 0, 1, 2, 3])
+
+    def testCancelPending(self):
+        m = self.newManager()
+
+        busy = self.submit(m, 1, 0.3)
+        f = self.submit(m, 3, 0.0)
+
+        self.assertTrue(f.cancel())
+        self.assertTrue(f.cancelled())
+        self.assertRaises(CancelledError, f.result)
+
+        self.assertEqual(busy.result(10), 0)
+        self.assertEqual(getPModuleClass("sleeper").runs, [0])
+
+    def testCancelRunning(self):
+        m = self.newManager()
+
+        f = self.submit(m, 1, 30.0)
+
+        while not getPModuleClass("sleeper").runs:
+            time.sleep(0.01)
+
+        start_time = time.time()
+        self.assertTrue(f.cancel())
+
+        # The worker is free again right away
+        self.assertEqual(self.submit(m, 2, 0.0).result(10), 1)
+        self.assertTrue(time.time() - start_time < 5)
+
+    def testFailureLeavesOtherTrees(self):
+        m = self.newManager()
+
+        getPModuleClass("resumable").fail_at = 3
+
+        busy = self.submit(m, 1, 0.3)
+
+        def squares(n):
+            return m.getResultsAsync(['resumable'], [PCall('resumable.setN', n)])['resumable']
+
+        bad = squares(6)
+        good = squares(2)
+
+        self.assertEqual(busy.result(10), 0)
+        self.assertRaises(RuntimeError, lambda: bad.result(10))
+        self.assertEqual(good.result(10).squares, [0, 1])
+
+
+class TestIOBound(ProjectTestCase):
+
+    def timeWaitFan(self, **options):
+        m = self.newManager(cache_directory = None, **options)
+
+        start_time = time.time()
+        self.assertEqual(m.getResults(['waitfan'], [PCall('waitfan.wide', 4, 0.3)])['waitfan'], 6)
+
+        return time.time() - start_time
+
+    def testWaitsOverlap(self):
+        # With one worker for everything else
+        self.assertTrue(self.timeWaitFan() < 0.9)
+
+    def testIOWorkersOff(self):
+        self.assertTrue(self.timeWaitFan(io_workers = 0) >= 1.2)
+
+    def testLimitedIOWorkers(self):
+        t = self.timeWaitFan(io_workers = 2)
+        self.assertTrue(0.6 <= t < 1.2)
+
+
+class TestResultsBatch(ProjectTestCase):
+
+    def testSharedNodesRunOnce(self):
+        m = self.newManager(cache_directory = None)
+
+        r = m.getResultsBatch([([PCall('fan.wide', 3, 0.0)], ['fan']),
+                               ([PCall('fan.wide', 4, 0.0)], ['fan', 'sleeper']),
+                               ([], 'sleeper')])
+
+        self.assertEqual(r, [{'fan' : 3}, {'fan' : 6, 'sleeper' : 0}, {'sleeper' : 0}])
+
+        # The sleepers of the narrower fan are those of the wider one
+        self.assertEqual(sorted(getPModuleClass("sleeper").runs), [0, 1, 2, 3])
+
+    def testParallel(self):
+        m = self.newManager(cache_directory = None, parallel_workers = 4)
+
+        r = m.getResultsBatch([([PCall('fan.wide', 4, 0.1)], ['fan']),
+                               ([PCall('chain.setDepth', 3)], ['chain'])])
+
+        self.assertEqual(r, [{'fan' : 6}, {'chain' : 3}])
+
+
+class TestIterResults(ProjectTestCase):
+
+    def testInOrderFinished(self):
+        m = self.newManager(parallel_workers = 4)
+
+        r = list(m.iterResults(['fan', 'sleeper', 'fan'], [PCall('fan.wide', 2, 0.3)]))
+
+        self.assertEqual([name for name, p, v in r], ['sleeper', 'fan', 'fan'])
+        self.assertEqual([v for name, p, v in r], [0, 1, 1])
+        self.assertEqual(r[1][1].width, 2)
+
+    def testStopEarly(self):
+        m = self.newManager(parallel_workers = 4)
+
+        results = m.iterResults(['fan', 'sleeper'], [PCall('fan.wide', 1, 30.0)])
+        self.assertEqual(results.next()[0], 'sleeper')
+
+        start_time = time.time()
+        results.close()
+
+        # The sleeper of the fan was stopped, not waited out
+        self.assertTrue(time.time() - start_time < 5)
+        self.assertFalse([t for t in threading.enumerate() if t.name == "lazyrunner-results"])
+
+        self.assertEqual(m.getResults(['chain'], [PCall('chain.setDepth', 2)])['chain'], 2)
+
+
+class TestTimeouts(ProjectTestCase):
+
+    def cached(self, name):
+        d = join(self.cache_directory, name, "__results__")
+        return listdir(d) if exists(d) else []
+
+    def getSlowFan(self, m, **kw):
+        return m.getResults(['fan'], [PCall('fan.wide', 1, 30.0)], **kw)
+
+    def testTimeoutLeavesNoCacheEntry(self):
+        m = self.newManager()
+
+        start_time = time.time()
+        self.assertRaises(ModuleTimeout, lambda: self.getSlowFan(m, timeout = 0.2))
+        self.assertTrue(time.time() - start_time < 5)
+
+        self.assertEqual(self.cached("sleeper"), [])
+        self.assertEqual(self.cached("fan"), [])
+
+    def testClassTimeout(self):
+        m = self.newManager()
+        getPModuleClass("sleeper").timeout = 0.2
+
+        self.assertRaises(ModuleTimeout, lambda: self.getSlowFan(m))
+        self.assertEqual(self.cached("sleeper"), [])
+
+    def testTimeoutInProcess(self):
+        shm_directory = join(self.directory, "shm")
+        makedirs(shm_directory)
+
+        m = self.newManager(shared_memory_directory = shm_directory)
+        getPModuleClass("sleeper").run_in_process = True
+
+        start_time = time.time()
+        self.assertRaises(ModuleTimeout, lambda: self.getSlowFan(m, timeout = 0.2))
+        self.assertTrue(time.time() - start_time < 5)
+
+        self.assertEqual(listdir(shm_directory), [])
+        self.assertEqual(self.cached("sleeper"), [])
+
+    def testCancelled(self):
+        m = self.newManager()
+
+        common = m._newCommon()
+        common.cancel()
+
+        self.assertRaises(ModuleCancelled,
+                          lambda: common.getResults(getParameterTree([]), ['sleeper']))
+        self.assertEqual(self.cached("sleeper"), [])
+
+    def testSiblingsFinishedAfterError(self):
+        m = self.newManager(parallel_workers = 4)
+        getPModuleClass("sleeper").fail_index = 0
+
+        self.assertRaises(RuntimeError, lambda: m.getResults(
+            ['fan'], [PCall('fan.wide', 2, 0.3)]))
+
+        # The sleeper still running when the other failed is cached
+        self.assertEqual(len(self.cached("sleeper")), 1)
+        self.assertEqual(self.cached("fan"), [])
+
+        # ... and its run time recorded
+        self.assertTrue(m.history.meanRunTime("sleeper") >= 0.3)
+
+        getPModuleClass("sleeper").fail_index = None
+        del getPModuleClass("sleeper").runs[:]
+
+        self.assertEqual(m.getResults(['fan'], [PCall('fan.wide', 2, 0.3)])['fan'], 1)
+        self.assertEqual(getPModuleClass("sleeper").runs, [0])
+
+
+class TestProgress(ProjectTestCase):
+
+    def testReportsEndFinished(self):
+        m = self.newManager(parallel_workers = 4)
+
+        reports = []
+        m.setProgressCallback(reports.append, interval = 0)
+
+        self.assertEqual(m.getResults(['fan'], [PCall('fan.wide', 4, 0.1)])['fan'], 6)
+
+        self.assertTrue(reports[-1].finished)
+        self.assertFalse(any(p.finished for p in reports[:-1]))
+
+        self.assertEqual(reports[-1].n_planned, 5)
+        self.assertEqual(reports[-1].n_done, 5)
+        self.assertEqual(reports[-1].fraction(), 1.0)
+
+    def testPlannedOnce(self):
+        m = self.newManager()
+        m.setProgressCallback(lambda p: None)
+
+        common = m._newCommon()
+
+        probed = []
+        probeStatus = common._probeStatus
+
+        def countingProbe(pn):
+            probed.append( (pn.name, pn.key) )
+            return probeStatus(pn)
+
+        common._probeStatus = countingProbe
+
+        try:
+            common.getResults(getParameterTree([PCall('fan.wide', 4)]), ['fan'])
+        finally:
+            m._finishRun(common)
+
+        self.assertEqual(len(probed), 5)
+        self.assertEqual(len(set(probed)), 5)
+
+    def testIntervalClamped(self):
+        tracker = ProgressTracker(lambda p: None, lambda name, key: None, interval = 0)
+        self.assertEqual(tracker.interval, min_interval)
+
+        tracker = ProgressTracker(lambda p: None, lambda name, key: None, interval = 2)
+        self.assertEqual(tracker.interval, 2)
+
+    def testFormatSize(self):
+        self.assertEqual(formatSize(None), "?")
+        self.assertEqual(formatSize(512), "512 B")
+        self.assertEqual(formatSize(2048), "2.0 KB")
+        self.assertEqual(formatSize(3 * 2**30), "3.0 GB")
+
+    def testFormatTime(self):
+        self.assertEqual(formatTime(None), "?")
+        self.assertEqual(formatTime(30), "30.0s")
+        self.assertEqual(formatTime(90), "1.5m")
+        self.assertEqual(formatTime(7200), "2.0h")
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file